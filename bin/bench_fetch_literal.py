@@ -0,0 +1,80 @@
+import socket, threading, time, argparse, re
+
+from imapproxy.framing import IMAPReader, literal_size
+
+""" Throughput of the FETCH literal relay: line-by-line path vs streaming path """
+
+# Tagged response from the server (line-by-line path)
+Tagged_Response = re.compile(r'\A(?P<tag>[A-Z0-9]+)'
+    r'\s(OK)'
+    r'(\s\[(?P<flags>.*)\])?'
+    r'\s(?P<command>[A-Z]*)', flags=re.IGNORECASE)
+
+def fetch_response(size):
+    """ Return a FETCH response with a base64-like literal of about size bytes """
+    line = b'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAxMjM0\r\n'
+    literal = line * (size // len(line))
+    return (b'* 1 FETCH (UID 1 BODY[] {' + str(len(literal)).encode() + b'}\r\n'
+            + literal + b')\r\nA1 OK FETCH completed\r\n')
+
+def line_by_line(server, client):
+    """ Previous path: every line is decoded, matched, re-encoded and sent """
+    file = server.makefile('rb')
+    while True:
+        response = file.readline().decode('utf-8', 'replace')
+        match = Tagged_Response.match(response)
+        client.send(response.encode('utf-8', 'replace'))
+        if match and match.group('tag') == 'A1':
+            return
+
+def streaming(server, client):
+    """ Current path: lines are matched, literals are streamed in chunks """
+    reader = IMAPReader(server.makefile('rb'))
+    while True:
+        response = reader.read_line()
+        client.sendall(response)
+        if response.startswith(b'A1 '):
+            return
+        literal = literal_size(response)
+        while literal:
+            for chunk in reader.read_chunks(literal[0]):
+                client.sendall(chunk)
+            response = reader.read_line()
+            client.sendall(response)
+            literal = literal_size(response)
+
+def run(relay, payload):
+    """ Return the time spent to relay the payload from a server socket to a client socket """
+    server_in, server_out = socket.socketpair()
+    client_in, client_out = socket.socketpair()
+
+    def drain():
+        received = 0
+        while received < len(payload):
+            received += len(client_out.recv(1 << 20))
+
+    threading.Thread(target=server_in.sendall, args=(payload,)).start()
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+
+    start = time.perf_counter()
+    relay(server_out, client_in)
+    drainer.join()
+    elapsed = time.perf_counter() - start
+
+    for s in (server_in, server_out, client_in, client_out):
+        s.close()
+
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', type=int, default=30, help='Size of the literal in MB (default: 30)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per path (default: 3)')
+    args = parser.parse_args()
+
+    payload = fetch_response(args.size * 1024 * 1024)
+
+    for name, relay in (('line-by-line', line_by_line), ('streaming', streaming)):
+        best = min(run(relay, payload) for i in range(args.repeat))
+        print('%-12s %8.1f MB/s' % (name, len(payload) / best / 1024 / 1024))
@@ -0,0 +1,90 @@
+import os, re, time, argparse, imaplib, tracemalloc, email
+from io import BytesIO
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+
+from imapproxy import pycircleanmail, fetchcache
+from imapproxy.signer import legacy_signature
+
+""" Time and peak memory of the replacement of an email by its sanitized copy:
+parsed and serialized emails (previous path) vs raw header splicing """
+
+class Server:
+
+    r""" imaplib connection appending nowhere, with the copy made by imaplib.append """
+
+    capabilities = ('IMAP4REV1', 'UIDPLUS', 'MOVE')
+    utf8_enabled = False
+
+    def __init__(self):
+        self.uid = 0
+        self.literal = None
+
+    def append(self, mailbox, flags, date_time, message):
+        self.literal = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+        return self._simple_command('APPEND', mailbox, flags, date_time)
+
+    def _simple_command(self, name, *args):
+        self.literal = None # Sent
+        self.uid += 1
+        return 'OK', [b'[APPENDUID 1 %d] Append completed' % self.uid]
+
+def make_email(size):
+    """ Return a raw email (CRLF line endings) with an attachment of about size bytes """
+    mail = MIMEMultipart()
+    mail['From'], mail['To'], mail['Subject'] = 'bench@example.com', 'user@example.com', 'Benchmark'
+    mail['Date'] = 'Mon, 1 Jan 2018 00:00:00 +0000'
+    mail.attach(MIMEText('Lorem ipsum dolor sit amet.\n' * 100))
+    mail.attach(MIMEApplication(os.urandom(size * 3 // 4), Name='data.bin'))
+    return imaplib.MapCRLF.sub(imaplib.CRLF, mail.as_bytes())
+
+def previous(bmail, content, server, key):
+    """ Previous path: both emails are parsed, then serialized with their headers """
+    mail = email.message_from_bytes(bmail)
+    date_str = mail.get('Date')
+    date = imaplib.Internaldate2tuple(date_str.encode()) if date_str else imaplib.Time2Internaldate(time.time())
+
+    smail = email.message_from_bytes(BytesIO(content).getvalue())
+    for copy, value, folder in ((smail, 'Sanitized', 'INBOX'), (mail, 'Original', 'Quarantine')):
+        copy.add_header('X-CIRCL-Sanitizer', value)
+        copy.add_header('X-Proxy-Sign', legacy_signature(copy, key))
+        server.append(folder, '', date, str(copy).encode())
+
+def current(bmail, content, server, key):
+    """ Current path (see pycircleanmail.process_email) """
+    pycircleanmail.process_email(bmail, content, server, 'INBOX', key)
+
+def measure(process, bmail, content, repeat):
+    """ Return (best time in seconds, peak memory in bytes) to process the email """
+    best = min(timed(process, bmail, content) for i in range(repeat))
+
+    tracemalloc.start()
+    process(bmail, content, Server(), 'key')
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+def timed(process, bmail, content):
+    start = time.perf_counter()
+    process(bmail, content, Server(), 'key')
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', default='1,10,30', help='Comma-separated sizes of the emails in MB (default: 1,10,30)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per path (default: 3)')
+    args = parser.parse_args()
+
+    fetchcache.configure(0) # The appended emails are not kept
+
+    print('%-9s %-8s %9s %11s %12s' % ('size MB', 'path', 'time ms', 'peak MB', 'peak/size'))
+    for size in args.sizes.split(','):
+        bmail = make_email(int(float(size) * 1024 * 1024))
+        # Sanitized copy, as returned by the workers
+        content = re.sub(rb'\r\n', b'\n', email.message_from_bytes(bmail).as_bytes())
+
+        for name, process in (('previous', previous), ('current', current)):
+            best, peak = measure(process, bmail, content, args.repeat)
+            print('%-9s %-8s %9.1f %11.1f %12.1f' % (size, name, best * 1000, peak / 1024 / 1024, peak / len(bmail)))
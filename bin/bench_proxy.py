@@ -0,0 +1,57 @@
+import argparse
+
+from imapproxy.proxy import ENGINES
+from imapproxy.pool import MAX_SESSIONS
+from imapproxy.bench.fakeimap import MESSAGE_SIZE
+from imapproxy.bench.load import SCENARIOS
+from imapproxy.bench.harness import run
+
+""" Load test of the proxy against stand-in IMAP and SMTP servers, for each engine """
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--scenarios', default=','.join(SCENARIOS), help='Scenarios to run (default: ' + ','.join(SCENARIOS) + ')')
+    parser.add_argument('-e', '--engines', default=','.join(ENGINES), help='Engines to compare (default: ' + ','.join(ENGINES) + ')')
+    parser.add_argument('-c', '--clients', type=int, help='Number of clients (default: 1000 for idle, 4 otherwise)')
+    parser.add_argument('-r', '--requests', type=int, default=5, help='Number of commands per client (default: 5)')
+    parser.add_argument('--handshakes', type=int, default=200, help='Number of connections per client of the handshake scenario (default: 200)')
+    parser.add_argument('-p', '--pipeline', type=int, default=10, help='Number of commands sent at once in the pipeline scenario (default: 10)')
+    parser.add_argument('-f', '--fetch', type=int, default=5000, help='Number of emails fetched by FETCH 1:n (default: 5000)')
+    parser.add_argument('-a', '--append-size', type=int, default=10, help='Size of the appended emails in MB (default: 10)')
+    parser.add_argument('-m', '--messages', type=int, default=0, help='Number of emails in the INBOX (default: enough for the scenario)')
+    parser.add_argument('--message-size', type=int, default=MESSAGE_SIZE, help='Size of the emails in bytes (default: ' + str(MESSAGE_SIZE) + ')')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='Latency of the IMAP server in ms (default: 0)')
+    parser.add_argument('--hold', type=float, default=2, help='Time the idle clients stay connected in s (default: 2)')
+    parser.add_argument('-s', '--sessions', type=int, default=MAX_SESSIONS, help='Maximum number of upstream sessions per account (default: ' + str(MAX_SESSIONS) + ')')
+    parser.add_argument('--tls', action='store_true', help='Clients connect to the proxy with SSL/TLS')
+    parser.add_argument('-z', '--compress', default='', help='Comma-separated legs compressed with COMPRESS=DEFLATE: client and/or server (default: none)')
+    parser.add_argument('--metrics', action='store_true', help='Enable the metrics of the proxy (to measure their cost)')
+    parser.add_argument('--unsanitized', action='store_true', help='Emails are not marked as sanitized (needs PyCIRCLeanMail)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the proxy')
+    args = parser.parse_args()
+
+    args.latency /= 1000
+    args.append_size *= 1024 * 1024
+
+    print('%-8s %-7s %6s %8s %9s %9s %9s %9s %12s %7s' % ('engine', 'scenario', 'conns', 'commands',
+        'cmds/s', 'p50 ms', 'p99 ms', 'MB/s', 'RSS/conn KB', 'errors'))
+
+    for scenario in args.scenarios.split(','):
+        options = argparse.Namespace(**vars(args))
+        if options.clients is None:
+            options.clients = 1000 if scenario == 'idle' else 4
+
+        for engine in args.engines.split(','):
+            results = run(engine, scenario, options)
+            rss = results['rss_per_connection']
+            print('%-8s %-8s %6d %8d %9.1f %9.2f %9.2f %9.1f %12s %7d' % (engine, scenario, results['connections'],
+                results['commands'], results['commands_s'], results['p50_ms'], results['p99_ms'],
+                results['bytes_s'] / 1024 / 1024, '%.1f' % (rss / 1024) if rss is not None else '-', results['errors']))
+            if 'forwarded' in results:
+                print('%17s forwarded to MISP: %d, last one %s s after the run' % ('', results['forwarded'],
+                    '%.2f' % results['misp_drain_s'] if results['misp_drain_s'] is not None else '-'))
+            if results['compression'] is not None:
+                print('%17s client bytes on the wire: %.1f%% of the IMAP payload' % ('', results['compression'] * 100))
+            if 'handshakes_s' in results:
+                print('%17s %s/s: %.1f, sessions resumed: %.0f%%' % ('', 'handshakes' if args.tls else 'connections',
+                    results['handshakes_s'], results['resumed'] * 100))
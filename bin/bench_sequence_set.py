@@ -0,0 +1,48 @@
+import time, argparse, tracemalloc
+
+from imapproxy.helpers import SequenceSet
+
+""" Time and memory of the id sets: expanded list of ids vs SequenceSet """
+
+def parse_ids(str_ids):
+    """ Previous helper: every id of the set is expanded in a list """
+    ids = []
+    for s in str_ids.split(','):
+        if ':' in s:
+            (start, end) = s.split(':')
+            ids.extend(range(int(start), int(end)+1))
+        else:
+            ids.append(int(s))
+    return ids
+
+def measure(parse, str_ids, repeat):
+    """ Return (best time in seconds, peak memory in bytes) to parse str_ids """
+    best = min(timed(parse, str_ids) for i in range(repeat))
+
+    tracemalloc.start()
+    ids = parse(str_ids)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+def timed(parse, str_ids):
+    start = time.perf_counter()
+    parse(str_ids)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=1000000, help='Number of uids in the mailbox (default: 1000000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per set (default: 3)')
+    args = parser.parse_args()
+
+    cases = (
+        ('whole mailbox', '1:%d' % args.number),
+        ('sparse', ','.join('%d:%d' % (i, i + 5) for i in range(1, args.number, 10))),
+    )
+
+    for case, str_ids in cases:
+        for name, parse in (('list', parse_ids), ('SequenceSet', SequenceSet.parse)):
+            best, peak = measure(parse, str_ids, args.repeat)
+            print('%-14s %-12s %10.2f ms %10.1f KB' % (case, name, best * 1000, peak / 1024))
@@ -0,0 +1,17 @@
+import argparse, time
+
+from imapproxy.tracer import read_dump, ARROWS
+
+""" Print the dumps of the last events of connections, written by the tracer on error """
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dumps', nargs='+', help='Dump files (trace_dumps/connection-*.trace)')
+    args = parser.parse_args()
+
+    for path in args.dumps:
+        reason, events = read_dump(path)
+        print('%s: %s' % (path, reason))
+        for (timestamp, direction, data) in events:
+            print('%s.%03d %s%r' % (time.strftime('%H:%M:%S', time.localtime(timestamp)), timestamp % 1 * 1000,
+                ARROWS[direction], data))
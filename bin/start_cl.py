@@ -1,19 +1,38 @@
-import argparse
+import argparse, functools
 
-from imapproxy.proxy import IMAP_Proxy
+from imapproxy.proxy import IMAP_Proxy, ENGINES, MAX_SESSIONS
+from imapproxy import tracer
 
 if __name__ == '__main__':
     # Parser
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--certfile', help='Enable SSL/TLS connection with the given certfile (default: None). ' +
                                                     'Should be the path to a certificate.')
+    parser.add_argument('--starttls', action='store_true', help='With a certfile, listen in plain text (default port: 143) and offer STARTTLS')
     parser.add_argument('-k', '--key', help='String key used to verify the integrity of emails append by the proxy (default: secret-proxy)')
     parser.add_argument('-p', '--port', type=int, help='Listen on the given port (default: 143 without certfile or 993)')
-    parser.add_argument('-n', '--nclient', type=int, help='Maximum number of client supported by the proxy (default: 5)')
-    parser.add_argument('-v', '--verbose', help='Echo IMAP payload', action='store_true')
+    parser.add_argument('-n', '--nclient', type=int, help='Maximum number of clients connected at the same time, the next ones are disconnected (default: 500)')
+    parser.add_argument('-v', '--verbose', help='Trace IMAP payload', action='store_true')
+    parser.add_argument('--trace-file', help='Append the trace to the given file (default: standard output)')
+    parser.add_argument('--trace-sample', type=float, default=tracer.SAMPLE, help='Fraction of the connections traced (default: 1, 0 only dumps the last events on error)')
+    parser.add_argument('--trace-users', default='', help='Comma-separated usernames whose connections are always traced')
+    parser.add_argument('--trace-dumps', default=tracer.DUMP_PATH, help='Directory of the dumps of the last events on error (default: ' + tracer.DUMP_PATH + ')')
     parser.add_argument('-6', '--ipv6', help='Enable IPv6 connection', action='store_true')
+    parser.add_argument('-e', '--engine', choices=ENGINES, help='Connection engine: one thread per client or one asyncio event loop (default: thread)')
+    parser.add_argument('-s', '--sessions', type=int, help='Maximum number of upstream sessions per account kept in the pool (default: 10, 0 disables the pool)')
+    parser.add_argument('-m', '--metrics', type=int, help='Serve the metrics of the proxy on http://host:METRICS/metrics (default: disabled)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes sharing the port (default: 1)')
+    parser.add_argument('-z', '--compress', default='', help='Comma-separated legs compressed with COMPRESS=DEFLATE: client and/or server (default: none)')
     args = parser.parse_args()
 
+    # Configuration of the tracer, in each worker process
+    setup = None
+    if args.verbose:
+        setup = functools.partial(tracer.configure, args.trace_file, args.trace_sample,
+            [u for u in args.trace_users.split(',') if u], dump_path=args.trace_dumps)
+
     # Start proxy
     print("Starting proxy")
-    IMAP_Proxy(port=args.port, certfile=args.certfile, key=args.key, max_client=args.nclient, ipv6=args.ipv6, verbose=args.verbose)
\ No newline at end of file
+    IMAP_Proxy(port=args.port, certfile=args.certfile, key=args.key, max_client=args.nclient, ipv6=args.ipv6, verbose=args.verbose, engine=args.engine,
+        max_sessions=MAX_SESSIONS if args.sessions is None else args.sessions, metrics_port=args.metrics,
+        workers=args.workers, setup=setup, starttls=args.starttls, compress=[leg for leg in args.compress.split(',') if leg])
\ No newline at end of file
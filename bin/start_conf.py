@@ -1,20 +1,10 @@
-import configparser
-
 from imapproxy.proxy import IMAP_Proxy
+from imapproxy import config
 
 if __name__ == '__main__':
     # Parser
-    parser = configparser.RawConfigParser()
-    fp = open('imapproxy.conf', 'rt')
-    parser.read_file(fp)
-
-    certfile = parser.get('general', 'certfile')
-    key = parser.get('general', 'key')
-    port = parser.getint('general', 'port')
-    nclient = parser.getint('general', 'nclient')
-    verbose = parser.getboolean('general', 'verbose_enabled')
-    ipv6 = parser.getboolean('general', 'ipv6_enabled')
+    options = config.proxy_options('imapproxy.conf')
 
     # Start proxy
     print("Starting proxy")
-    IMAP_Proxy(port=port, certfile=certfile, key=key, max_client=nclient, ipv6=ipv6, verbose=verbose)
\ No newline at end of file
+    IMAP_Proxy(**options)
\ No newline at end of file
@@ -0,0 +1,53 @@
+import sys, argparse
+
+from imapproxy import fetchcache
+
+""" Tests of the UID FETCH requests rewritten by the cache of the immutable data of the emails, without server """
+
+HEADER = b'{23}\r\nSubject: IMAP4 test\r\n\r\n'
+
+class FakeClient:
+
+    r""" Connection object of a client which selected INBOX (UIDVALIDITY 7) and sent the request """
+
+    def __init__(self, request):
+        self.request = request
+        self.account = 'user'
+        self.current_folder = 'INBOX'
+        self.uidvalidity = 7
+
+def run_tests(verbose=False):
+    failed_tests = []
+    fetchcache.configure(memory_size=1024 * 1024, disk_size=0)
+    fetchcache.message_cache().put(('user', 'INBOX', 7, 5, b'BODY[HEADER]'), HEADER)
+
+    def check(request, expected):
+        commands = [command for command, responses in fetchcache.process(FakeClient(request))]
+        if verbose:
+            print('[%s] %s' % (request, commands))
+        if commands != expected:
+            failed_tests.append('%s => %s instead of %s' % (request, commands, expected))
+
+    # Cached items only: the server is only asked for the UID
+    check('A1 UID FETCH 5 (UID BODY.PEEK[HEADER])', [b'UID FETCH 5 (UID)\r\n'])
+    # Simple items are asked to the server along with the cached items
+    check('A2 UID FETCH 5 (UID FLAGS BODY.PEEK[HEADER])', [b'UID FETCH 5 (UID FLAGS)\r\n'])
+    # A partial item is not cached: the request is transmitted as it is
+    check('A3 UID FETCH 5 (UID BODY.PEEK[]<0.2048> BODY.PEEK[HEADER])', [None])
+    # BODY[] sets \Seen: the request is transmitted as it is
+    check('A4 UID FETCH 5 (UID BODY[HEADER])', [None])
+
+    if not failed_tests:
+        print('TESTS SUCCEEDED')
+    else:
+        print('SOME TESTS FAILED:')
+        for test in failed_tests:
+            print(test)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help='Print the commands sent to the server', action='store_true')
+    args = parser.parse_args()
+
+    run_tests(args.verbose)
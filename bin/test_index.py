@@ -0,0 +1,64 @@
+import sys, argparse
+
+from imapproxy import pycircleanmail
+from imapproxy.helpers import SequenceSet
+from imapproxy.index import SanitizedIndex
+
+""" Tests of the index of sanitized uids updated by the PyCIRCLeanMail module, without server """
+
+SIGNED = (pycircleanmail.CIRCL_SIGN + ': ' + pycircleanmail.VALUE_SANITIZED).encode() + b'\r\n\r\n'
+
+class FakeServer:
+
+    r""" imaplib connection to a mailbox of uids 1:3 (UIDVALIDITY 7), answering the FETCH
+    of the signatures with the given result and the signatures of the given uids """
+
+    def __init__(self, result, signed):
+        self.result, self.signed = result, signed
+        self.capabilities = ('IMAP4REV1',)
+        self.host = 'localhost'
+
+    def select(self, mailbox):
+        return 'OK', [b'3']
+
+    def response(self, name):
+        return name, [{'UIDVALIDITY': b'7', 'UIDNEXT': b'4'}[name]]
+
+    def uid(self, command, uids, items):
+        if self.result != 'OK':
+            return self.result, [b'Server unavailable']
+        return 'OK', [(('%d (UID %d BODY[HEADER.FIELDS (X-CIRCL-Sanitizer)] {%d}'
+            % (uid, uid, len(SIGNED))).encode(), SIGNED) for uid in self.signed] + [b')']
+
+def run_tests(verbose=False):
+    failed_tests = []
+    requested = SequenceSet.parse('1:3')
+
+    def check(name, result, signed, missing):
+        pycircleanmail.INDEX = SanitizedIndex()
+        pycircleanmail.process_emails(requested, FakeServer(result, signed), 'INBOX', True, None, 'user')
+        found = pycircleanmail.index().missing('user', 'INBOX', 7, requested)
+        if verbose:
+            print('[%s] missing: %s' % (name, found))
+        if found != SequenceSet.parse(missing):
+            failed_tests.append('%s => missing %s instead of %s' % (name, found, missing))
+
+    # Nothing is recorded when the server refuses the FETCH of the signatures
+    check('signatures NO', 'NO', [], '1:3')
+    # Only the uids returned sanitized are recorded, not the others below UIDNEXT
+    check('signatures OK', 'OK', [1, 3], '2')
+
+    if not failed_tests:
+        print('TESTS SUCCEEDED')
+    else:
+        print('SOME TESTS FAILED:')
+        for test in failed_tests:
+            print(test)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', help='Print the uids missing from the index', action='store_true')
+    args = parser.parse_args()
+
+    run_tests(args.verbose)
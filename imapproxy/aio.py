@@ -0,0 +1,501 @@
+"""
+    Asyncio engine of the proxy.
+    Client and server sessions of every connection run as coroutines on one event loop.
+"""
+
+import asyncio, ssl, socket, imaplib, functools, time, signal, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .proxy import BaseConnection, split_hostname, DRAIN_TIMEOUT, DRAIN_INTERVAL, TOO_MANY_CLIENTS
+from .helpers import refresh_capabilities
+from .framing import CHUNK_SIZE, literal_size
+from . import metrics
+from .tls import start_tls
+from .pool import WAIT_TIMEOUT
+from .idle import Watcher, Update, LINGER, REIDLE_INTERVAL, RETRY_DELAY
+from .compress import negotiate, DeflatingWriter
+from .streams import open_connection, start_server
+
+def run(proxy):
+    """ Serve the clients of the given IMAP_Proxy on a new event loop until interrupted """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # SSL/TLS is started by new_connection, with the current context of the proxy
+    server = loop.run_until_complete(start_server(functools.partial(new_connection, proxy), proxy.sock))
+    if threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(drain(proxy, server)))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+async def drain(proxy, server):
+    """ Stop accepting clients, close the connections between two commands (all of them
+    after DRAIN_TIMEOUT seconds) and stop the loop (on SIGTERM) """
+
+    print('Draining', len(proxy.connections), 'connections')
+    proxy.draining = True
+    server.close()
+
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while proxy.connections and time.monotonic() < deadline:
+        for connection in list(proxy.connections):
+            await connection.close_idle()
+        await asyncio.sleep(DRAIN_INTERVAL)
+
+    for connection in list(proxy.connections):
+        connection.close()
+    asyncio.get_event_loop().stop()
+
+async def new_connection(proxy, reader, writer):
+    if not proxy.clients.acquire(blocking=False):
+        reject(proxy, writer)
+        return
+    try:
+        # Not set by asyncio: the listening socket of the proxy is created with proto 0
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if proxy.tls and not proxy.starttls: # Add SSL/TLS
+            try:
+                reader, writer = await start_tls(reader, writer, proxy.tls.context())
+            except OSError as e:
+                print('[ERROR] SSL/TLS handshake failed:', e)
+                writer.transport.abort()
+                return
+
+        if metrics.ENABLED:
+            metrics.CONNECTIONS_TOTAL.inc()
+            metrics.CONNECTIONS.inc()
+        connection = AsyncConnection(reader, writer, proxy.key, proxy.tracer, proxy.pool,
+            proxy.tls if proxy.starttls else None, proxy.idle, proxy.compress)
+        proxy.connections.add(connection)
+        try:
+            await connection.serve()
+        finally:
+            proxy.connections.discard(connection)
+            if metrics.ENABLED:
+                metrics.CONNECTIONS.dec()
+    finally:
+        proxy.clients.release()
+
+def reject(proxy, writer):
+    """ Disconnect a client over the max_client limit (see IMAP_Proxy.reject) """
+    print('[ERROR] Too many clients, connection refused')
+    if metrics.ENABLED:
+        metrics.CONNECTIONS_REJECTED.inc()
+    if not proxy.tls or proxy.starttls:
+        writer.write((TOO_MANY_CLIENTS + '\r\n').encode())
+    writer.close()
+
+# Threads opening, unselecting and closing the upstream sessions of the pool. The modules
+# (default executor) can't delay them, and the sessions are waited for on the event loop.
+POOL_THREADS = 16
+POOL_EXECUTOR = ThreadPoolExecutor(POOL_THREADS)
+
+async def acquire_session(pool, host, username, password, connect):
+    """ Return a Session of the account from the pool (see SessionPool.acquire). An account which
+    reached its cap waits on the event loop for a released session, not in a thread. """
+
+    loop = asyncio.get_event_loop()
+    key = pool.account(host, username, password)
+    deadline = loop.time() + WAIT_TIMEOUT
+    while True:
+        released = asyncio.Event()
+        taken = pool.take(key, lambda: loop.call_soon_threadsafe(released.set))
+        if taken:
+            break
+        try:
+            await asyncio.wait_for(released.wait(), max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            raise ValueError('Error while connecting to the server: '
+                + 'Too many sessions opened for ' + username)
+
+    session, evicted = taken
+    return session or await loop.run_in_executor(POOL_EXECUTOR, pool.open, key, evicted, connect,
+        host, username, password)
+
+def client_context():
+    """ SSL/TLS context used to connect to the servers (same settings as imaplib.IMAP4_SSL) """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+class AsyncIMAP4(imaplib.IMAP4):
+
+    r""" imaplib client running over the streams of an event loop.
+
+    Instantiate with: AsyncIMAP4(loop, reader, writer[, host])
+
+            loop - Event loop owning the streams
+            reader - asyncio.StreamReader connected to the server
+            writer - asyncio.StreamWriter connected to the server
+            host - Name of the server, as with imaplib (default: '')
+
+    Every imaplib method blocks until the event loop has performed the I/O, so it must
+    be called from another thread (e.g. with loop.run_in_executor). This lets the
+    modules use the server connection exactly as with the threaded engine.
+    """
+
+    def __init__(self, loop, reader, writer, host=''):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        imaplib.IMAP4.__init__(self, host)
+
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        self.host = host # Configured name, not the address: the limits of the scheduler are per provider
+        self.port = port
+        self.sock = self.writer.get_extra_info('socket')
+
+    def run(self, coro):
+        """ Run the coroutine in the event loop and wait for its result """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def read(self, size):
+        return self.run(self.read_literal(size))
+
+    def readline(self):
+        return self.run(self.reader.readline())
+
+    def send(self, data):
+        self.run(self.write(data))
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    async def read_literal(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def compress(self):
+        """ Compress the streams once the server accepted COMPRESS DEFLATE (see compress.negotiate) """
+        self.run(self.start_compress())
+
+    async def start_compress(self):
+        await self.reader.inflate(metrics.SERVER_IN)
+        self.writer = DeflatingWriter(self.writer, metrics.SERVER_OUT)
+
+class AsyncWatcher(Watcher):
+
+    r""" Upstream IDLE on a mailbox running as a coroutine of the event loop (see idle.Watcher),
+    acquire being a coroutine function (see acquire_session) """
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """ IDLE upstream until the watcher expired """
+
+        while not self.hub.expired(self):
+            try:
+                session = await self.acquire()
+            except (imaplib.IMAP4.error, OSError, ValueError) as e:
+                print('[ERROR] Upstream IDLE of', self.mailbox, 'not opened:', e)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            try:
+                await self.watch(session.conn)
+            except (imaplib.IMAP4.error, OSError, ValueError, asyncio.IncompleteReadError) as e:
+                print('[ERROR] Upstream IDLE of', self.mailbox, 'interrupted:', e)
+                await self.loop.run_in_executor(POOL_EXECUTOR, self.pool.discard, session)
+                continue
+            await self.loop.run_in_executor(POOL_EXECUTOR, self.pool.release, session)
+            return
+
+    async def watch(self, conn):
+        """ Examine the mailbox and IDLE until the watcher expired """
+
+        typ, data = await self.loop.run_in_executor(None, conn.select, self.mailbox, True)
+        if typ != 'OK':
+            raise ValueError('Error while opening the upstream IDLE: ' + self.mailbox + ' not selected')
+
+        while True:
+            tag = conn._new_tag()
+            await conn.write(tag + b' IDLE\r\n')
+            response = await self.readline(conn)
+            while response.startswith(b'*'):
+                response = await self.readline(conn)
+            if not response.startswith(b'+'):
+                raise ValueError('Error while opening the upstream IDLE: ' + response.decode('utf-8', 'replace'))
+
+            await self.refresh() # Updates since the last command of the connections
+            expired = await self.wait_updates(conn, time.monotonic() + REIDLE_INTERVAL)
+
+            await conn.write(b'DONE\r\n')
+            response = await self.readline(conn)
+            while not response.startswith(tag + b' '):
+                response = await self.readline(conn)
+            conn.tagged_commands.pop(tag, None)
+
+            if expired:
+                return
+
+    async def wait_updates(self, conn, deadline):
+        """ Refresh the connections on the updates until the deadline (False) or the expiration of the watcher (True) """
+
+        while True:
+            timeout = min(deadline - time.monotonic(), LINGER)
+            if timeout <= 0:
+                return False
+            try:
+                # Cancelled while waiting, readline doesn't consume anything
+                line = await asyncio.wait_for(conn.reader.readline(), timeout)
+            except asyncio.TimeoutError:
+                if self.hub.expired(self):
+                    return True
+                continue
+
+            # Updates received at once are sent in one refresh
+            updated = Update.match(await self.readline(conn, line)) is not None
+            while conn.reader.size:
+                updated = Update.match(await self.readline(conn)) is not None or updated
+            if updated:
+                await self.refresh()
+
+    async def readline(self, conn, line=None):
+        """ Return the next line of the server (or the given one), without the literals it announces """
+
+        first = line = await conn.reader.readline() if line is None else line
+        literal = literal_size(line)
+        while literal:
+            await conn.reader.readexactly(literal[0])
+            line = await conn.reader.readline()
+            literal = literal_size(line)
+        if not line:
+            raise ConnectionResetError('Connection closed by the server')
+        return first
+
+    async def refresh(self):
+        """ Send the updates of the mailbox to the idling connections """
+        for connection in self.hub.subscribers(self):
+            await connection.refresh()
+
+class AsyncIMAPReader:
+
+    r""" Incremental reader of IMAP commands or responses over an asyncio stream.
+
+    Instantiate with: AsyncIMAPReader(reader[, client])
+
+            reader - asyncio.StreamReader of the peer
+            client - True if the peer is a client (default: False)
+
+    Same messages as framing.IMAPReader, except that the literals are returned as bytes.
+    """
+
+    def __init__(self, reader, client=False):
+        self.reader = reader
+        self.client = client
+
+    async def read_message(self):
+        """ Return (parts, literal) for the next message """
+        return await self.read_parts([])
+
+    async def read_continuation(self, size):
+        """ Return (parts, literal) for the synchronizing literal of the given size
+        and the rest of the message, once the server accepted it """
+        return await self.read_parts([await self.read_literal(size)])
+
+    async def read_rest(self):
+        """ Return (parts, literal) for the rest of the message after a synchronizing literal
+        streamed with read_chunks """
+        return await self.read_parts([])
+
+    async def read_parts(self, parts):
+        """ Read lines and literals until a line announces no literal """
+
+        while True:
+            line = await self.read_line()
+            parts.append(line)
+
+            literal = literal_size(line)
+            if not literal:
+                return parts, None
+
+            size, synchronizing = literal
+            if self.client and synchronizing:
+                return parts, size
+
+            parts.append(await self.read_literal(size))
+
+    async def read_line(self):
+        """ Return the next line with its CRLF """
+
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed by the peer')
+
+        return line
+
+    async def read_literal(self, size):
+        """ Return the next size bytes """
+        return await self.reader.readexactly(size)
+
+    async def read_chunks(self, size):
+        """ Yield the next size bytes in chunks of at most CHUNK_SIZE bytes """
+
+        while size > 0:
+            chunk = await self.reader.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionResetError('Connection closed by the peer')
+            size -= len(chunk)
+            yield chunk
+
+class AsyncConnection(BaseConnection):
+
+    r""" Connection with a client served as a coroutine of the event loop.
+
+    Instantiate with: AsyncConnection(reader, writer, key[, tracer[, pool[, tls[, idle[, compress]]]]]])
+
+            reader - streams.StreamReader of the client
+            writer - asyncio.StreamWriter of the client
+            key - Key used to verify the integrity of emails append by the proxy
+            tracer - Tracer of the IMAP payload (default: None, no trace)
+            pool - SessionPool providing the upstream session (default: None, a new session is opened)
+            tls - ServerContext offered to the client with STARTTLS (default: None, no STARTTLS)
+            idle - IdleHub of the upstream IDLEs (default: None, IDLE is transmitted to the server)
+            compress - Legs compressed with COMPRESS=DEFLATE: 'client' and/or 'server' (default: ())
+
+    Same behaviour as Connection (see BaseConnection), until serve() returns. The modules are
+    run in the default executor of the loop and the pool in POOL_EXECUTOR.
+    """
+
+    WATCHER = AsyncWatcher
+
+    def __init__(self, reader, writer, key, tracer = None, pool = None, tls = None, idle = None, compress = ()):
+        BaseConnection.__init__(self, key, tracer, pool, tls, idle, compress)
+        self.loop = asyncio.get_event_loop()
+        self.client_stream = reader
+        self.client_writer = writer
+        self.client_reader = AsyncIMAPReader(reader, client=True)
+        self.server_writer = None
+        self.idle_lock = asyncio.Lock() # Held while the idling client is refreshed
+
+    async def close_idle(self):
+        """ Close the connection with a BYE response, unless a command is running """
+        if self.in_command or self.pending or self.closing:
+            return
+        self.closing = True
+        async with self.idle_lock: # Not during a refresh
+            if self.client_writer.is_closing(): # Client already gone
+                return
+            try:
+                await self.send_to_client('* BYE Server shutting down')
+            except OSError:
+                pass
+            self.client_writer.close() # The listening coroutine stops on the end of the stream
+
+    def close(self):
+        """ Abort the connection with the client, even during a command """
+        self.closing = True
+        self.client_writer.transport.abort()
+
+    def close_client(self):
+        """ Close the connection with the client once it is not listened anymore,
+        and the one with the server unless it is kept in the pool """
+        self.client_writer.close()
+        if self.server_writer and not self.session:
+            self.server_writer.close()
+
+    async def refresh(self):
+        """ Send the updates of the selected mailbox to the idling client (called by the AsyncWatcher of the mailbox) """
+        async with self.idle_lock:
+            await self.send_updates()
+
+    async def stop_idling(self):
+        """ Stop the refreshes of the client, once the one running is over """
+        async with self.idle_lock:
+            self.idling = False
+
+    async def release_server(self):
+        """ Give the upstream session back to the pool, unless a command was interrupted """
+        if not self.session:
+            return
+        if self.in_command or self.pending:
+            await self.loop.run_in_executor(POOL_EXECUTOR, self.pool.discard, self.session)
+        else:
+            await self.loop.run_in_executor(POOL_EXECUTOR, self.pool.release, self.session, self.current_folder is not None)
+        self.server_writer = None
+        self.session = None
+
+    async def open_session(self, hostname, username, password):
+        """ Open the upstream session of the account, or take it from the pool """
+
+        if self.pool:
+            self.session = await acquire_session(self.pool, hostname, username, password, self.login_server)
+            self.conn_server = self.session.conn
+            self.background_session = functools.partial(self.pool.acquire, hostname, username, password, self.login_server)
+            self.acquire_session = functools.partial(acquire_session, self.pool, hostname, username, password, self.login_server)
+        else:
+            self.conn_server = await self.loop.run_in_executor(None,
+                self.login_server, hostname, username, password)
+        self.server_writer = self.conn_server.writer
+        self.server_reader = AsyncIMAPReader(self.conn_server.reader)
+
+    def login_server(self, hostname, username, password):
+        """ Return a new AsyncIMAP4 authenticated on the server (called out of the event loop) """
+
+        host, port = split_hostname(hostname)
+        reader, writer = asyncio.run_coroutine_threadsafe(open_connection(host, port, ssl=client_context()),
+            self.loop).result()
+        conn_server = AsyncIMAP4(self.loop, reader, writer, host)
+        try:
+            conn_server.login(username, password)
+        except imaplib.IMAP4.error:
+            conn_server.shutdown()
+            raise
+        refresh_capabilities(conn_server)
+        if 'server' in self.compression and negotiate(conn_server):
+            conn_server.compress()
+        return conn_server
+
+    async def start_client_tls(self):
+        """ Start SSL/TLS on the connection with the client (see starttls) """
+        if self.client_stream.size: # Plain text sent after STARTTLS would be read as protected
+            raise ValueError('Error while starting SSL/TLS with the client: data received before the handshake')
+        self.client_stream, self.client_writer = await start_tls(self.client_stream, self.client_writer,
+            self.tls.context())
+        self.client_reader = AsyncIMAPReader(self.client_stream, client=True)
+
+    async def compress_client(self):
+        """ Decompress the next requests of the client and compress the next responses (see compress) """
+        await self.client_stream.inflate(metrics.CLIENT_IN)
+        self.client_writer = DeflatingWriter(self.client_writer, metrics.CLIENT_OUT)
+
+    async def run_blocking(self, function, *args):
+        """ Return function(*args), called in the default executor of the loop """
+        return await self.loop.run_in_executor(None, function, *args)
+
+    def client_ready(self):
+        """ Return True if the client already sent (a part of) its next request """
+        return self.client_stream.size > 0
+
+    def write_client(self, data):
+        """ Write data to the client, sent by drain_client """
+        self.client_writer.write(data)
+
+    async def drain_client(self):
+        """ Wait until the data written to the client can be sent """
+        await self.client_writer.drain()
+
+    def write_server(self, data):
+        """ Write data to the server, sent by drain_server """
+        self.server_writer.write(data)
+
+    async def drain_server(self):
+        """ Wait until the data written to the server can be sent """
+        await self.server_writer.drain()
@@ -0,0 +1,3 @@
+"""
+    Benchmark harness: stand-in IMAP and SMTP servers and a load generator
+"""
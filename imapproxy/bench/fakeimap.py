@@ -0,0 +1,482 @@
+"""
+    Stand-in IMAP4rev1 server: every account gets a generated INBOX, no real server is needed
+"""
+
+import socketserver, socket, ssl, threading, time, re, bisect, os, io, subprocess
+from array import array
+from ..framing import IMAPReader, received
+from ..helpers import SequenceSet
+from ..compress import DeflatingIO, inflating_file
+from .. import metrics
+
+# Capabilities of the server (after the login)
+CAPABILITIES = 'IMAP4rev1 LITERAL+ UIDPLUS MOVE UNSELECT IDLE COMPRESS=DEFLATE'
+
+# Default number of emails in the INBOX of every account
+MESSAGES = 1000
+
+# Default size (in bytes) of these emails
+MESSAGE_SIZE = 10 * 1024
+
+# UIDVALIDITY of all the mailboxes
+UIDVALIDITY = 1
+
+# Command of a client: tag, optional UID prefix, name and arguments
+Command = re.compile(rb'(?P<tag>[^ \r\n]+) (?P<uid>UID )?(?P<name>[A-Z]+) ?(?P<args>[^\r\n]*)', flags=re.IGNORECASE)
+
+# Items of a FETCH: sections of BODY are kept whole
+Fetch_Item = re.compile(r'BODY(\.PEEK)?\[[^\]]*\](<[0-9.]+>)?|[A-Z0-9.]+', flags=re.IGNORECASE)
+
+# Mailbox name, quoted or not
+Mailbox_Name = re.compile(r'"(?P<quoted>[^"]*)"|(?P<atom>[^ ]+)')
+
+def make_email(size, headers=()):
+    """ Return a raw email (in bytes) of about size bytes
+
+        headers - additional (name, value) header fields
+    """
+
+    head = b'From: bench@example.com\r\nTo: user@example.com\r\nSubject: Benchmark\r\n'
+    head += b'Date: Mon, 1 Jan 2018 00:00:00 +0000\r\nMessage-ID: <bench@example.com>\r\n'
+    head += b''.join(name.encode() + b': ' + value.encode() + b'\r\n' for name, value in headers)
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n'
+    return head + b'\r\n' + line * max(1, (size - len(head)) // len(line))
+
+def make_certificate(path):
+    """ Write a self-signed certificate and its key in the PEM file path (needs the openssl command) """
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-keyout', path, '-out', path + '.crt'],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(path, 'ab') as key, open(path + '.crt', 'rb') as cert:
+        key.write(cert.read())
+    os.remove(path + '.crt')
+    return path
+
+class Mailbox:
+
+    r""" Mailbox of the stand-in server.
+
+    Instantiate with: Mailbox([messages[, message]])
+
+            messages - Number of generated emails (default: 0)
+            message - Raw email returned for every generated email (default: b'')
+
+    The generated emails share one raw email, so big mailboxes cost a few bytes per email.
+    Only flags and appended emails are stored.
+    """
+
+    def __init__(self, messages=0, message=b''):
+        self.uids = array('L', range(1, messages + 1))
+        self.uidnext = messages + 1
+        self.message = message
+        self.flags = {} # uid -> set of flags
+        self.bodies = {} # uid -> raw email of the appended emails
+        self.sessions = set() # sessions with the mailbox selected
+
+    def body(self, uid):
+        return self.bodies.get(uid, self.message)
+
+    def add(self, body=None, flags=()):
+        """ Add an email and return its uid """
+        uid = self.uidnext
+        self.uidnext += 1
+        self.uids.append(uid)
+        if body is not None:
+            self.bodies[uid] = body
+        if flags:
+            self.flags[uid] = set(flags)
+        return uid
+
+    def find(self, str_ids, uid):
+        """ Return the [(sequence number, uid)] of the ids of a command """
+
+        if not self.uids:
+            return []
+
+        found = []
+        if uid:
+            ids = SequenceSet.parse(str_ids).resolve(self.uids[-1])
+            for (start, end) in ids.ranges():
+                i = bisect.bisect_left(self.uids, start)
+                while i < len(self.uids) and self.uids[i] <= end:
+                    found.append((i + 1, self.uids[i]))
+                    i += 1
+        else:
+            ids = SequenceSet.parse(str_ids).resolve(len(self.uids))
+            for (start, end) in ids.ranges():
+                found += ((seq, self.uids[seq - 1]) for seq in range(start, min(end, len(self.uids)) + 1))
+
+        return found
+
+    def remove(self, uids):
+        """ Remove the emails and return their sequence numbers, in the order of the EXPUNGE responses """
+
+        expunged = []
+        for uid in sorted(uids, reverse=True):
+            i = bisect.bisect_left(self.uids, uid)
+            if i < len(self.uids) and self.uids[i] == uid:
+                del self.uids[i]
+                self.flags.pop(uid, None)
+                self.bodies.pop(uid, None)
+                expunged.append(i + 1)
+        return expunged
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+
+    r""" Stand-in IMAP4rev1 server accepting any login, one thread per client.
+
+    Instantiate with: FakeIMAPServer([port[, certfile[, latency[, messages[, message_size[, keep_appends[, message_headers]]]]]]])
+
+            port - Port number (default: 0, any free port, see port)
+            certfile - PEM file with the certificate and its key, the connections use SSL/TLS
+                if given (default: None)
+            latency - Delay (in seconds) before the completion of every command, as a round trip to
+                a distant server: the commands pipelined by the client are not delayed again (default: 0)
+            messages - Number of emails in the INBOX of every account (default: MESSAGES)
+            message_size - Size (in bytes) of these emails (default: MESSAGE_SIZE)
+            keep_appends - Keep the content of the appended emails (default: True). Without it,
+                appended emails read as the generated email and big APPENDs don't fill the memory
+            message_headers - Additional (name, value) header fields of the generated email (default: ())
+
+    Supported commands: CAPABILITY, LOGIN, SELECT, EXAMINE, STATUS, LIST, CREATE, FETCH, STORE,
+    COPY, MOVE, EXPUNGE (with or without UID), APPEND, NOOP, IDLE, UNSELECT, CLOSE and LOGOUT.
+    The EXISTS and EXPUNGE responses of the changes made by the other sessions are sent at once
+    to the sessions in IDLE, and on NOOP to the others.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, certfile=None, latency=0, messages=MESSAGES, message_size=MESSAGE_SIZE,
+            keep_appends=True, message_headers=()):
+        self.latency = latency
+        self.messages = messages
+        self.message = make_email(message_size, message_headers)
+        self.keep_appends = keep_appends
+        self.accounts = {} # username -> {name: Mailbox}
+        self.lock = threading.Lock()
+        self.commands = 0
+
+        self.context = None
+        if certfile:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(certfile)
+
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), IMAPHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """ Serve in a background thread and return the port """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.port
+
+    def mailboxes(self, username):
+        """ Return the mailboxes of the account, created on its first login """
+        with self.lock:
+            if username not in self.accounts:
+                self.accounts[username] = {'INBOX': Mailbox(self.messages, self.message)}
+            return self.accounts[username]
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+
+    r""" Connection of a client with the stand-in server """
+
+    wbufsize = 64 * 1024 # Responses are flushed on completion
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # As real servers
+        if self.server.context:
+            self.request = self.server.context.wrap_socket(self.request, server_side=True)
+        socketserver.StreamRequestHandler.setup(self)
+        self.reader = IMAPReader(self.rfile, client=True)
+        self.mailboxes = None
+        self.selected = None
+        self.exists = 0 # Number of emails of the selected mailbox known by the client
+        self.expunged = [] # EXPUNGE responses of the changes made by the other sessions, not sent yet
+        self.idling = False
+
+    def handle(self):
+        try:
+            self.send(b'* OK [CAPABILITY ' + CAPABILITIES.encode() + b'] Stand-in server ready')
+            self.wfile.flush()
+            while self.serve_command():
+                pass
+        except (ConnectionError, ssl.SSLError, ValueError):
+            pass
+        finally:
+            self.select(None)
+
+    def serve_command(self):
+        """ Answer one command, return False after LOGOUT """
+
+        # Received before the completion of the previous command: no other round trip
+        self.delayed = self.server.latency and not received(self.request, self.rfile)
+        parts, literal = self.reader.read_message()
+        while literal is not None:
+            # Synchronizing literal: the client waits for a continuation
+            self.send(b'+ Ready')
+            self.wfile.flush()
+            more, literal = self.reader.read_continuation(literal)
+            parts += more
+
+        match = Command.match(parts[0])
+        if not match:
+            self.send(b'* BAD Invalid command')
+            return True
+
+        tag = match.group('tag')
+        name = match.group('name').decode().upper()
+        args = match.group('args').decode('utf-8', 'replace')
+        uid = bool(match.group('uid'))
+        self.server.commands += 1
+
+        if name == 'LOGOUT':
+            self.send(b'* BYE Logging out')
+            self.complete(tag, 'OK', name)
+            return False
+
+        if name == 'COMPRESS' and self.mailboxes is not None and args.upper() == 'DEFLATE' \
+                and not isinstance(self.wfile.raw, DeflatingIO):
+            self.complete(tag, 'OK', name)
+            self.compress()
+            return True
+
+        handler = getattr(self, 'do_' + name.lower(), None)
+        if not handler or (self.mailboxes is None and name not in ('CAPABILITY', 'LOGIN', 'NOOP')):
+            self.complete(tag, 'BAD', name)
+            return True
+
+        try:
+            status = handler(args, uid, parts) or 'OK'
+        except (IndexError, KeyError, ValueError, AttributeError):
+            status = 'BAD'
+        self.complete(tag, status, ('UID ' if uid else '') + name)
+        return True
+
+    def send(self, line):
+        self.wfile.write(line + b'\r\n')
+
+    def complete(self, tag, status, name):
+        if self.delayed:
+            time.sleep(self.server.latency)
+        self.wfile.write(tag + b' ' + status.encode() + b' ' + name.encode() + b' completed\r\n')
+        self.wfile.flush()
+
+    def compress(self):
+        """ Compress the connection from now on (after the completion of COMPRESS DEFLATE) """
+        with self.server.lock: # Not while another session sends updates
+            self.rfile = inflating_file(self.request, self.rfile, metrics.CLIENT_IN)
+            self.reader = IMAPReader(self.rfile, client=True)
+            self.wfile = io.BufferedWriter(DeflatingIO(self.request, metrics.CLIENT_OUT), self.wbufsize)
+
+    def notify(self, mailbox, expunged=()):
+        """ Report the changes of the mailbox to the other sessions (with the lock of the server) """
+        for handler in mailbox.sessions:
+            if handler is not self:
+                handler.expunged += expunged
+                if handler.idling:
+                    handler.send_updates()
+
+    def send_updates(self):
+        """ Send the EXPUNGE and EXISTS responses of the changes not reported yet """
+        lines = [b'* %d EXPUNGE' % seq for seq in self.expunged]
+        self.exists -= len(self.expunged)
+        self.expunged = []
+        if self.selected and len(self.selected.uids) != self.exists:
+            self.exists = len(self.selected.uids)
+            lines.append(b'* %d EXISTS' % self.exists)
+        if lines:
+            self.wfile.write(b''.join(line + b'\r\n' for line in lines))
+        if self.idling:
+            try:
+                self.wfile.flush()
+            except OSError:
+                pass
+
+    def select(self, mailbox):
+        """ Select the mailbox (None to unselect) """
+        with self.server.lock:
+            if self.selected:
+                self.selected.sessions.discard(self)
+            self.selected = mailbox
+            self.expunged = []
+            if mailbox:
+                mailbox.sessions.add(self)
+                self.exists = len(mailbox.uids)
+
+    def mailbox(self, name, create=True):
+        """ Return the mailbox of the account with the given name (created if needed) """
+        match = Mailbox_Name.match(name)
+        name = match.group('quoted') if match.group('quoted') is not None else match.group('atom')
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        if name not in self.mailboxes and create:
+            self.mailboxes[name] = Mailbox()
+        return self.mailboxes.get(name), name
+
+    #       Commands
+
+    def do_capability(self, args, uid, parts):
+        self.send(b'* CAPABILITY ' + CAPABILITIES.encode())
+
+    def do_noop(self, args, uid, parts):
+        with self.server.lock:
+            self.send_updates()
+
+    def do_login(self, args, uid, parts):
+        username = args.split(' ')[0].strip('"')
+        self.mailboxes = self.server.mailboxes(username)
+
+    def do_select(self, args, uid, parts):
+        mailbox, name = self.mailbox(args)
+        self.select(mailbox)
+        self.send(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send(b'* %d EXISTS' % self.exists)
+        self.send(b'* 0 RECENT')
+        self.send(b'* OK [UIDVALIDITY %d] UIDs valid' % UIDVALIDITY)
+        self.send(b'* OK [UIDNEXT %d] Predicted next UID' % mailbox.uidnext)
+
+    do_examine = do_select
+
+    def do_unselect(self, args, uid, parts):
+        self.select(None)
+
+    do_close = do_unselect
+
+    def do_status(self, args, uid, parts):
+        name, items = args.split(' (')
+        mailbox, name = self.mailbox(name)
+        values = {'MESSAGES': len(mailbox.uids), 'UIDNEXT': mailbox.uidnext, 'UIDVALIDITY': UIDVALIDITY, 'UNSEEN': 0, 'RECENT': 0}
+        status = ' '.join('%s %d' % (item, values[item]) for item in items.rstrip(')').upper().split())
+        self.send(('* STATUS "%s" (%s)' % (name, status)).encode())
+
+    def do_list(self, args, uid, parts):
+        for name in self.mailboxes:
+            self.send(('* LIST () "/" "%s"' % name).encode())
+
+    def do_create(self, args, uid, parts):
+        self.mailbox(args)
+
+    def do_fetch(self, args, uid, parts):
+        str_ids, items = args.split(' ', 1)
+        items = [match.group(0).upper() for match in Fetch_Item.finditer(items)]
+        if uid and 'UID' not in items:
+            items.insert(0, 'UID')
+
+        mailbox = self.selected
+        for seq, message_uid in mailbox.find(str_ids, uid):
+            body = mailbox.body(message_uid)
+            data = []
+            for item in items:
+                if item == 'UID':
+                    data.append(b'UID %d' % message_uid)
+                elif item == 'FLAGS':
+                    data.append(b'FLAGS (' + ' '.join(sorted(mailbox.flags.get(message_uid, ()))).encode() + b')')
+                elif item == 'RFC822.SIZE':
+                    data.append(b'RFC822.SIZE %d' % len(body))
+                elif item == 'INTERNALDATE':
+                    data.append(b'INTERNALDATE "01-Jan-2018 00:00:00 +0000"')
+                elif item.startswith('BODY') or item.startswith('RFC822'):
+                    section, content = self.section(item, body)
+                    data.append(section + b' {%d}\r\n' % len(content) + content)
+            self.wfile.write(b'* %d FETCH (' % seq + b' '.join(data) + b')\r\n')
+
+    def section(self, item, body):
+        """ Return (name, content) of a section of the email for a FETCH item """
+
+        name = item.replace('.PEEK', '').split('<')[0]
+        if name in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+            item = {'RFC822': 'BODY[]', 'RFC822.HEADER': 'BODY[HEADER]', 'RFC822.TEXT': 'BODY[TEXT]'}[name]
+        spec = item[item.index('[') + 1:item.index(']')]
+        header, sep, text = body.partition(b'\r\n\r\n')
+
+        if spec == '':
+            content = body
+        elif spec == 'HEADER':
+            content = header + b'\r\n\r\n'
+        elif spec == 'TEXT':
+            content = text
+        elif spec.startswith('HEADER.FIELDS'):
+            fields = spec[spec.index('(') + 1:spec.index(')')].split()
+            content = b''.join(line + b'\r\n' for line in header.split(b'\r\n')
+                if line.split(b':')[0].decode('utf-8', 'replace').upper() in fields) + b'\r\n'
+        else:
+            content = b''
+
+        return name.encode(), content
+
+    def do_store(self, args, uid, parts):
+        str_ids, action, flags = args.split(' ', 2)
+        flags = set(flags.strip('()').split())
+        mailbox = self.selected
+        for seq, message_uid in mailbox.find(str_ids, uid):
+            current = mailbox.flags.setdefault(message_uid, set())
+            if action.upper().startswith('+'):
+                current |= flags
+            elif action.upper().startswith('-'):
+                current -= flags
+            else:
+                current.clear()
+                current |= flags
+            if not action.upper().endswith('.SILENT'):
+                self.send(b'* %d FETCH (FLAGS (' % seq + ' '.join(sorted(current)).encode() + b'))')
+
+    def do_copy(self, args, uid, parts, move=False):
+        str_ids, name = args.split(' ', 1)
+        source = self.selected
+        destination, name = self.mailbox(name)
+        with self.server.lock:
+            found = source.find(str_ids, uid)
+            copies = [destination.add(source.bodies.get(message_uid), source.flags.get(message_uid, ()))
+                for seq, message_uid in found]
+            if move:
+                expunged = source.remove([message_uid for seq, message_uid in found])
+                self.exists = len(source.uids)
+                self.notify(source, expunged)
+            self.notify(destination)
+        if found:
+            self.send(('* OK [COPYUID %d %s %s] Done' % (UIDVALIDITY,
+                SequenceSet.from_ids(message_uid for seq, message_uid in found),
+                SequenceSet.from_ids(copies))).encode())
+        if move:
+            for seq in expunged:
+                self.send(b'* %d EXPUNGE' % seq)
+
+    def do_move(self, args, uid, parts):
+        self.do_copy(args, uid, parts, move=True)
+
+    def do_expunge(self, args, uid, parts):
+        mailbox = self.selected
+        deleted = [message_uid for message_uid, flags in mailbox.flags.items() if '\\Deleted' in flags]
+        if uid:
+            ids = SequenceSet.parse(args)
+            deleted = [message_uid for message_uid in deleted if message_uid in ids]
+        with self.server.lock:
+            expunged = mailbox.remove(deleted)
+            self.exists = len(mailbox.uids)
+            self.notify(mailbox, expunged)
+        for seq in expunged:
+            self.send(b'* %d EXPUNGE' % seq)
+
+    def do_append(self, args, uid, parts):
+        mailbox, name = self.mailbox(args)
+        content = bytes(parts[1])
+        with self.server.lock:
+            message_uid = mailbox.add(content if self.server.keep_appends else None)
+            self.notify(mailbox)
+        return 'OK [APPENDUID %d %d]' % (UIDVALIDITY, message_uid)
+
+    def do_idle(self, args, uid, parts):
+        self.send(b'+ idling')
+        with self.server.lock:
+            self.idling = True
+            self.send_updates()
+        try:
+            self.reader.read_line() # DONE
+        finally:
+            with self.server.lock:
+                self.idling = False
@@ -0,0 +1,74 @@
+"""
+    Stand-in SMTP server: a sink counting the emails forwarded to MISP
+"""
+
+import socketserver, threading, time
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+
+    r""" SMTP sink accepting every email, one thread per client.
+
+    Instantiate with: FakeSMTPServer([port])
+
+            port - Port number (default: 0, any free port, see port)
+
+    The emails are dropped: only their number, their size and the time of the last one are kept.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        self.received = 0
+        self.bytes = 0
+        self.last = None
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), SMTPHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """ Serve in a background thread and return the port """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.port
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    r""" Connection of a client with the SMTP sink """
+
+    def handle(self):
+        self.reply(b'220 Stand-in SMTP server ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            verb = line[:4].upper()
+            if verb == b'DATA':
+                self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+                self.read_data()
+                self.reply(b'250 Queued')
+            elif verb == b'QUIT':
+                self.reply(b'221 Bye')
+                return
+            elif verb == b'EHLO':
+                self.reply(b'250-localhost\r\n250 8BITMIME')
+            else: # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply(b'250 OK')
+
+    def read_data(self):
+        size = 0
+        for line in self.rfile:
+            if line == b'.\r\n':
+                break
+            size += len(line)
+
+        with self.server.lock:
+            self.server.received += 1
+            self.server.bytes += size
+            self.server.last = time.monotonic()
+
+    def reply(self, line):
+        self.wfile.write(line + b'\r\n')
@@ -0,0 +1,188 @@
+"""
+    Benchmark harness: run a scenario of the load generator against the proxy and stand-in servers
+"""
+
+import os, sys, ssl, time, socket, asyncio, tempfile, multiprocessing
+
+from .fakeimap import FakeIMAPServer, make_certificate
+from .fakesmtp import FakeSMTPServer
+from .load import Stats, SCENARIOS
+
+# Header of the generated emails, so the proxy doesn't sanitize them (see --unsanitized)
+SANITIZED_HEADER = ('X-CIRCL-Sanitizer', 'Sanitized')
+
+# Maximum time (in seconds) to wait for the proxy to listen and for the MISP queue to be sent
+START_TIMEOUT = 10
+DRAIN_TIMEOUT = 30
+
+# Interval (in seconds) between two samples of the memory of the proxy
+SAMPLE_INTERVAL = 0.1
+
+class Target:
+
+    r""" Address of the proxy for the load generator.
+
+    Instantiate with: Target(host, port[, context[, compress]])
+
+            context - SSLContext if the proxy uses SSL/TLS (default: None)
+            compress - The clients send COMPRESS DEFLATE after the login (default: False)
+    """
+
+    def __init__(self, host, port, context=None, compress=False):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.compress = compress
+
+def rss(pid):
+    """ Return the resident memory (in bytes) of the process, or None if unknown (Linux only) """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+def free_port():
+    """ Return a TCP port which is free at the moment """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve_standins(conn, certfile, latency, messages, message_size, sanitized):
+    """ Run the stand-in IMAP and SMTP servers (in their own process) and answer the
+    requests of the harness on conn: 'smtp' returns (emails received, time of the last one) """
+
+    headers = (SANITIZED_HEADER,) if sanitized else ()
+    imap = FakeIMAPServer(0, certfile, latency, messages, message_size, keep_appends=False, message_headers=headers)
+    smtp = FakeSMTPServer()
+    conn.send((imap.start(), smtp.start()))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request == 'smtp':
+            conn.send((smtp.received, smtp.last))
+
+def serve_proxy(engine, port, imap_port, smtp_port, queue_path, certfile, max_sessions, metrics_port, compress, output):
+    """ Run the proxy (in its own process) with the stand-in servers as upstream servers """
+
+    if not output:
+        sys.stdout = open(os.devnull, 'w')
+
+    from ..proxy import IMAP_Proxy, HOSTS
+    from .. import misp, pycircleanmail
+    from .load import DOMAIN
+
+    HOSTS[DOMAIN.split('.')[0]] = '127.0.0.1:%d' % imap_port
+    misp.configure(queue_path, '127.0.0.1:%d' % smtp_port)
+    pycircleanmail.configure() # Worker processes started before the run
+    IMAP_Proxy(port=port, certfile=certfile, max_client=1024, engine=engine, max_sessions=max_sessions,
+        metrics_port=metrics_port, compress=compress)
+
+def wait_listening(port, process, context=None):
+    """ Wait until the process listens on the port (and completes a handshake with the context) """
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline and process.is_alive():
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+            if context:
+                sock = context.wrap_socket(sock)
+            sock.close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('The proxy did not start')
+
+async def drive(scenario, target, options, pid):
+    """ Run the scenario while sampling the memory of the proxy.
+    Return (stats, number of connections, peak RSS in bytes) """
+
+    stats = Stats()
+    peak = [rss(pid)]
+
+    async def sample():
+        while True:
+            peak[0] = max(peak[0] or 0, rss(pid) or 0)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    sampler = asyncio.ensure_future(sample())
+    try:
+        connections = await scenario(target, options, stats)
+    finally:
+        sampler.cancel()
+
+    return stats, connections, peak[0]
+
+def run(engine, name, options):
+    """ Run the scenario of the given name against a proxy using the given engine.
+    Return a dict of results (see Stats.report) with rss_per_connection, forwarded (MISP)
+    and handshakes_s (handshake) """
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile = make_certificate(os.path.join(tmp, 'cert.pem'))
+
+        conn, child_conn = context.Pipe()
+        standins = context.Process(target=serve_standins, daemon=True, args=(child_conn, certfile,
+            options.latency, max(options.messages, options.fetch, options.requests), options.message_size,
+            not options.unsanitized))
+        standins.start()
+        imap_port, smtp_port = conn.recv()
+
+        port = free_port()
+        legs = [leg for leg in options.compress.split(',') if leg]
+        # Not a daemon: the proxy starts its own worker processes
+        proxy = context.Process(target=serve_proxy, args=(engine, port, imap_port, smtp_port,
+            os.path.join(tmp, 'misp_queue'), certfile if options.tls else None, options.sessions,
+            free_port() if options.metrics else None, legs, options.verbose))
+        proxy.start()
+
+        try:
+            client_context = None
+            if options.tls:
+                client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                client_context.check_hostname = False
+                client_context.verify_mode = ssl.CERT_NONE
+            wait_listening(port, proxy, client_context)
+
+            baseline = rss(proxy.pid)
+            loop = asyncio.new_event_loop()
+            stats, connections, peak = loop.run_until_complete(drive(SCENARIOS[name],
+                Target('127.0.0.1', port, client_context, 'client' in legs), options, proxy.pid))
+            loop.close()
+
+            results = stats.report()
+            results['connections'] = connections
+            results['rss_per_connection'] = (peak - baseline) / connections if peak and baseline else None
+
+            if name == 'misp':
+                results.update(wait_forwarded(conn, connections * options.requests))
+            if name == 'handshake':
+                results['handshakes_s'] = results['commands_s']
+                results['resumed'] = stats.resumed / max(1, results['commands'])
+
+            return results
+        finally:
+            proxy.terminate()
+            proxy.join()
+            conn.close()
+            standins.join()
+
+def wait_forwarded(conn, expected):
+    """ Wait until the SMTP sink received the expected emails.
+    Return forwarded (emails received) and misp_drain_s (time between the end of the run and the last email) """
+
+    end = time.monotonic()
+    received, last = 0, None
+    while time.monotonic() < end + DRAIN_TIMEOUT:
+        conn.send('smtp')
+        received, last = conn.recv()
+        if received >= expected:
+            break
+        time.sleep(0.1)
+
+    return {'forwarded': received, 'misp_drain_s': max(0, last - end) if last else None}
@@ -0,0 +1,317 @@
+"""
+    Load generator: many IMAP clients driven by one event loop, and the benchmark scenarios
+"""
+
+import asyncio, time, socket
+from concurrent.futures import ThreadPoolExecutor
+
+from ..framing import CHUNK_SIZE, literal_size
+from ..compress import DeflatingWriter
+from ..streams import open_connection
+from .. import metrics
+
+# Domain of the accounts of the clients (mapped to the stand-in server by the harness)
+DOMAIN = 'bench.com'
+
+# Maximum number of clients connecting at the same time
+CONNECT_CONCURRENCY = 100
+
+class Stats:
+
+    r""" Latencies and traffic of the commands of a run.
+
+    Instantiate with: Stats()
+
+    Only the commands sent between begin() and finish() are measured: the clients log in
+    and out with other Stats.
+    """
+
+    def __init__(self):
+        self.latencies = [] # in seconds
+        self.bytes = 0 # sent and received by the clients
+        self.wire_bytes = 0 # sent and received on the wire by the compressed clients
+        self.errors = 0
+        self.resumed = 0 # SSL/TLS sessions resumed
+        self.start = self.end = None
+
+    def begin(self):
+        self.start = time.perf_counter()
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def percentile(self, p):
+        """ Return the latency (in seconds) below which p percent of the commands completed """
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def report(self):
+        """ Return the results of the run """
+        elapsed = (self.end or time.perf_counter()) - self.start
+        return {'commands': len(self.latencies), 'commands_s': len(self.latencies) / elapsed,
+            'p50_ms': self.percentile(50) * 1000, 'p99_ms': self.percentile(99) * 1000,
+            'bytes_s': self.bytes / elapsed, 'errors': self.errors, 'elapsed': elapsed,
+            'compression': self.wire_bytes / self.bytes if self.wire_bytes and self.bytes else None}
+
+class Client:
+
+    r""" IMAP client recording the latency of its commands.
+
+    Instantiate with: Client(stats)
+
+            stats - Stats of the run
+
+    Literals of the responses are read chunk by chunk and dropped.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.reader = self.writer = None
+        self.tags = 0
+        self.inflater = None # Compressed connection (see compress)
+        self.wire_start = 0
+
+    def wire_bytes(self):
+        """ Return the bytes sent and received on the wire since COMPRESS """
+        return self.inflater.size + self.writer.deflater.size if self.inflater else 0
+
+    async def compress(self):
+        """ Compress the connection with COMPRESS DEFLATE """
+        if await self.command('COMPRESS DEFLATE') == 'OK':
+            self.inflater = await self.reader.inflate(metrics.CLIENT_IN)
+            self.writer = DeflatingWriter(self.writer, metrics.CLIENT_OUT)
+
+    async def connect(self, host, port, context=None):
+        """ Open the connection and read the greeting """
+        self.reader, self.writer = await open_connection(host, port, ssl=context)
+        await self.reader.readline()
+
+    async def command(self, command, literal=None):
+        """ Send a command and return the status of its completion ('OK', 'NO' or 'BAD')
+
+            command - Command without tag and CRLF
+            literal - Bytes sent as a synchronizing literal at the end of the command (default: None)
+        """
+
+        self.tags += 1
+        tag = b'C%d' % self.tags
+        line = tag + b' ' + command.encode()
+        if literal is not None:
+            line += b' {%d}' % len(literal)
+
+        start = time.perf_counter()
+        self.writer.write(line + b'\r\n')
+        self.stats.bytes += len(line) + 2
+        if literal is not None:
+            await self.writer.drain()
+            continuation = await self.read_line()
+            if not continuation.startswith(b'+'):
+                self.stats.errors += 1
+                return continuation.split(b' ')[1].decode()
+            self.writer.write(literal)
+            self.writer.write(b'\r\n')
+            self.stats.bytes += len(literal) + 2
+        await self.writer.drain()
+
+        status = await self.read_response(tag)
+        self.stats.latencies.append(time.perf_counter() - start)
+        if status != 'OK':
+            self.stats.errors += 1
+        return status
+
+    async def pipeline(self, commands):
+        """ Send the commands (without tag and CRLF) at once and wait for their completions """
+
+        tags = []
+        lines = []
+        for command in commands:
+            self.tags += 1
+            tags.append(b'C%d' % self.tags)
+            lines.append(tags[-1] + b' ' + command.encode() + b'\r\n')
+
+        start = time.perf_counter()
+        self.writer.write(b''.join(lines))
+        await self.writer.drain()
+        self.stats.bytes += sum(len(line) for line in lines)
+        for tag in tags: # Completed in order
+            status = await self.read_response(tag)
+            self.stats.latencies.append(time.perf_counter() - start)
+            if status != 'OK':
+                self.stats.errors += 1
+
+    async def read_response(self, tag):
+        """ Read the responses until the completion of the command with the given tag """
+
+        prefix = tag + b' '
+        while True:
+            line = await self.read_line()
+            if line.startswith(prefix):
+                return line[len(prefix):].split(b' ')[0].decode()
+
+            literal = literal_size(line)
+            while literal:
+                size = literal[0]
+                while size > 0:
+                    size -= len(await self.reader.readexactly(min(size, CHUNK_SIZE)))
+                self.stats.bytes += literal[0]
+                literal = literal_size(await self.read_line())
+
+    async def read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed by the proxy')
+        self.stats.bytes += len(line)
+        return line
+
+    async def close(self):
+        self.writer.close()
+
+async def open_clients(count, target, stats, select='INBOX'):
+    """ Return count clients logged in (user0@DOMAIN, user1@DOMAIN...) with the mailbox selected.
+    The measure of the stats begins once they are all ready. """
+
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    setup = Stats()
+
+    async def open_client(i):
+        async with semaphore:
+            client = Client(setup)
+            await client.connect(target.host, target.port, target.context)
+            await client.command('LOGIN user%d@%s password' % (i, DOMAIN))
+            if target.compress:
+                await client.compress()
+            if select:
+                await client.command('SELECT ' + select)
+            client.stats = stats
+            client.wire_start = client.wire_bytes()
+            return client
+
+    clients = await asyncio.gather(*(open_client(i) for i in range(count)))
+    stats.errors += setup.errors
+    stats.begin()
+    return clients
+
+async def close_clients(clients, stats):
+    """ Finish the measure of the stats, logout and close the clients """
+    stats.finish()
+    for client in clients:
+        stats.wire_bytes += client.wire_bytes() - client.wire_start
+        client.stats = Stats()
+    await asyncio.gather(*(client.command('LOGOUT') for client in clients))
+    for client in clients:
+        await client.close()
+
+#       Scenarios: coroutines (target, options, stats) returning the number of connections
+
+async def idle(target, options, stats):
+    """ Many clients logged in and doing nothing, apart from one NOOP each """
+
+    clients = await open_clients(options.clients, target, stats)
+    await asyncio.gather(*(client.command('NOOP') for client in clients))
+    stats.finish()
+    await asyncio.sleep(options.hold) # RSS of the proxy sampled meanwhile
+    await close_clients(clients, stats)
+    return len(clients)
+
+async def bulk_fetch(target, options, stats):
+    """ Each client fetches the entire emails 1:fetch, requests times """
+
+    clients = await open_clients(options.clients, target, stats)
+
+    async def run(client):
+        for i in range(options.requests):
+            await client.command('FETCH 1:%d (UID FLAGS BODY.PEEK[])' % options.fetch)
+
+    await asyncio.gather(*(run(client) for client in clients))
+    await close_clients(clients, stats)
+    return len(clients)
+
+async def large_append(target, options, stats):
+    """ Each client appends an email of append_size bytes, requests times """
+
+    clients = await open_clients(options.clients, target, stats, select=None)
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n'
+    bmail = b'From: bench@example.com\r\nSubject: Append\r\n\r\n' + line * (options.append_size // len(line))
+
+    async def run(client):
+        for i in range(options.requests):
+            await client.command('APPEND Bench (\\Seen)', bmail)
+
+    await asyncio.gather(*(run(client) for client in clients))
+    await close_clients(clients, stats)
+    return len(clients)
+
+async def misp_move(target, options, stats):
+    """ Each client moves requests emails to the MISP mailbox, one by one """
+
+    clients = await open_clients(options.clients, target, stats)
+
+    async def run(client):
+        for uid in range(1, options.requests + 1):
+            await client.command('UID MOVE %d "MISP"' % uid)
+
+    await asyncio.gather(*(run(client) for client in clients))
+    await close_clients(clients, stats)
+    return len(clients)
+
+async def pipeline(target, options, stats):
+    """ Each client sends requests batches of pipeline commands (UID STORE and NOOP) at once """
+
+    clients = await open_clients(options.clients, target, stats)
+
+    async def run(client):
+        for i in range(options.requests):
+            await client.pipeline(['UID STORE %d +FLAGS (\\Seen)' % (n + 1) if n % 2 else 'NOOP'
+                for n in range(options.pipeline)])
+
+    await asyncio.gather(*(run(client) for client in clients))
+    await close_clients(clients, stats)
+    return len(clients)
+
+async def handshake(target, options, stats):
+    """ Each client opens handshakes connections one after the other and closes them once greeted.
+    With SSL/TLS, each connection resumes the session of the previous one. The clients are threads
+    (blocking sockets): asyncio can't resume SSL/TLS sessions. """
+
+    def run():
+        session = None
+        for i in range(options.handshakes):
+            start = time.perf_counter()
+            try:
+                sock = socket.create_connection((target.host, target.port))
+                try:
+                    if target.context:
+                        sock = target.context.wrap_socket(sock, session=session)
+                    greeting = sock.makefile('rb').readline()
+                    if target.context:
+                        stats.resumed += sock.session_reused
+                        session = sock.session # Known once the greeting is read (TLS 1.3 tickets)
+                finally:
+                    sock.close()
+            except OSError:
+                stats.errors += 1
+                continue
+            if not greeting:
+                stats.errors += 1
+            stats.latencies.append(time.perf_counter() - start)
+            stats.bytes += len(greeting)
+
+    stats.begin()
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(options.clients) as executor:
+        await asyncio.gather(*(loop.run_in_executor(executor, run) for i in range(options.clients)))
+    stats.finish()
+    return options.clients
+
+# Scenarios by name
+SCENARIOS = {
+    'idle': idle,
+    'fetch': bulk_fetch,
+    'append': large_append,
+    'misp': misp_move,
+    'handshake': handshake,
+    'pipeline': pipeline,
+}
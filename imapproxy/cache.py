@@ -0,0 +1,132 @@
+"""
+    Content-addressed cache of sanitized emails
+"""
+
+import threading, hashlib, sqlite3, time
+from collections import OrderedDict
+
+# Default maximum size (in bytes) of the sanitized emails kept in memory
+MEMORY_SIZE = 256 * 1024 * 1024
+
+# Default maximum size (in bytes) of the sanitized emails kept on disk
+DISK_SIZE = 4 * 1024 * 1024 * 1024
+
+# Maximum time (in seconds) to wait for the database locked by another process
+DB_TIMEOUT = 30
+
+# The size of the disk tier is read again every RESYNC insertions (other processes insert too)
+RESYNC = 100
+
+def digest(bmail):
+    """ Return the key of a raw email (in bytes) """
+    return hashlib.blake2b(bmail, digest_size=32).digest()
+
+class SanitizedCache:
+
+    r""" Cache of sanitized emails keyed by the digest of the raw email.
+
+    Instantiate with: SanitizedCache([memory_size[, path[, disk_size]]])
+
+            memory_size - Maximum size (in bytes) of the emails kept in memory (default: MEMORY_SIZE)
+            path - Path of a sqlite database keeping the emails on disk, across restarts (default: None)
+            disk_size - Maximum size (in bytes) of the emails kept on disk (default: DISK_SIZE)
+
+    Both tiers evict the least recently used emails. The emails evicted from memory stay on disk.
+    The counters hits, disk_hits, misses and evictions show how many sanitizations are saved.
+    The disk tier is shared by the worker processes using the same path.
+    """
+
+    def __init__(self, memory_size=MEMORY_SIZE, path=None, disk_size=DISK_SIZE):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict() # digest -> sanitized email, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=DB_TIMEOUT, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS sanitized '
+                '(digest BLOB PRIMARY KEY, content BLOB, size INTEGER, last_used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS sanitized_lru ON sanitized (last_used)')
+            self.db.commit()
+            self.inserts = 0
+            self.resync()
+
+    def resync(self):
+        """ Read the size of the disk tier """
+        (self.disk_total,) = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM sanitized').fetchone()
+
+    def get(self, key):
+        """ Return the sanitized email of the given digest or None """
+
+        with self.lock:
+            content = self.memory.get(key)
+            if content is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return content
+
+            if self.db:
+                row = self.db.execute('SELECT content FROM sanitized WHERE digest = ?', (key,)).fetchone()
+                if row:
+                    self.db.execute('UPDATE sanitized SET last_used = ? WHERE digest = ?', (time.time(), key))
+                    self.db.commit()
+                    self.disk_hits += 1
+                    self.keep(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, content):
+        """ Keep the sanitized email of the given digest """
+
+        with self.lock:
+            if key in self.memory:
+                return
+            self.keep(key, content)
+
+            if self.db:
+                cursor = self.db.execute('INSERT OR IGNORE INTO sanitized VALUES (?, ?, ?, ?)',
+                    (key, content, len(content), time.time()))
+                self.disk_total += len(content) if cursor.rowcount else 0
+                self.inserts += 1
+                if self.disk_total > self.disk_size or self.inserts % RESYNC == 0:
+                    self.resync()
+                if self.disk_total > self.disk_size:
+                    self.evict_disk()
+                self.db.commit()
+
+    def keep(self, key, content):
+        """ Keep the email in memory and evict the least recently used ones (lock held) """
+
+        if len(content) > self.memory_size:
+            return
+
+        self.memory[key] = content
+        self.size += len(content)
+        while self.size > self.memory_size:
+            old_key, old_content = self.memory.popitem(last=False)
+            self.size -= len(old_content)
+            self.evictions += 1
+
+    def evict_disk(self):
+        """ Delete the least recently used emails beyond disk_size (lock held) """
+
+        evicted = []
+        for key, size in self.db.execute('SELECT digest, size FROM sanitized ORDER BY last_used'):
+            if self.disk_total <= self.disk_size:
+                break
+            evicted.append((key,))
+            self.disk_total -= size
+
+        self.db.executemany('DELETE FROM sanitized WHERE digest = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """ Return the counters of the cache """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+            'evictions': self.evictions, 'memory_bytes': self.size, 'memory_emails': len(self.memory)}
@@ -0,0 +1,203 @@
+"""
+    COMPRESS=DEFLATE (RFC 4978): streaming compression of the connections with the clients and the servers
+"""
+
+import io, ssl, zlib, imaplib
+from . import metrics
+
+# Legs of the proxy on which COMPRESS=DEFLATE can be enabled
+LEGS = ('client', 'server')
+
+# Compression level of the data sent (1: fastest, 9: smallest)
+LEVEL = 6
+
+# Raw DEFLATE streams, without zlib header and checksum (RFC 1951)
+WBITS = -15
+
+# Maximum size of the compressed data received at once
+READ_SIZE = 64 * 1024
+
+# Unknown to imaplib, which refuses to send it otherwise
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+def negotiate(conn):
+    """ Send COMPRESS DEFLATE on the authenticated imaplib connection if the server supports it.
+    Return True if the server accepted it: the data following its response is compressed. """
+
+    if 'COMPRESS=DEFLATE' not in conn.capabilities:
+        return False
+    typ, data = conn._simple_command('COMPRESS', 'DEFLATE')
+    return typ == 'OK'
+
+class Deflater:
+
+    r""" Compressed stream of the data sent on a connection.
+
+    Instantiate with: Deflater(labels)
+
+            labels - Labels of metrics.COMPRESSED_BYTES (e.g. metrics.CLIENT_OUT)
+
+    compress() may keep the end of the data in the stream: flush() returns the rest, so that
+    the peer can decompress everything given so far. It is called at the end of every message.
+    """
+
+    def __init__(self, labels):
+        self.compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS)
+        self.labels = labels
+        self.size = 0 # Compressed bytes returned
+
+    def compress(self, data):
+        return self.count(self.compressor.compress(data))
+
+    def flush(self):
+        return self.count(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def count(self, data):
+        self.size += len(data)
+        if metrics.ENABLED:
+            metrics.COMPRESSED_BYTES.inc(self.labels, len(data))
+        return data
+
+class InflatingIO(io.RawIOBase):
+
+    r""" Raw stream of the decompressed data received on a socket.
+
+    Instantiate with: InflatingIO(sock, labels[, data])
+
+            sock - Socket (with or without SSL/TLS) receiving the compressed data
+            labels - Labels of metrics.COMPRESSED_BYTES (e.g. metrics.CLIENT_IN)
+            data - Compressed data already received from the socket (default: b'')
+
+    Buffered by inflating_file(). As the files of socket.makefile(), readinto() returns None
+    if the socket is non-blocking and nothing was received (see framing.received). The data is
+    decompressed by blocks of at most the size of the buffer read into.
+    """
+
+    def __init__(self, sock, labels, data=b''):
+        self.sock = sock
+        self.labels = labels
+        self.decompressor = zlib.decompressobj(WBITS)
+        self.data = data # Compressed data not decompressed yet
+        self.full = False # The last block filled the buffer: zlib may hold more data
+        self.size = len(data) # Compressed bytes received
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.data or self.full:
+                block = self.decompressor.decompress(self.data, len(buffer))
+                self.data = self.decompressor.unconsumed_tail
+                self.full = len(block) == len(buffer)
+                if block:
+                    buffer[:len(block)] = block
+                    return len(block)
+
+            try:
+                self.data = self.sock.recv(READ_SIZE)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return None
+            if not self.data:
+                return 0
+            self.size += len(self.data)
+            if metrics.ENABLED:
+                metrics.COMPRESSED_BYTES.inc(self.labels, len(self.data))
+
+def inflating_file(sock, file, labels):
+    """ Return a buffered file decompressing the data received on the socket, to replace
+    its file (socket.makefile('rb') or imaplib.IMAP4.file) once compression started.
+    The data the file already received is compressed: it is decompressed first. """
+
+    data = b''
+    sock.setblocking(False) # Only what is already received
+    try:
+        chunk = file.read1(READ_SIZE)
+        while chunk:
+            data += chunk
+            chunk = file.read1(READ_SIZE)
+    except (BlockingIOError, ssl.SSLWantReadError):
+        pass
+    finally:
+        sock.setblocking(True)
+    return io.BufferedReader(InflatingIO(sock, labels, data))
+
+class DeflatingIO(io.RawIOBase):
+
+    r""" Raw stream compressing the data written on a socket.
+
+    Instantiate with: DeflatingIO(sock, labels)
+
+            sock - Socket (with or without SSL/TLS) sending the compressed data
+            labels - Labels of metrics.COMPRESSED_BYTES
+
+    Every write() is flushed: the peer can decompress it at once. Buffer it with
+    io.BufferedWriter to flush complete responses only.
+    """
+
+    def __init__(self, sock, labels):
+        self.sock = sock
+        self.deflater = Deflater(labels)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sock.sendall(self.deflater.compress(data) + self.deflater.flush())
+        return len(data)
+
+def compress_imaplib(conn):
+    """ Compress the imaplib connection once the server accepted COMPRESS DEFLATE (see negotiate) """
+
+    conn.file = inflating_file(conn.sock, conn.file, metrics.SERVER_IN)
+    # Every imaplib send() is a complete request, or a literal
+    conn.send = DeflatingIO(conn.sock, metrics.SERVER_OUT).write
+
+class Inflater:
+
+    r""" Decompressed stream of the data received by a streams.StreamReader (see StreamReader.inflate).
+
+    Instantiate with: Inflater(labels)
+
+            labels - Labels of metrics.COMPRESSED_BYTES
+    """
+
+    def __init__(self, labels):
+        self.decompressor = zlib.decompressobj(WBITS)
+        self.labels = labels
+        self.size = 0
+
+    def decompress(self, data):
+        self.size += len(data)
+        if metrics.ENABLED:
+            metrics.COMPRESSED_BYTES.inc(self.labels, len(data))
+        return self.decompressor.decompress(data)
+
+class DeflatingWriter:
+
+    r""" asyncio.StreamWriter compressing the data written.
+
+    Instantiate with: DeflatingWriter(writer, labels)
+
+            writer - asyncio.StreamWriter of the connection
+            labels - Labels of metrics.COMPRESSED_BYTES
+
+    The data given to write() is sent once drain() is called, at the end of every message.
+    The other attributes are the ones of the writer.
+    """
+
+    def __init__(self, writer, labels):
+        self.writer = writer
+        self.deflater = Deflater(labels)
+
+    def write(self, data):
+        data = self.deflater.compress(data)
+        if data:
+            self.writer.write(data)
+
+    async def drain(self):
+        self.writer.write(self.deflater.flush())
+        await self.writer.drain()
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
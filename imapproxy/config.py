@@ -0,0 +1,84 @@
+"""
+    Configuration of the proxy and its modules from a configuration file (see imapproxy.conf)
+"""
+
+import os, configparser, functools
+
+from .pool import MAX_SESSIONS, MAX_HOST_SESSIONS
+from . import pycircleanmail, misp, tracer, fetchcache, signer, scheduler, modules
+
+def read(path):
+    """ Return the RawConfigParser of the configuration file """
+    parser = configparser.RawConfigParser()
+    with open(path, 'rt') as fp:
+        parser.read_file(fp)
+    return parser
+
+def configure_modules(path):
+    """ Configure the modules with the sections of the configuration file.
+    Called in every worker process, so they all share the same configuration. """
+
+    parser = read(path)
+
+    if parser.getboolean('general', 'verbose_enabled') and parser.has_section('trace'):
+        tracer.configure(path=parser.get('trace', 'path') or None,
+                         sample=parser.getfloat('trace', 'sample'),
+                         users=[u.strip() for u in parser.get('trace', 'users').split(',') if u.strip()],
+                         max_literal=parser.getint('trace', 'max_literal'),
+                         dump_path=parser.get('trace', 'dump_path'),
+                         ring_size=parser.getint('trace', 'ring_size'))
+
+    if parser.has_section('modules'):
+        modules.configure([name.strip() for name in parser.get('modules', 'enabled').split(',') if name.strip()])
+
+    if parser.has_section('pycircleanmail'):
+        pycircleanmail.configure(workers=parser.getint('pycircleanmail', 'workers'),
+                                 timeout=parser.getint('pycircleanmail', 'timeout'),
+                                 max_size=parser.getint('pycircleanmail', 'max_size'),
+                                 max_jobs=parser.getint('pycircleanmail', 'max_jobs'),
+                                 max_queue=parser.getint('pycircleanmail', 'max_queue'),
+                                 cache_size=parser.getint('pycircleanmail', 'cache_size'),
+                                 cache_path=parser.get('pycircleanmail', 'cache_path') or None,
+                                 cache_disk_size=parser.getint('pycircleanmail', 'cache_disk_size'),
+                                 index_path=parser.get('pycircleanmail', 'index_path') or None,
+                                 presanitize=parser.getboolean('pycircleanmail', 'presanitize'),
+                                 presanitize_workers=parser.getint('pycircleanmail', 'presanitize_workers'),
+                                 presanitize_rate=parser.getfloat('pycircleanmail', 'presanitize_rate'),
+                                 presanitize_burst=parser.getint('pycircleanmail', 'presanitize_burst'),
+                                 sign_digest=parser.get('pycircleanmail', 'sign_digest', fallback=signer.DIGEST),
+                                 verify_signatures=parser.getboolean('pycircleanmail', 'verify_signatures', fallback=False))
+
+    if parser.has_section('fetch_cache'):
+        fetchcache.configure(memory_size=parser.getint('fetch_cache', 'memory_size'),
+                             disk_size=parser.getint('fetch_cache', 'disk_size'))
+
+    if parser.has_section('scheduler'):
+        scheduler.configure(max_running=parser.getint('scheduler', 'max_running'),
+                            max_account=parser.getint('scheduler', 'max_account'),
+                            max_host=parser.getint('scheduler', 'max_host'),
+                            rate=parser.getfloat('scheduler', 'rate'),
+                            burst=parser.getint('scheduler', 'burst'))
+
+    if parser.has_section('misp'):
+        misp.configure(queue_path=parser.get('misp', 'queue_path'),
+                       server=parser.get('misp', 'server'))
+
+def proxy_options(path):
+    """ Return the arguments of IMAP_Proxy from the [general] section of the configuration file,
+    setup configuring the modules (see configure_modules) """
+
+    parser = read(path)
+    return dict(certfile=parser.get('general', 'certfile'),
+                starttls=parser.getboolean('general', 'starttls', fallback=False),
+                key=parser.get('general', 'key'),
+                port=parser.getint('general', 'port'),
+                max_client=parser.getint('general', 'nclient'),
+                verbose=parser.getboolean('general', 'verbose_enabled'),
+                ipv6=parser.getboolean('general', 'ipv6_enabled'),
+                engine=parser.get('general', 'engine', fallback='thread'),
+                max_sessions=parser.getint('general', 'max_sessions', fallback=MAX_SESSIONS),
+                max_host_sessions=parser.getint('general', 'max_host_sessions', fallback=MAX_HOST_SESSIONS),
+                metrics_port=parser.getint('general', 'metrics_port', fallback=0),
+                workers=parser.getint('general', 'workers', fallback=1),
+                compress=[leg.strip() for leg in parser.get('general', 'compress', fallback='').split(',') if leg.strip()],
+                setup=functools.partial(configure_modules, os.path.abspath(path)))
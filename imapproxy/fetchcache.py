@@ -0,0 +1,424 @@
+"""
+    Read-through cache of the immutable data of the emails (BODY[] and its sections, RFC822.SIZE,
+    BODYSTRUCTURE), so that an email fetched again is not downloaded again from the server
+"""
+
+import re, mmap, tempfile, threading
+from collections import OrderedDict
+from .helpers import SequenceSet, STAR, Fetch_UID
+from .framing import literal_size
+from . import metrics
+
+# Default maximum size (in bytes) of the data kept in memory
+MEMORY_SIZE = 64 * 1024 * 1024
+
+# Default size (in bytes) of the memory-mapped file the data evicted from memory is spilled to
+DISK_SIZE = 512 * 1024 * 1024
+
+# Items bigger than MAX_ITEM bytes are not cached
+MAX_ITEM = 16 * 1024 * 1024
+
+# Maximum number of uids of a FETCH looked up in the cache
+MAX_LOOKUPS = 1000
+
+# Maximum size (in bytes) of the cached data answering one FETCH
+MAX_ANSWER = 64 * 1024 * 1024
+
+# Items of a FETCH request answered by the server along with the cached items
+SIMPLE_ITEMS = frozenset(('UID', 'FLAGS', 'INTERNALDATE', 'MODSEQ', 'X-GM-MSGID', 'X-GM-THRID'))
+
+# Immutable items besides the sections of BODY[]
+IMMUTABLE_ITEMS = frozenset((b'RFC822.SIZE', b'BODYSTRUCTURE'))
+
+# UID FETCH request of the client (first line, without modifiers such as CHANGEDSINCE)
+Fetch_Request = re.compile(r'[^ ]+ UID FETCH (?P<ids>[0-9:,*]+) (?P<items>\([^()]*(\([^()]*\))?[^()]*\)|[A-Z0-9.]+)\Z',
+    flags=re.IGNORECASE)
+# Item of a FETCH request
+Fetch_Item = re.compile(r'(BODY|BINARY)(\.PEEK)?\[[^\]]*\](<[0-9.]+>)?|[A-Z0-9.\-]+', flags=re.IGNORECASE)
+# Untagged FETCH response
+Fetch_Response = re.compile(rb'\* [0-9]+ FETCH \(', flags=re.IGNORECASE)
+
+# Cache of the proxy (created on first use or by configure)
+CACHE = None
+CONFIGURED = False
+
+def configure(memory_size=MEMORY_SIZE, disk_size=DISK_SIZE):
+    """ Create the cache of the proxy (see MessageCache, disabled if memory_size is 0) """
+    global CACHE, CONFIGURED
+    CACHE = MessageCache(memory_size, disk_size) if memory_size else None
+    CONFIGURED = True
+    if CACHE:
+        metrics.Callback('imapproxy_fetch_cache', 'Counters of the cache of the immutable data of the emails',
+            'gauge', lambda: {(name,): value for name, value in CACHE.stats().items()}, ('counter',))
+
+def message_cache():
+    """ Return the cache of the proxy, None if disabled """
+    if not CONFIGURED:
+        configure()
+    return CACHE
+
+class MessageCache:
+
+    r""" LRU cache of the immutable data of the emails, keyed by (account, mailbox, UIDVALIDITY, uid, item).
+
+    Instantiate with: MessageCache([memory_size[, disk_size]])
+
+            memory_size - Maximum size (in bytes) of the data kept in memory (default: MEMORY_SIZE)
+            disk_size - Size (in bytes) of the memory-mapped file the data evicted from memory
+                is spilled to (default: DISK_SIZE, 0 keeps the data in memory only)
+
+    The file is a temporary file written as a ring: the oldest data is overwritten first.
+    Data read from the file goes back to memory. Nothing is invalidated: with the same
+    UIDVALIDITY, the data of a uid never changes.
+    """
+
+    def __init__(self, memory_size=MEMORY_SIZE, disk_size=DISK_SIZE):
+        self.memory_size = memory_size
+        self.memory = OrderedDict() # key -> value, least recently used first
+        self.size = 0
+        self.disk = OrderedDict() # key -> (offset, size) in the file, oldest first
+        self.head = 0 # Offset of the next write in the file
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+        self.map = None
+        if disk_size:
+            with tempfile.TemporaryFile() as f: # Removed from the filesystem, the mapping keeps it
+                f.truncate(disk_size)
+                self.map = mmap.mmap(f.fileno(), disk_size)
+
+    def get(self, key):
+        """ Return the value of the key or None """
+
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return value
+
+            location = self.disk.pop(key, None)
+            if location:
+                offset, size = location
+                value = self.map[offset:offset + size]
+                self.disk_hits += 1
+                self.keep(key, value)
+                return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """ Keep the value of the key """
+
+        with self.lock:
+            if key in self.memory or len(value) > min(MAX_ITEM, self.memory_size):
+                return
+            self.disk.pop(key, None)
+            self.keep(key, value)
+
+    def keep(self, key, value):
+        """ Keep the value in memory and spill the least recently used ones (lock held) """
+
+        self.memory[key] = value
+        self.size += len(value)
+        while self.size > self.memory_size:
+            old_key, old_value = self.memory.popitem(last=False)
+            self.size -= len(old_value)
+            self.spill(old_key, old_value)
+
+    def spill(self, key, value):
+        """ Write the value in the file, over the oldest values (lock held) """
+
+        if not self.map or len(value) > len(self.map):
+            self.evictions += 1
+            return
+
+        if self.head + len(value) > len(self.map):
+            self.head = 0
+        end = self.head + len(value)
+        while self.disk:
+            old_key, (offset, size) = next(iter(self.disk.items()))
+            if offset >= end or offset + size <= self.head:
+                break
+            del self.disk[old_key]
+            self.evictions += 1
+
+        self.map[self.head:end] = value
+        self.disk[key] = (self.head, len(value))
+        self.head = end
+
+    def stats(self):
+        """ Return the counters of the cache """
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'memory_bytes': self.size, 'memory_items': len(self.memory),
+                'disk_items': len(self.disk)}
+
+#       Items of the FETCH requests and responses
+
+def item_key(name):
+    """ Return the key of an item of a FETCH request or response (bytes): BODY.PEEK[...] and
+    BODY[...] are the same data, RFC822 is BODY[] """
+
+    key = b' '.join(name.upper().split())
+    if key.startswith(b'BODY.PEEK['):
+        key = b'BODY[' + key[10:]
+    return b'BODY[]' if key == b'RFC822' else key
+
+def cacheable(key):
+    """ Return True if the item of the given key is immutable (and not partial) """
+    return key in IMMUTABLE_ITEMS or (key.startswith(b'BODY[') and key.endswith(b']'))
+
+def answerable(name):
+    """ Return True if the item of a FETCH request can be answered from the cache without
+    changing the flags of the email """
+    name = name.upper()
+    return name.startswith('BODY.PEEK[') or name in ('RFC822.SIZE', 'BODYSTRUCTURE')
+
+def literal(data):
+    """ Return the data as an IMAP literal """
+    return b'{%d}\r\n' % len(data) + data
+
+def request_items(items):
+    """ Return the names of the items of a FETCH request, None if a macro or not understood """
+
+    if not items.startswith('('):
+        return None
+    names = []
+    position = 1
+    for match in Fetch_Item.finditer(items, 1, len(items) - 1):
+        if items[position:match.start()].strip():
+            return None
+        names.append(match.group())
+        position = match.end()
+    if items[position:-1].strip():
+        return None
+    return names
+
+def response_items(data):
+    """ Return [(name, value)] of an untagged FETCH response (bytes of the whole response),
+    the values as sent by the server, or None if the response is not understood """
+
+    match = Fetch_Response.match(data)
+    if not match:
+        return None
+
+    items = []
+    position = match.end()
+    try:
+        while data[position:position + 1] != b')':
+            end = skip_name(data, position)
+            name = data[position:end]
+            position = end + 1 # Space
+            end = skip_value(data, position)
+            items.append((name, data[position:end]))
+            position = end + 1 if data[end:end + 1] == b' ' else end
+    except (IndexError, ValueError):
+        return None
+    return items
+
+def skip_name(data, position):
+    """ Return the end of the name of the item starting at position """
+
+    while data[position:position + 1] not in (b' ', b'['):
+        if position >= len(data):
+            raise ValueError('Unexpected end of the response')
+        position += 1
+    if data[position:position + 1] == b'[':
+        position = data.index(b']', position) + 1
+        if data[position:position + 1] == b'<':
+            position = data.index(b'>', position) + 1
+    return position
+
+def skip_value(data, position):
+    """ Return the end of the value (atom, string, literal or list) starting at position """
+
+    depth = 0
+    while True:
+        char = data[position:position + 1]
+        if char == b'"':
+            position += 1
+            while data[position:position + 1] != b'"':
+                position += 2 if data[position:position + 1] == b'\\' else 1
+                if position >= len(data):
+                    raise ValueError('Unterminated string')
+            position += 1
+        elif char == b'{':
+            end = data.index(b'\r\n', position) + 2
+            size = literal_size(data[position:end])
+            if not size:
+                raise ValueError('Invalid literal')
+            position = end + size[0]
+        elif char == b'(':
+            depth += 1
+            position += 1
+            continue
+        elif char == b')':
+            if not depth:
+                return position # End of the response
+            depth -= 1
+            position += 1
+        elif not char:
+            raise ValueError('Unexpected end of the response')
+        else:
+            while data[position:position + 1] not in (b' ', b')', b'(', b'') or data[position - 1:position] == b'\\':
+                position += 1
+
+        if not depth:
+            return position
+        if data[position:position + 1] == b' ':
+            position += 1
+
+class FetchResponses:
+
+    r""" Untagged responses of a FETCH command for the emails of a mailbox: the immutable
+    items of the FETCH responses are recorded in the cache, and the responses are completed
+    with the cached items of their email.
+
+    Instantiate with: FetchResponses(cache, mailbox[, cached])
+
+            cache - MessageCache
+            mailbox - (account, mailbox name, UIDVALIDITY) of the emails
+            cached - {uid: [(name, value)]} of the items added to the responses (default: None)
+
+    The engines give the first line of every untagged response to parts(), then the size of
+    its literals to literal(), their chunks to chunk() (or chunks()) and the lines following
+    them to line(). Responses bigger than MAX_ITEM are streamed without being recorded.
+    """
+
+    def __init__(self, cache, mailbox, cached=None):
+        self.cache = cache
+        self.mailbox = mailbox
+        self.cached = cached
+        self.message = None # Parts of the FETCH response being recorded
+        self.size = 0
+
+    def parts(self, line):
+        """ Return the parts sent to the client for the first line of an untagged response """
+
+        self.message = None
+        if not Fetch_Response.match(line):
+            return [line]
+
+        if self.cached and line.endswith(b')\r\n'):
+            match = Fetch_UID.search(line)
+            items = self.cached.pop(int(match.group('uid')), None) if match else None
+            if items:
+                parts = [line[:-3]]
+                for name, value in items:
+                    parts += (b' ', name, b' ', value)
+                parts.append(b')\r\n')
+                return parts
+
+        self.message = [line]
+        self.size = len(line)
+        if not literal_size(line):
+            self.record()
+        return [line]
+
+    def literal(self, size):
+        """ Return True if the literal of the given size is recorded (see chunk) """
+        if self.message is None:
+            return False
+        self.size += size
+        if self.size > MAX_ITEM:
+            self.message = None
+            return False
+        return True
+
+    def chunk(self, data):
+        self.message.append(bytes(data))
+
+    def line(self, line):
+        """ Record the line following a literal """
+        if self.message is None:
+            return
+        self.message.append(line)
+        self.size += len(line)
+        if not literal_size(line):
+            self.record()
+
+    def record(self):
+        """ Keep the immutable items of the complete response in the cache """
+
+        items = response_items(b''.join(self.message))
+        self.message = None
+        if not items:
+            return
+
+        uid = next((value for name, value in items if name.upper() == b'UID'), b'')
+        if not uid.isdigit():
+            return
+        for name, value in items:
+            key = item_key(name)
+            if cacheable(key):
+                self.cache.put(self.mailbox + (int(uid), key), value)
+
+def process(client):
+    """ Return the commands answering the UID FETCH request of the client, as [(request, FetchResponses)]:
+    each request without tag (None for the request of the client), the completion of the last one
+    completing the request. Empty if the request is transmitted as it is.
+
+        client - Connection object
+
+    The uids whose requested immutable items are all cached are fetched without these items,
+    which are added to the responses. The other uids are fetched as requested, and their
+    immutable items recorded.
+    """
+
+    cache = message_cache()
+    if not cache or not client.uidvalidity or not client.current_folder:
+        return []
+
+    match = Fetch_Request.match(client.request)
+    names = request_items(match.group('items')) if match else None
+    if not names:
+        return []
+    keys = [item_key(name.encode()) for name in names]
+    if not any(cacheable(key) for key in keys):
+        return []
+
+    mailbox = (client.account, client.current_folder, client.uidvalidity)
+    recorded = [(None, FetchResponses(cache, mailbox))]
+
+    # Answered from the cache: BODY.PEEK only, as BODY[] and RFC822 set \Seen
+    answered = [(name, key) for name, key in zip(names, keys) if cacheable(key) and answerable(name)]
+    others = [name for name, key in zip(names, keys) if not (cacheable(key) and answerable(name))]
+    ids = SequenceSet.parse(match.group('ids'))
+    if (not answered or any(name.upper() not in SIMPLE_ITEMS for name in others)
+            or STAR in ids or len(ids) > MAX_LOOKUPS):
+        return recorded
+
+    cached, size = {}, 0
+    for uid in ids:
+        items = []
+        for name, key in answered:
+            value = cache.get(mailbox + (uid, key))
+            if value is None:
+                break
+            items.append((name.encode().upper().replace(b'BODY.PEEK[', b'BODY['), value))
+        else:
+            size += sum(len(value) for name, value in items)
+            if size > MAX_ANSWER:
+                break
+            cached[uid] = items
+    if not cached:
+        return recorded
+
+    hits = SequenceSet.from_ids(cached)
+    misses = ids - hits
+    items = ['UID'] + [name for name in others if name.upper() != 'UID']
+    commands = [(('UID FETCH %s (%s)\r\n' % (hits, ' '.join(items))).encode(), FetchResponses(cache, mailbox, cached))]
+    if misses:
+        commands.append((('UID FETCH %s %s\r\n' % (misses, match.group('items'))).encode(), FetchResponses(cache, mailbox)))
+    return commands
+
+def remember(account, folder, uidvalidity, uid, bmail):
+    """ Keep BODY[] and RFC822.SIZE of an email whose content is known (downloaded or appended by a module) """
+
+    cache = message_cache()
+    if cache and uidvalidity:
+        mailbox = (account, folder, uidvalidity, uid)
+        cache.put(mailbox + (b'BODY[]',), literal(bmail))
+        cache.put(mailbox + (b'RFC822.SIZE',), b'%d' % len(bmail))
@@ -0,0 +1,157 @@
+"""
+    IMAP framing: incremental and literal-aware reading of commands and responses
+"""
+
+import re, ssl, imaplib
+
+# Maximum length of a line read from the client or the server
+MAX_LINE = imaplib._MAXLINE
+
+# Initial size of the buffer receiving the literals
+BUFFER_SIZE = 64 * 1024
+
+# Maximum size of the reused buffer: a bigger literal gets a buffer of its own, released with its slice
+MAX_BUFFER_SIZE = 1024 * 1024
+
+# Size of the chunks of a streamed literal
+CHUNK_SIZE = 256 * 1024
+
+# Literal announced at the end of a line: {n} (synchronizing) or {n+} (non-synchronizing)
+Literal = re.compile(rb'\{(?P<size>[0-9]+)(?P<plus>\+)?\}\r\n\Z')
+
+def literal_size(line):
+    """ Return (size, synchronizing) of the literal announced at the end of the line
+    or None if the line announces no literal """
+
+    if not line.endswith(b'}\r\n'):
+        return None
+
+    match = Literal.search(line)
+    if not match:
+        return None
+
+    return int(match.group('size')), not match.group('plus')
+
+def received(sock, file):
+    """ Return True if (a part of) the next message is already received on the socket, without
+    blocking: buffered by the file (socket.makefile('rb')) or readable on the socket """
+
+    sock.setblocking(False) # The file only reads what is already received
+    try:
+        return bool(file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.setblocking(True)
+
+class IMAPReader:
+
+    r""" Incremental reader of IMAP commands or responses.
+
+    Instantiate with: IMAPReader(file[, client[, max_line]])
+
+            file - Buffered binary file of the socket (e.g. socket.makefile('rb') or imaplib.IMAP4.file)
+            client - True if the peer is a client: a synchronizing literal {n} then ends the message
+                because the client waits for a continuation response before sending it (default: False)
+            max_line - Maximum length of a line (default: imaplib._MAXLINE)
+
+    read_message() returns the parts of one complete command or response: the lines as bytes
+    (with CRLF) and the literals as memoryview slices of a receive buffer reused from one
+    message to the next. The slices are only valid until the next read.
+    Nothing is read beyond the message, so the file can be shared with imaplib.
+
+    The buffer grows up to MAX_BUFFER_SIZE: a bigger literal is read in a buffer of its own.
+    Big literals can also be streamed with read_line() and read_chunks() without being
+    held in memory at once.
+    """
+
+    def __init__(self, file, client=False, max_line=MAX_LINE):
+        self.file = file
+        self.client = client
+        self.max_line = max_line
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.offset = 0
+        self.chunk = None
+
+    def read_message(self):
+        """ Return (parts, literal) for the next message, literal being the size of the
+        synchronizing literal the client waits to send (None otherwise) """
+        self.offset = 0
+        return self.read_parts([])
+
+    def read_continuation(self, size):
+        """ Return (parts, literal) for the synchronizing literal of the given size
+        and the rest of the message, once the server accepted it """
+        self.offset = 0
+        return self.read_parts([self.read_literal(size)])
+
+    def read_rest(self):
+        """ Return (parts, literal) for the rest of the message after a synchronizing literal
+        streamed with read_chunks """
+        self.offset = 0
+        return self.read_parts([])
+
+    def read_parts(self, parts):
+        """ Read lines and literals until a line announces no literal """
+
+        while True:
+            line = self.read_line()
+            parts.append(line)
+
+            literal = literal_size(line)
+            if not literal:
+                return parts, None
+
+            size, synchronizing = literal
+            if self.client and synchronizing:
+                return parts, size
+
+            parts.append(self.read_literal(size))
+
+    def read_line(self):
+        """ Return the next line with its CRLF """
+
+        line = self.file.readline(self.max_line + 1)
+        if not line:
+            raise ConnectionResetError('Connection closed by the peer')
+        if len(line) > self.max_line:
+            raise ValueError('Line too long: got more than %d bytes' % self.max_line)
+
+        return line
+
+    def read_literal(self, size):
+        """ Return a memoryview on the next size bytes """
+
+        if size > MAX_BUFFER_SIZE:
+            view = memoryview(bytearray(size))
+        else:
+            if self.offset + size > len(self.buffer):
+                # Previous slices keep the old buffer alive until they are released
+                self.buffer = bytearray(min(max(size, 2 * len(self.buffer)), MAX_BUFFER_SIZE))
+                self.offset = 0
+
+            view = memoryview(self.buffer)[self.offset:self.offset + size]
+            self.offset += size
+
+        received = 0
+        while received < size:
+            n = self.file.readinto(view[received:])
+            if not n:
+                raise ConnectionResetError('Connection closed by the peer')
+            received += n
+
+        return view
+
+    def read_chunks(self, size):
+        """ Yield the next size bytes as memoryviews of at most CHUNK_SIZE bytes.
+        Every chunk is only valid until the next one is yielded. """
+
+        if self.chunk is None: # Allocated once, on the first streamed literal
+            self.chunk = memoryview(bytearray(CHUNK_SIZE))
+
+        while size > 0:
+            n = self.file.readinto(self.chunk[:min(size, CHUNK_SIZE)])
+            if not n:
+                raise ConnectionResetError('Connection closed by the peer')
+            size -= n
+            yield self.chunk[:n]
@@ -2,25 +2,258 @@
     Helpers for the modules (PyCIRCLeanMail & MISP)
 """
 
-def parse_ids(str_ids):
-    """ Convert string of ids to a list of ids
+import re, bisect
+from array import array
 
-        str_ids - ids of format "1:6" or "1,3:5" or "1,4"
+# Start of the data of a message in a FETCH response
+Fetch_Start = re.compile(rb'\A[0-9]+ \(')
+# UID of a message in a FETCH response
+Fetch_UID = re.compile(rb'UID (?P<uid>[0-9]+)')
 
-    If str_ids = "1:6", return (1,2,3,4,5,6).
-    If str_ids = "1,3:5", return (1,3,4,5).
-    If str_ids = "1,4", return (1,4).
-    """
+# Id standing for '*' (the largest id in use) until it is resolved
+STAR = 2**32 - 1
+
+# Line endings other than CRLF in a raw email
+Bare_Line_Ending = re.compile(rb'\r(?!\n)|(?<!\r)\n')
 
-    ids = []
-    raw_ids = str_ids.split(',')
+def parse_fetch(response):
+    """ Return {uid: literal} for the data of an imaplib FETCH response including the UID
 
-    for s in raw_ids:
-        if ':' in s:
-            (start, end) = s.split(':')
-            print(start, end)
-            [ids.append(i) for i in range(int(start), int(end)+1)]
+        response - data returned by imaplib for a FETCH command
+
+    The literal is the first literal of the message data (None if the message has no literal).
+    """
+
+    messages = [] # [text, literal] of each message
+    for item in response:
+        if isinstance(item, tuple):
+            text, literal = item[0], item[1]
+        elif item:
+            text, literal = item, None
         else:
-            ids.append(int(s))
+            continue
+
+        if Fetch_Start.match(text):
+            messages.append([text, literal])
+        elif messages:
+            # Following data of the same message (e.g. ")" or " UID 5)")
+            messages[-1][0] += text
+            if messages[-1][1] is None:
+                messages[-1][1] = literal
+
+    result = {}
+    for text, literal in messages:
+        match = Fetch_UID.search(text)
+        if match:
+            result[int(match.group('uid'))] = literal
+
+    return result
+
+def crlf(bmail):
+    """ Return the raw email with CRLF line endings, as sent by imaplib (copied only if needed) """
+    if not Bare_Line_Ending.search(bmail):
+        return bmail
+    if b'\r' not in bmail:
+        # LF line endings (e.g. serialized by the email package): one copy, without a piece per line
+        return bmail.replace(b'\n', b'\r\n')
+    return re.sub(rb'\r\n|\r|\n', b'\r\n', bmail)
+
+def body_offset(bmail):
+    """ Return the offset of the body of the raw email (bytes with CRLF line endings),
+    its length if the email has no body """
+
+    if bmail[:2] == b'\r\n':
+        return 2
+    end = bmail.find(b'\r\n\r\n')
+    return end + 4 if end >= 0 else len(bmail)
+
+def get_header(bmail, name):
+    """ Return the (unfolded) value of the first header of the given name in the raw email
+    (bytes with CRLF line endings), None if the email has no such header. The body is not read. """
+
+    match = re.compile(rb'^' + re.escape(name.encode()) + rb':[ \t]*(?P<value>[^\r\n]*(\r\n[ \t][^\r\n]*)*)',
+        flags=re.IGNORECASE | re.MULTILINE).search(bmail, 0, body_offset(bmail))
+    if match:
+        return match.group('value').replace(b'\r\n', b'').decode('utf-8', 'replace').strip()
+
+def add_headers(bmail, headers):
+    """ Return the raw email (bytes with CRLF line endings) with the headers [(name, value)]
+    added at the end of its header block, in one copy: the body is neither parsed nor modified """
+
+    lines = b''.join(('%s: %s' % header).encode('utf-8') + b'\r\n' for header in headers)
+    offset = body_offset(bmail)
+    if offset == len(bmail) and bmail[-4:] != b'\r\n\r\n':
+        # Headers only
+        return bmail + (b'' if bmail.endswith(b'\r\n') or not bmail else b'\r\n') + lines
+    return b''.join((memoryview(bmail)[:offset - 2], lines, memoryview(bmail)[offset - 2:]))
+
+def refresh_capabilities(conn_server):
+    """ Update the capabilities of an imaplib connection once authenticated:
+    servers often advertise more capabilities (e.g. UIDPLUS, MOVE) after the login """
+
+    typ, dat = conn_server.capability()
+    if typ == 'OK' and dat[-1]:
+        conn_server.capabilities = tuple(dat[-1].decode('ascii', 'replace').upper().split())
+
+class SequenceSet:
+
+    r""" Compact set of ids (sequence numbers or uids) stored as sorted and disjoint ranges.
+
+    Instantiate with: SequenceSet([ranges]) or SequenceSet.parse(str_ids)
+
+            ranges - iterable of ranges (start, end), in any order and possibly overlapping
+
+    The bounds of the ranges are kept in an array, so "1:100000" costs two integers.
+    '*' is kept as STAR until resolve() replaces it by the largest id in use (EXISTS or UIDNEXT - 1).
+
+    If str_ids = "1:6", the set contains 1,2,3,4,5,6 and str() returns "1:6".
+    If str_ids = "4,1,3:2", the set contains 1,2,3,4 and str() returns "1:4".
+    """
+
+    __slots__ = ('bounds',)
+
+    def __init__(self, ranges=()):
+        bounds = []
+        for (start, end) in sorted(ranges):
+            if bounds and start <= bounds[-1] + 1:
+                bounds[-1] = max(end, bounds[-1])
+            else:
+                bounds += (start, end)
+        self.bounds = array('L', bounds)
+
+    @classmethod
+    def parse(cls, str_ids):
+        """ Return the SequenceSet of a string of ids
+
+            str_ids - ids of format "1:6" or "1,3:5" or "1,4" or "5:*"
+        """
+
+        bounds = [] # Bounds of the ranges while they come in increasing order
+        ranges = None
+        for s in str_ids.split(','):
+            (start, sep, end) = s.partition(':')
+            start = STAR if start == '*' else int(start)
+            end = start if not sep else STAR if end == '*' else int(end)
+            if start > end:
+                start, end = end, start
+
+            if ranges is not None:
+                ranges.append((start, end))
+            elif not bounds or start > bounds[-1] + 1:
+                bounds += (start, end)
+            else:
+                # Unordered or overlapping ranges: merged by the constructor
+                ranges = list(zip(bounds[0::2], bounds[1::2]))
+                ranges.append((start, end))
+
+        if ranges is not None:
+            return cls(ranges)
+
+        sequence_set = cls()
+        sequence_set.bounds = array('L', bounds)
+        return sequence_set
+
+    @classmethod
+    def from_ids(cls, ids):
+        """ Return the SequenceSet of an iterable of ids """
+        return cls((id, id) for id in ids)
+
+    def ranges(self):
+        """ Iterate over the ranges (start, end) """
+        bounds = self.bounds
+        return zip(bounds[0::2], bounds[1::2])
+
+    def resolve(self, largest):
+        """ Return the set with '*' replaced by largest, the largest id in use """
+
+        ranges = []
+        for (start, end) in self.ranges():
+            if start == STAR:
+                start = end = largest
+            elif end == STAR:
+                # "5:*" with 3 messages is "3:5"
+                start, end = min(start, largest), max(start, largest)
+            ranges.append((start, end))
+
+        return SequenceSet(ranges)
+
+    def chunks(self, size):
+        """ Iterate over subsets of at most size ids, in increasing order """
+
+        chunk, count = [], 0
+        for (start, end) in self.ranges():
+            while start <= end:
+                n = min(end - start + 1, size - count)
+                chunk.append((start, start + n - 1))
+                count += n
+                start += n
+                if count == size:
+                    yield SequenceSet(chunk)
+                    chunk, count = [], 0
+
+        if chunk:
+            yield SequenceSet(chunk)
+
+    def __and__(self, other):
+        """ Intersection of two sets """
+
+        ranges, others = [], list(other.ranges())
+        i = 0
+        for (start, end) in self.ranges():
+            while i < len(others) and others[i][1] < start:
+                i += 1
+            j = i
+            while j < len(others) and others[j][0] <= end:
+                ranges.append((max(start, others[j][0]), min(end, others[j][1])))
+                j += 1
+
+        return SequenceSet(ranges)
+
+    def __sub__(self, other):
+        """ Difference of two sets """
+
+        ranges, others = [], list(other.ranges())
+        i = 0
+        for (start, end) in self.ranges():
+            while i < len(others) and others[i][1] < start:
+                i += 1
+            j = i
+            while start <= end and j < len(others) and others[j][0] <= end:
+                if others[j][0] > start:
+                    ranges.append((start, others[j][0] - 1))
+                start = max(start, others[j][1] + 1)
+                j += 1
+            if start <= end:
+                ranges.append((start, end))
+
+        return SequenceSet(ranges)
+
+    def __or__(self, other):
+        """ Union of two sets """
+        return SequenceSet(list(self.ranges()) + list(other.ranges()))
+
+    def __contains__(self, id):
+        i = bisect.bisect_right(self.bounds, id)
+        # Inside a range if id is after a start (odd index) or equal to an end
+        return i % 2 == 1 or (i > 0 and self.bounds[i-1] == id)
+
+    def __iter__(self):
+        for (start, end) in self.ranges():
+            yield from range(start, end + 1)
+
+    def __len__(self):
+        return sum(end - start + 1 for (start, end) in self.ranges())
+
+    def __bool__(self):
+        return len(self.bounds) > 0
+
+    def __eq__(self, other):
+        return isinstance(other, SequenceSet) and self.bounds == other.bounds
+
+    def __str__(self):
+        """ Minimal IMAP string of the set """
+        ids = lambda id: '*' if id == STAR else str(id)
+        return ','.join(ids(start) if start == end else ids(start) + ':' + ids(end) for (start, end) in self.ranges())
 
-    return ids
\ No newline at end of file
+    def __repr__(self):
+        return 'SequenceSet(' + repr(str(self)) + ')'
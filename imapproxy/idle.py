@@ -0,0 +1,194 @@
+"""
+    IDLE of the clients: one upstream IDLE per mailbox of an account, shared by its idling connections
+"""
+
+import re, time, select, threading, imaplib
+from .framing import literal_size, received
+
+# The upstream IDLE is restarted every REIDLE_INTERVAL seconds, before the 30 minutes inactivity timer of the servers
+REIDLE_INTERVAL = 29 * 60
+
+# Time (in seconds) the upstream IDLE of a mailbox is kept after its last client left:
+# clients IDLE again after each command
+LINGER = 60
+
+# Delay (in seconds) before opening again an upstream IDLE which failed
+RETRY_DELAY = 30
+
+# Untagged responses reporting a change of the mailbox
+Update = re.compile(rb'\* [0-9]+ (EXISTS|EXPUNGE|RECENT|FETCH)\b', flags=re.IGNORECASE)
+
+class IdleHub:
+
+    r""" Upstream IDLEs of the proxy by account and mailbox.
+
+    Instantiate with: IdleHub()
+
+    subscribe() adds an idling connection to the watcher of its mailbox, started on first use
+    with a session of the account. A watcher stops LINGER seconds after its last connection
+    unsubscribed, and its session goes back to the pool.
+    """
+
+    def __init__(self):
+        self.watchers = {} # (account, mailbox) -> watcher
+        self.lock = threading.Lock()
+
+    def subscribe(self, watcher_class, account, mailbox, pool, acquire, connection):
+        """ Return the watcher of the mailbox, the connection being refreshed on its updates
+
+            watcher_class - Watcher or aio.AsyncWatcher, started if the mailbox has no watcher
+            account - Key of the account (see SessionPool.account)
+            pool - SessionPool of the sessions
+            acquire - Function returning a session of the account from the pool
+        """
+
+        with self.lock:
+            watcher = self.watchers.get((account, mailbox))
+            if watcher is None:
+                watcher = self.watchers[(account, mailbox)] = watcher_class(self, (account, mailbox), pool, acquire)
+                watcher.start()
+            watcher.subscribers.add(connection)
+            watcher.left = None
+        return watcher
+
+    def unsubscribe(self, watcher, connection):
+        with self.lock:
+            watcher.subscribers.discard(connection)
+            if not watcher.subscribers:
+                watcher.left = time.monotonic()
+
+    def subscribers(self, watcher):
+        """ Return the connections of the watcher """
+        with self.lock:
+            return list(watcher.subscribers)
+
+    def expired(self, watcher):
+        """ Return True (and forget the watcher) if it has no connection for LINGER seconds """
+        with self.lock:
+            if watcher.left is None or time.monotonic() - watcher.left < LINGER:
+                return False
+            if self.watchers.get(watcher.key) is watcher:
+                del self.watchers[watcher.key]
+            return True
+
+    def stats(self):
+        """ Return the number of mailboxes in IDLE upstream and of idling connections (see metrics) """
+        with self.lock:
+            return {('mailboxes',): len(self.watchers),
+                    ('connections',): sum(len(watcher.subscribers) for watcher in self.watchers.values())}
+
+class Watcher:
+
+    r""" Upstream IDLE on a mailbox, shared by the idling connections of an account (one thread).
+
+    Instantiate with: Watcher(hub, key, pool, acquire)
+
+            hub - IdleHub of the watcher
+            key - (account, name of the mailbox)
+            pool - SessionPool the session is taken from and given back to
+            acquire - Function returning a session of the account from the pool
+
+    The mailbox is opened read-only (EXAMINE) and IDLE is restarted every REIDLE_INTERVAL
+    seconds. When IDLE starts and on every batch of updates of the mailbox (EXISTS, EXPUNGE,
+    FETCH...), the idling connections are refreshed (see Connection.refresh): they get the
+    updates from their own session, whose sequence numbers are the ones known by the client.
+    """
+
+    def __init__(self, hub, key, pool, acquire):
+        self.hub = hub
+        self.key = key
+        self.mailbox = key[1]
+        self.pool = pool
+        self.acquire = acquire
+        self.subscribers = set()
+        self.left = time.monotonic() # Time the last connection left, None while it has connections
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """ IDLE upstream until the watcher expired """
+
+        while not self.hub.expired(self):
+            try:
+                session = self.acquire()
+            except (imaplib.IMAP4.error, OSError, ValueError) as e:
+                print('[ERROR] Upstream IDLE of', self.mailbox, 'not opened:', e)
+                time.sleep(RETRY_DELAY)
+                continue
+
+            try:
+                self.watch(session.conn)
+            except (imaplib.IMAP4.error, OSError, ValueError) as e:
+                print('[ERROR] Upstream IDLE of', self.mailbox, 'interrupted:', e)
+                self.pool.discard(session)
+                continue
+            self.pool.release(session)
+            return
+
+    def watch(self, conn):
+        """ Examine the mailbox and IDLE until the watcher expired """
+
+        typ, data = conn.select(self.mailbox, readonly=True)
+        if typ != 'OK':
+            raise ValueError('Error while opening the upstream IDLE: ' + self.mailbox + ' not selected')
+
+        while True:
+            tag = conn._new_tag()
+            conn.send(tag + b' IDLE\r\n')
+            response = self.readline(conn)
+            while response.startswith(b'*'):
+                response = self.readline(conn)
+            if not response.startswith(b'+'):
+                raise ValueError('Error while opening the upstream IDLE: ' + response.decode('utf-8', 'replace'))
+
+            self.refresh() # Updates since the last command of the connections
+            expired = self.wait_updates(conn, time.monotonic() + REIDLE_INTERVAL)
+
+            conn.send(b'DONE\r\n')
+            response = self.readline(conn)
+            while not response.startswith(tag + b' '):
+                response = self.readline(conn)
+            conn.tagged_commands.pop(tag, None)
+
+            if expired:
+                return
+
+    def wait_updates(self, conn, deadline):
+        """ Refresh the connections on the updates until the deadline (False) or the expiration of the watcher (True) """
+
+        while True:
+            timeout = min(deadline - time.monotonic(), LINGER)
+            if timeout <= 0:
+                return False
+            if not (received(conn.sock, conn.file) or select.select([conn.sock], [], [], timeout)[0]):
+                if self.hub.expired(self):
+                    return True
+                continue
+
+            # Updates received at once are sent in one refresh
+            updated = False
+            while True:
+                updated = Update.match(self.readline(conn)) is not None or updated
+                if not received(conn.sock, conn.file):
+                    break
+            if updated:
+                self.refresh()
+
+    def readline(self, conn):
+        """ Return the next line of the server, without the literals it announces """
+
+        first = line = conn.readline()
+        literal = literal_size(line)
+        while literal:
+            conn.read(literal[0])
+            line = conn.readline()
+            literal = literal_size(line)
+        if not line:
+            raise ConnectionResetError('Connection closed by the server')
+        return first
+
+    def refresh(self):
+        """ Send the updates of the mailbox to the idling connections """
+        for connection in self.hub.subscribers(self):
+            connection.refresh()
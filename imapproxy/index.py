@@ -0,0 +1,83 @@
+"""
+    Index of the uids known to be sanitized, per mailbox
+"""
+
+import threading, sqlite3
+from .helpers import SequenceSet
+
+# Maximum time (in seconds) to wait for the database locked by another process
+DB_TIMEOUT = 30
+
+class SanitizedIndex:
+
+    r""" Uids known to be sanitized, keyed by (account, mailbox, UIDVALIDITY).
+
+    Instantiate with: SanitizedIndex([path])
+
+            path - Path of a sqlite database keeping the index across restarts (default: None)
+
+    A uid is known when the server returned its email sanitized (or its original was
+    sanitized and moved away). Uids are kept as a SequenceSet. The uids of a mailbox are forgotten when its UIDVALIDITY changes.
+
+    With a path, the index is shared by the worker processes of the proxy: the uids of a
+    mailbox are read again from the database before being checked or extended.
+    """
+
+    def __init__(self, path=None):
+        self.mailboxes = {} # (account, mailbox) -> (uidvalidity, SequenceSet)
+        self.lock = threading.Lock()
+
+        self.db = None
+        if path:
+            # Transactions are explicit (see add), writers of other processes are waited for
+            self.db = sqlite3.connect(path, timeout=DB_TIMEOUT, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS sanitized_uids '
+                '(account TEXT, mailbox TEXT, uidvalidity INTEGER, uids TEXT, PRIMARY KEY (account, mailbox))')
+
+    def load(self, account, mailbox):
+        """ Read the uids of the mailbox from the database (lock held) """
+        row = self.db.execute('SELECT uidvalidity, uids FROM sanitized_uids WHERE account = ? AND mailbox = ?',
+            (account, mailbox)).fetchone()
+        if row:
+            uidvalidity, uids = row
+            self.mailboxes[(account, mailbox)] = (uidvalidity, SequenceSet.parse(uids) if uids else SequenceSet())
+
+    def known(self, account, mailbox, uidvalidity):
+        """ Return the SequenceSet of known uids of the mailbox (lock held) """
+        entry = self.mailboxes.get((account, mailbox))
+        if not entry or entry[0] != uidvalidity:
+            return SequenceSet()
+        return entry[1]
+
+    def missing(self, account, mailbox, uidvalidity, uids):
+        """ Return the SequenceSet of uids among the given SequenceSet which are not known """
+        with self.lock:
+            if self.db:
+                self.load(account, mailbox)
+            return uids - self.known(account, mailbox, uidvalidity)
+
+    def add(self, account, mailbox, uidvalidity, uids):
+        """ Record the given SequenceSet of uids as known.
+        The previous uids are dropped if the UIDVALIDITY of the mailbox changed. """
+
+        if not uids:
+            return
+
+        with self.lock:
+            if not self.db:
+                self.mailboxes[(account, mailbox)] = (uidvalidity, self.known(account, mailbox, uidvalidity) | uids)
+                return
+
+            # Read, extend and write in one transaction: uids added by other processes are kept
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.load(account, mailbox)
+                known = self.known(account, mailbox, uidvalidity) | uids
+                self.mailboxes[(account, mailbox)] = (uidvalidity, known)
+                self.db.execute('INSERT OR REPLACE INTO sanitized_uids VALUES (?, ?, ?, ?)',
+                    (account, mailbox, uidvalidity, str(known)))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
@@ -0,0 +1,229 @@
+"""
+    Metrics of the proxy, served over HTTP in the Prometheus text format
+"""
+
+import threading, bisect
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Default port of the metrics endpoint
+METRICS_PORT = 9143
+
+# Upper bounds (in seconds) of the buckets of the histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Commands counted under their own name, the others are counted as 'other'
+KNOWN_COMMANDS = frozenset((
+    'append', 'authenticate', 'capability', 'check', 'close', 'copy', 'create', 'delete', 'enable',
+    'examine', 'expunge', 'fetch', 'getquota', 'getquotaroot', 'id', 'idle', 'list', 'login', 'logout',
+    'lsub', 'move', 'namespace', 'noop', 'rename', 'search', 'select', 'setquota', 'sort', 'starttls',
+    'status', 'store', 'subscribe', 'thread', 'unselect', 'unsubscribe', 'xlist', 'compress'
+))
+
+# The hot paths only measure when ENABLED is True (set by serve): a disabled proxy
+# pays one attribute lookup per check
+ENABLED = False
+
+# Metrics by name, in the order of the output
+REGISTRY = {}
+
+class Metric:
+
+    r""" Metric with optional labels.
+
+    Instantiate with: Counter(name, help[, labels]), Gauge(...) or Histogram(...)
+
+            name - Name of the metric
+            help - Description of the metric
+            labels - Names of the labels (default: ()), the values are given as a tuple
+                to inc(), dec(), set() or observe()
+
+    The metric is added to the REGISTRY.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} # label values -> value
+        self.lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def samples(self):
+        """ Return [(suffix, {label: value}, value)] """
+        with self.lock:
+            return [('', dict(zip(self.labels, labels)), value) for labels, value in self.values.items()]
+
+    def render(self):
+        """ Return the lines of the metric in the text format """
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(labels), format_value(value)))
+        return lines
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(BUCKETS) + 1), 0, 0] # counts per bucket, sum, count
+            entry[0][bisect.bisect_left(BUCKETS, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                labels = dict(zip(self.labels, labels))
+                cumulative = 0
+                for bound, n in zip(BUCKETS + (float('inf'),), counts):
+                    cumulative += n
+                    samples.append(('_bucket', dict(labels, le=format_value(bound)), cumulative))
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, count))
+        return samples
+
+class Callback(Metric):
+
+    r""" Metric read from the proxy when the metrics are scraped.
+
+    Instantiate with: Callback(name, help, kind, function[, labels])
+
+            kind - 'gauge' or 'counter'
+            function - Function returning {label values: value}
+    """
+
+    def __init__(self, name, help, kind, function, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.kind = kind
+        self.function = function
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception as e:
+            print('[ERROR] Metric', self.name, 'unavailable:', e)
+            return []
+        return [('', dict(zip(self.labels, labels)), value) for labels, value in values.items()]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels.items()) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    """ Return all the metrics in the text format """
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+#       Metrics of the proxy
+
+CONNECTIONS = Gauge('imapproxy_connections', 'Client connections currently opened')
+CONNECTIONS_TOTAL = Counter('imapproxy_connections_total', 'Client connections accepted')
+CONNECTIONS_REJECTED = Counter('imapproxy_connections_rejected_total',
+    'Client connections refused because the proxy serves max_client clients')
+COMMANDS = Counter('imapproxy_commands_total', 'Commands received from the clients', ('command',))
+COMMAND_SECONDS = Histogram('imapproxy_command_seconds', 'Time to complete a command, '
+    'spent waiting for the server (upstream) or in the proxy and its modules (proxy)', ('command', 'side'))
+PIPELINED_COMMANDS = Counter('imapproxy_pipelined_commands_total',
+    'Commands sent to the server before the completion of the previous ones')
+BYTES = Counter('imapproxy_bytes_total', 'Bytes received from (in) and sent to (out) the clients and the servers',
+    ('peer', 'direction'))
+COMPRESSED_BYTES = Counter('imapproxy_compressed_bytes_total',
+    'Bytes of the compressed connections (COMPRESS=DEFLATE) on the wire, counted decompressed by imapproxy_bytes_total',
+    ('peer', 'direction'))
+UPSTREAM_CONNECT_SECONDS = Histogram('imapproxy_upstream_connect_seconds',
+    'Time to get an authenticated upstream session (connection and login, or session of the pool)')
+TLS_HANDSHAKE_SECONDS = Histogram('imapproxy_tls_handshake_seconds',
+    'Time of the SSL/TLS handshakes with the clients, full or resumed', ('session',))
+TLS_HANDSHAKE_FAILURES = Counter('imapproxy_tls_handshake_failures_total',
+    'SSL/TLS handshakes with the clients failed or timed out')
+SANITIZE_QUEUE = Gauge('imapproxy_sanitize_queue', 'Emails waiting for a worker or being sanitized')
+SANITIZE_SECONDS = Histogram('imapproxy_sanitize_seconds', 'Time to sanitize an email in a worker process')
+PROCESS_EMAIL_SECONDS = Histogram('imapproxy_process_email_seconds',
+    'Time to replace an email by its sanitized copy on the server')
+MISP_FORWARD_SECONDS = Histogram('imapproxy_misp_forward_seconds',
+    'Time between the queuing of an email for MISP and its sending')
+
+# Labels of BYTES and COMPRESSED_BYTES
+CLIENT_IN, CLIENT_OUT = ('client', 'in'), ('client', 'out')
+SERVER_IN, SERVER_OUT = ('server', 'in'), ('server', 'out')
+
+def command_label(command):
+    """ Return the label of a command of a client (bounded set of values) """
+    return command if command in KNOWN_COMMANDS else 'other'
+
+def observe_command(command, elapsed, upstream):
+    """ Count a command and record its time (in seconds), upstream being the part spent
+    waiting for the server """
+    command = command_label(command)
+    COMMANDS.inc((command,))
+    COMMAND_SECONDS.observe(upstream, (command, 'upstream'))
+    COMMAND_SECONDS.observe(max(0, elapsed - upstream), (command, 'proxy'))
+
+def count_bytes(labels, parts):
+    """ Count the bytes of the parts (bytes or memoryviews) """
+    BYTES.inc(labels, sum(len(part) for part in parts))
+
+#       Endpoint
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port=METRICS_PORT, host=''):
+    """ Enable the instrumentation and serve the metrics on http://host:port/metrics in a background thread """
+    global ENABLED
+    server = MetricsServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ENABLED = True
+    return server
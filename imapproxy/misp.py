@@ -3,10 +3,14 @@
     Forward to MISP the emails moved to MISP mailfolder
 """
 
-import re, imaplib, smtplib, email
+import re
 from email.message import EmailMessage
 from email import message_from_bytes
-from .helpers import parse_ids
+from .helpers import parse_fetch
+from .outbox import Outbox
+from .scheduler import scheduler
+from .modules import Module
+from . import metrics
 
 # MISP client mailbox (should be created in client side)
 MISP_FOLDER = '\"MISP\"'
@@ -21,69 +25,81 @@ DST_ADDR = 'mail2misp@freeblind.net'
 Move_MISP = re.compile(r'\A(?P<tag>[A-Z0-9]+)'
     r'(\s(UID))?'
     r'\s(MOVE)'
-    r'\s(?P<ids>[0-9:,]+)'
+    r'\s(?P<ids>[0-9:,*]+)'
     r'\s' + re.escape(MISP_FOLDER), flags=re.IGNORECASE)
 
 # Message data used to get the entire mail
-MSG_DATA = 'BODY.PEEK[]'
+MSG_DATA = '(UID BODY.PEEK[])'
 
-def process(client):
+# Spool directory of the emails waiting to be sent to MISP
+QUEUE_PATH = 'misp_queue'
+
+# Queue of the emails to forward (created on first use or by configure)
+OUTBOX = None
+
+def configure(queue_path=QUEUE_PATH, server=MISP_SERVER):
+    """ Create the queue of the emails forwarded to the given MISP server (see Outbox) """
+    global OUTBOX
+    OUTBOX = Outbox(queue_path, server, build_email)
+    metrics.Callback('imapproxy_misp_queue', 'Emails waiting to be forwarded to MISP',
+        'gauge', lambda: {(): OUTBOX.size()})
+
+def outbox():
+    """ Return the queue of the emails to forward """
+    if OUTBOX is None:
+        configure()
+    return OUTBOX
+
+def process(client, match):
     """ Apply the MISP module when an email is moved to the MISP mailbox
 
         client - Connection object
+        match - Match of the request with Move_MISP
 
     """
 
     request = client.request
-    match = Move_MISP.match(request)
     conn_server = client.conn_server
     folder = client.current_folder
 
     uidc = True if (('UID' in request) or ('uid' in request)) else False
 
-    match = Move_MISP.match(request) 
-    if not match: return 
     ids = match.group('ids')
 
-    
-    if ids.isdigit():
-        # Only one email
+    with scheduler().slot(client.account, conn_server.host):
         forward_to_misp(ids, conn_server, folder, uidc)
-    else:
-        # Multiple emails
-        for id in parse_ids(ids):
-            forward_to_misp(str(id), conn_server, folder, uidc)
 
-def forward_to_misp(id, conn_server, folder, uidc):
-    """ Forward an email to MISP.
+def forward_to_misp(ids, conn_server, folder, uidc):
+    """ Queue the emails to forward to MISP. They are sent in background.
 
-        id - String containing the id of the email to forward;
+        ids - String containing the ids of the emails to forward ('*' resolved by the server);
         conn_server - imaplib connection to the server;
         folder - Current folder of the client;
         uidc - True if command contains UID flag
 
     """
 
-    # Fetch the entire email
+    # Fetch all the emails at once
     conn_server.select(folder)
-    result, response = conn_server.uid('fetch', id, MSG_DATA) if uidc else conn_server.fetch(id, MSG_DATA)
-
-    if result == 'OK' and response != [b'The specified message set is invalid.'] and response != [None]:
-        bmail = message_from_bytes(response[0][1])
-    else:
+    result, response = conn_server.uid('fetch', ids, MSG_DATA) if uidc else conn_server.fetch(ids, MSG_DATA)
+    if result != 'OK':
         return
 
-    # Initialize an email containing the moved email in attachment
+    for uid, bmail in parse_fetch(response).items():
+        if bmail:
+            outbox().put(bmail)
+
+def build_email(bmail):
+    """ Return an email containing the raw email (in bytes) in attachment """
+
     msg = EmailMessage()
     msg['Subject'] = SUBJECT
     msg['From'] = SRC_ADDR
     msg['To'] = DST_ADDR
 
     msg.set_content(BODY)
-    msg.add_attachment(bmail, filename=FILENAME)
+    msg.add_attachment(message_from_bytes(bmail), filename=FILENAME)
 
-    s = smtplib.SMTP(MISP_SERVER)
-    s.send_message(msg)
-    s.quit()
+    return msg
 
-    print('Sent !')
\ No newline at end of file
+MODULE = Module('misp', ('move',), process, Move_MISP)
@@ -0,0 +1,106 @@
+"""
+    Registry of the modules of the proxy: the commands and mailboxes each module is called for,
+    compiled into one dispatch table (see configure and the [modules] section of imapproxy.conf)
+"""
+
+import re, importlib
+
+# Modules enabled by default, in the order they are called
+MODULES = ('pycircleanmail', 'misp')
+
+# Python modules of the modules of the proxy, by name. Other modules are enabled
+# with the path of their Python module, which declares a Module in its MODULE variable.
+BUILTIN = {
+    'pycircleanmail': 'imapproxy.pycircleanmail',
+    'misp': 'imapproxy.misp'
+}
+
+# Any request
+Any_Request = re.compile('')
+
+# Enabled modules (set on first use or by configure)
+ENABLED = None
+# Command of the clients -> Modules called for it, in order
+DISPATCH = {}
+# Modules notified of the new emails
+NOTIFIED = ()
+
+class Module:
+
+    r""" Module of the proxy, declared by the MODULE variable of its Python module.
+
+    Instantiate with: Module(name[, commands[, process[, request[, folders[, notify]]]]])
+
+            name - Name of the module in the configuration file
+            commands - Commands of the clients (lowercase, without UID) the module is called for (default: ())
+            process - Function called with the Connection and the match of request before the command is
+                sent to the server, out of the event loop with the asyncio engine (default: None)
+            request - Compiled regular expression the request of the client must match (default: any request)
+            folders - Function returning False for the selected mailboxes the module skips (default: None, all)
+            notify - Function called with the Connection when the server announces new emails (EXISTS)
+                in the selected mailbox, in the connection (or event loop) thread: it must hand over
+                its work to a background thread (default: None)
+
+    The command waits for process, never for notify. A request which doesn't match or a mailbox
+    which is skipped costs one regular expression match, the module is not called.
+    """
+
+    def __init__(self, name, commands=(), process=None, request=Any_Request, folders=None, notify=None):
+        self.name = name
+        self.commands = tuple(command.lower() for command in commands)
+        self.process = process
+        self.request = request
+        self.folders = folders
+        self.notify = notify
+
+    def match(self, client):
+        """ Return the match of the request of the client, None if the module skips it """
+        if self.folders and not (client.current_folder and self.folders(client.current_folder)):
+            return None
+        return self.request.match(client.request)
+
+def load(name):
+    """ Return the Module of the given name (see BUILTIN) or Python module path """
+    try:
+        module = importlib.import_module(BUILTIN.get(name, name)).MODULE
+    except (ImportError, AttributeError) as e:
+        raise ValueError('Error while loading the module ' + name + ': ' + str(e))
+    if not isinstance(module, Module):
+        raise ValueError('Error while loading the module ' + name + ': MODULE is not a Module')
+    return module
+
+def configure(names=MODULES):
+    """ Enable the modules of the given names, in order, and compile the dispatch table """
+    global ENABLED, DISPATCH, NOTIFIED
+
+    enabled = tuple(load(name) for name in names)
+    dispatch = {}
+    for module in enabled:
+        if module.process:
+            for command in module.commands:
+                dispatch.setdefault(command, []).append(module)
+
+    ENABLED = enabled
+    DISPATCH = {command: tuple(modules) for command, modules in dispatch.items()}
+    NOTIFIED = tuple(module for module in enabled if module.notify)
+
+def enabled():
+    """ Return the enabled Modules """
+    if ENABLED is None:
+        configure()
+    return ENABLED
+
+def commands():
+    """ Return the commands some module is called for """
+    enabled()
+    return frozenset(DISPATCH)
+
+def hooks(command):
+    """ Return the Modules called for the command, in order (empty for the commands transmitted as they are) """
+    return DISPATCH.get(command, ())
+
+def notify(client):
+    """ Notify the modules that the server announced new emails in the selected mailbox """
+    for module in NOTIFIED:
+        if not module.folders or (client.current_folder and module.folders(client.current_folder)):
+            module.notify(client)
@@ -0,0 +1,136 @@
+"""
+    Durable queue of emails sent by SMTP in background
+"""
+
+import os, time, threading, smtplib, itertools, fcntl
+from . import metrics
+
+# Maximum number of emails sent in a row on the SMTP connection before checking the queue again
+BATCH = 50
+
+# The SMTP connection is closed after KEEPALIVE seconds without email to send
+KEEPALIVE = 60
+
+# Delay (in seconds) before the first retry and maximum delay between retries
+MIN_BACKOFF, MAX_BACKOFF = 1, 300
+
+class Outbox:
+
+    r""" Spool directory of raw emails sent by a background thread over one SMTP connection.
+
+    Instantiate with: Outbox(path, server, build)
+
+            path - Spool directory (created if needed). Emails are kept in path/new until sent,
+                and moved to path/failed if the server refuses them
+            server - Host of the SMTP server
+            build - Function returning the EmailMessage to send for a raw email (in bytes)
+
+    put() only writes the email in the spool, so it survives a restart of the proxy. The sender
+    reuses its SMTP connection while there are emails to send and retries with an exponential
+    backoff when the server is unreachable.
+
+    Several processes can share the spool: each email is locked (flock) while being sent,
+    so it is sent once, and the lock is released if its sender dies.
+    """
+
+    def __init__(self, path, server, build):
+        self.server = server
+        self.build = build
+        self.new = os.path.join(path, 'new')
+        self.tmp = os.path.join(path, 'tmp')
+        self.failed = os.path.join(path, 'failed')
+        for directory in (self.new, self.tmp, self.failed):
+            os.makedirs(directory, exist_ok=True)
+
+        self.counter = itertools.count()
+        self.event = threading.Event()
+        self.smtp = None
+        self.event.set() # Emails left by a previous run
+        threading.Thread(target=self.send_forever, daemon=True).start()
+
+    def put(self, bmail):
+        """ Queue a raw email (in bytes) """
+
+        # Names are sorted in the order of arrival
+        name = '%020d.%d.%d.eml' % (time.time_ns(), os.getpid(), next(self.counter))
+        tmp_path = os.path.join(self.tmp, name)
+        with open(tmp_path, 'wb') as f:
+            f.write(bmail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.new, name)) # Atomic: the sender never sees a partial email
+
+        self.event.set()
+
+    def send_forever(self):
+        """ Send the queued emails, wait for new ones and close the idle connection """
+
+        backoff = MIN_BACKOFF
+        while True:
+            if not self.event.wait(KEEPALIVE):
+                self.close()
+                continue
+            self.event.clear()
+
+            try:
+                while self.send_batch():
+                    pass
+                backoff = MIN_BACKOFF
+            except (smtplib.SMTPException, OSError) as e:
+                print('[ERROR] Sending to', self.server, 'failed, retry in', backoff, 's:', e)
+                self.close()
+                time.sleep(backoff)
+                backoff = min(2 * backoff, MAX_BACKOFF)
+                self.event.set()
+
+    def send_batch(self):
+        """ Send up to BATCH queued emails and return True if emails remain """
+
+        names = sorted(os.listdir(self.new))
+        for name in names[:BATCH]:
+            path = os.path.join(self.new, name)
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue # Sent by another process
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # Being sent by another process
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue # Sent by another process meanwhile
+                msg = self.build(f.read())
+
+                if not self.smtp:
+                    self.smtp = smtplib.SMTP(self.server)
+
+                try:
+                    self.smtp.send_message(msg)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    if getattr(e, 'smtp_code', 500) < 500:
+                        raise # Temporary error: retry later
+                    print('[ERROR] Email refused by', self.server, ':', e)
+                    os.rename(path, os.path.join(self.failed, name))
+                    continue
+
+                os.remove(path) # Before the lock is released
+            print('Sent !')
+            if metrics.ENABLED:
+                # The name starts with the time of arrival (in ns)
+                metrics.MISP_FORWARD_SECONDS.observe(max(0, time.time() - int(name.split('.')[0]) / 1e9))
+
+        return len(names) > BATCH
+
+    def size(self):
+        """ Return the number of emails waiting to be sent """
+        return len(os.listdir(self.new))
+
+    def close(self):
+        """ Close the SMTP connection """
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
@@ -0,0 +1,262 @@
+"""
+    Pool of authenticated upstream sessions, shared by the connections of a same account
+"""
+
+import os, time, threading, hashlib, hmac, imaplib
+from collections import deque
+
+# Default maximum number of upstream sessions opened per account
+MAX_SESSIONS = 10
+
+# Default maximum number of upstream sessions opened on a host (all its accounts)
+MAX_HOST_SESSIONS = 100
+
+# Idle sessions are logged out after IDLE_TIMEOUT seconds
+IDLE_TIMEOUT = 300
+
+# Idle sessions are checked with a NOOP every CHECK_INTERVAL seconds
+CHECK_INTERVAL = 60
+
+# Maximum time (in seconds) to wait for a session when an account reached its cap
+WAIT_TIMEOUT = 30
+
+# Credentials are only kept as HMAC with a random key of the process
+SALT = os.urandom(16)
+
+# Mailbox examined to leave the selected state on the servers without UNSELECT (see unselect)
+NO_MAILBOX = '"IMAProxy/Unselect"'
+
+imaplib.Commands.setdefault('UNSELECT', ('SELECTED',)) # Python < 3.9
+
+class Session:
+
+    r""" Upstream session handed over by the pool.
+
+    Instantiate with: Session(key, conn)
+
+            key - Account of the session: (host, username, credential hash)
+            conn - Authenticated imaplib connection
+    """
+
+    __slots__ = ('key', 'conn', 'last_used', 'last_checked')
+
+    def __init__(self, key, conn):
+        self.key = key
+        self.conn = conn
+        self.last_used = self.last_checked = time.monotonic()
+
+class SessionPool:
+
+    r""" Pool of upstream sessions keyed by (host, username, credential hash).
+
+    Instantiate with: SessionPool([max_sessions[, idle_timeout[, check_interval[, max_host_sessions]]]])
+
+            max_sessions - Maximum number of sessions opened per account (default: MAX_SESSIONS)
+            idle_timeout - Idle sessions are logged out after idle_timeout seconds (default: IDLE_TIMEOUT)
+            check_interval - Idle sessions are checked with a NOOP every check_interval seconds (default: CHECK_INTERVAL)
+            max_host_sessions - Maximum number of sessions opened on a host (default: MAX_HOST_SESSIONS)
+
+    acquire() returns an idle session of the account if there is one, without any round trip,
+    or opens a new one. release() resets the session to the unselected state and keeps it
+    for the next connection. A background thread logs out the expired sessions and checks
+    the others, so that acquire() only hands over healthy sessions. When a host reached its
+    cap, the least recently used idle session of another account is logged out for a new one.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT, check_interval=CHECK_INTERVAL,
+            max_host_sessions=MAX_HOST_SESSIONS):
+        self.max_sessions = max_sessions
+        self.max_host_sessions = max_host_sessions
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.idle = {} # account -> deque of idle sessions (most recently used on the right)
+        self.opened = {} # account -> number of opened sessions
+        self.hosts = {} # host -> number of opened sessions
+        self.wakers = [] # Functions called on the next release (see take)
+        self.lock = threading.Condition()
+
+        threading.Thread(target=self.maintain, daemon=True).start()
+
+    def account(self, host, username, password):
+        """ Return the key of the account """
+        digest = hmac.new(SALT, password.encode('utf-8'), hashlib.sha256).hexdigest()
+        return (host, username, digest)
+
+    def acquire(self, host, username, password, connect):
+        """ Return a Session of the account, connect(host, username, password) being called
+        to open and authenticate a new imaplib connection if no session is idle """
+
+        key = self.account(host, username, password)
+        deadline = time.monotonic() + WAIT_TIMEOUT
+
+        with self.lock:
+            while True:
+                taken = self.take(key)
+                if taken:
+                    break
+
+                # The account or the host reached its cap: wait for a released session
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    raise ValueError('Error while connecting to the server: '
+                        + 'Too many sessions opened for ' + username)
+
+        session, evicted = taken
+        return session or self.open(key, evicted, connect, host, username, password)
+
+    def take(self, key, wake=None):
+        """ Take a session of the account without waiting. Return (idle Session, None), or (None,
+        idle Session evicted or None) if a new session can be opened (see open), or None if the
+        account or the host reached its cap: wake() is then called when a session is released. """
+
+        host = key[0]
+        with self.lock:
+            sessions = self.idle.get(key)
+            if sessions:
+                return sessions.pop(), None
+
+            if self.opened.get(key, 0) < self.max_sessions:
+                if self.hosts.get(host, 0) < self.max_host_sessions:
+                    self.hosts[host] = self.hosts.get(host, 0) + 1
+                    self.opened[key] = self.opened.get(key, 0) + 1
+                    return None, None
+                # Its slot on the host goes to the new session
+                evicted = self.evict(host)
+                if evicted:
+                    self.opened[key] = self.opened.get(key, 0) + 1
+                    return None, evicted
+
+            if wake:
+                self.wakers.append(wake)
+            return None
+
+    def open(self, key, evicted, connect, host, username, password):
+        """ Return a new Session of the account taken by take, after logging out the session evicted """
+        if evicted:
+            self.logout(evicted.conn)
+        try:
+            return Session(key, connect(host, username, password))
+        except Exception:
+            self.closed(key)
+            raise
+
+    def evict(self, host):
+        """ Take the least recently used idle session of the host out of the pool, or return None (lock held) """
+
+        oldest = None
+        for key, sessions in self.idle.items():
+            if key[0] == host and (oldest is None or sessions[0].last_used < oldest.last_used):
+                oldest = sessions[0]
+        if oldest is None:
+            return None
+
+        self.idle[oldest.key].popleft()
+        if not self.idle[oldest.key]:
+            del self.idle[oldest.key]
+        self.opened[oldest.key] -= 1
+        if not self.opened[oldest.key]:
+            del self.opened[oldest.key]
+        return oldest
+
+    def release(self, session, selected=True):
+        """ Give back a session that has no command in progress.
+        If a mailbox may be selected, it is unselected first. """
+
+        if selected and not self.unselect(session.conn):
+            self.discard(session)
+            return
+
+        # Responses and tags of the commands sent by the proxy behind imaplib
+        session.conn.untagged_responses.clear()
+        session.conn.tagged_commands.clear()
+        session.last_used = time.monotonic()
+        with self.lock:
+            self.idle.setdefault(session.key, deque()).append(session)
+            self.wake()
+
+    def discard(self, session):
+        """ Close a session that can't be reused """
+        self.logout(session.conn)
+        self.closed(session.key)
+
+    def closed(self, key):
+        """ Forget a session of the account """
+        with self.lock:
+            self.opened[key] -= 1
+            if not self.opened[key]:
+                del self.opened[key]
+            self.hosts[key[0]] -= 1
+            if not self.hosts[key[0]]:
+                del self.hosts[key[0]]
+            self.wake()
+
+    def wake(self):
+        """ Wake up the threads and call the functions waiting for a session (lock held) """
+        self.lock.notify_all()
+        wakers, self.wakers = self.wakers, []
+        for wake in wakers:
+            wake()
+
+    def stats(self):
+        """ Return the number of busy and idle sessions of all the accounts (see metrics) """
+        with self.lock:
+            idle = sum(len(sessions) for sessions in self.idle.values())
+            return {('busy',): sum(self.opened.values()) - idle, ('idle',): idle}
+
+    def maintain(self):
+        """ Log out the expired idle sessions and check the others with a NOOP """
+
+        while True:
+            time.sleep(min(self.check_interval, self.idle_timeout))
+            now = time.monotonic()
+
+            # Take the sessions to expire or to check out of the pool
+            expired, to_check = [], []
+            with self.lock:
+                for key, sessions in list(self.idle.items()):
+                    for session in list(sessions):
+                        if now - session.last_used > self.idle_timeout:
+                            expired.append(session)
+                            sessions.remove(session)
+                        elif now - session.last_checked > self.check_interval:
+                            to_check.append(session)
+                            sessions.remove(session)
+                    if not sessions:
+                        del self.idle[key]
+
+            for session in expired:
+                self.discard(session)
+
+            for session in to_check:
+                try:
+                    session.conn.noop()
+                except (imaplib.IMAP4.error, OSError):
+                    self.discard(session)
+                    continue
+                session.last_checked = time.monotonic()
+                with self.lock:
+                    self.idle.setdefault(session.key, deque()).appendleft(session)
+                    self.wake()
+
+    def unselect(self, conn):
+        """ Return True if the connection is back in the authenticated state: with UNSELECT or,
+        if the server doesn't support it, with the EXAMINE of a mailbox which doesn't exist
+        (a failed EXAMINE deselects the mailbox, unlike CLOSE it expunges nothing) """
+        conn.state = 'SELECTED' # The proxy may have selected a mailbox behind imaplib
+        try:
+            if 'UNSELECT' in conn.capabilities:
+                unselected = conn._simple_command('UNSELECT')[0] == 'OK'
+            else:
+                unselected = conn._simple_command('EXAMINE', NO_MAILBOX)[0] == 'NO'
+        except (imaplib.IMAP4.error, OSError):
+            return False
+        if unselected:
+            conn.state = 'AUTH'
+        return unselected
+
+    def logout(self, conn):
+        """ Log out without raising """
+        try:
+            conn.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
@@ -0,0 +1,74 @@
+"""
+    Background sanitization of new emails, before the client fetches them
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .scheduler import TokenBucket
+
+# Default maximum number of mailboxes sanitized at the same time (all accounts)
+WORKERS = 4
+
+# Default number of background runs per second for an account
+RATE = 0.2
+
+# Default number of background runs an account can make in a row
+BURST = 2
+
+class Presanitizer:
+
+    r""" Run the sanitization of mailboxes in background threads.
+
+    Instantiate with: Presanitizer(run[, workers[, rate[, burst]]])
+
+            run - Function called with the arguments given to notify
+            workers - Maximum number of runs at the same time, for all accounts (default: WORKERS)
+            rate - Number of runs per second allowed for an account (default: RATE)
+            burst - Number of runs an account can make in a row (default: BURST)
+
+    Notifications for a mailbox which is already waiting are merged into one run. When an
+    account exceeds its rate, its run is delayed until a token is available.
+    """
+
+    def __init__(self, run, workers=WORKERS, rate=RATE, burst=BURST):
+        self.run = run
+        self.rate = rate
+        self.burst = burst
+        self.executor = ThreadPoolExecutor(workers)
+        self.buckets = {} # account -> TokenBucket
+        self.waiting = set() # (account, mailbox) waiting to be run
+        self.lock = threading.Lock()
+
+    def notify(self, account, mailbox, *args):
+        """ Schedule a run of run(*args) for the mailbox of the account """
+
+        with self.lock:
+            if (account, mailbox) in self.waiting:
+                return
+            self.waiting.add((account, mailbox))
+
+            bucket = self.buckets.setdefault(account, TokenBucket(self.rate, self.burst))
+            delay = bucket.take()
+            if delay:
+                bucket.tokens -= 1 # Token reserved for the delayed run
+
+        if delay:
+            timer = threading.Timer(delay, self.submit, (account, mailbox, args))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.submit(account, mailbox, args)
+
+    def submit(self, account, mailbox, args):
+        self.executor.submit(self.execute, account, mailbox, args)
+
+    def execute(self, account, mailbox, args):
+        """ Run for the mailbox. Later notifications wait for a new run. """
+
+        with self.lock:
+            self.waiting.discard((account, mailbox))
+
+        try:
+            self.run(*args)
+        except Exception as e:
+            print('[ERROR] Background sanitization of', mailbox, 'failed:', e)
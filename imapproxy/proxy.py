@@ -2,19 +2,43 @@
     Implementation of the proxy
 """
 
-import sys, socket, ssl, re, base64, threading, argparse, imaplib
-
-from .pycircleanmail import process as pycircleanmail_module
-from .misp import process as misp_module
+import sys, socket, ssl, re, base64, threading, argparse, imaplib, functools, time, signal, asyncio
+
+from .helpers import refresh_capabilities
+from .framing import IMAPReader, literal_size, received
+from .pool import SessionPool, MAX_SESSIONS, MAX_HOST_SESSIONS
+from .fetchcache import process as fetchcache_module, message_cache
+from .scheduler import Unavailable
+from . import metrics, modules
+from .tracer import tracer as get_tracer, CLIENT_IN, CLIENT_OUT, SERVER_OUT, SERVER_IN
+from .tls import ServerContext, handshake
+from .idle import IdleHub, Watcher
+from .compress import LEGS, Deflater, negotiate, inflating_file, compress_imaplib
 
 # Default key to verify integrity of emails modified by the proxy
 DEFAULT_KEY = 'secret-proxy'
 
 # Default maximum number of client supported by the proxy
-MAX_CLIENT = 5  
+MAX_CLIENT = 500
+
+# Response to the clients connecting when the proxy serves max_client clients
+TOO_MANY_CLIENTS = '* BYE [UNAVAILABLE] Too many clients, try again later'
 
 # Default ports
 IMAP_PORT, IMAP_SSL_PORT = 143, 993
+
+# Connection engines: one thread per client or one event loop for all clients
+ENGINES = ('thread', 'asyncio')
+
+# Maximum time (in seconds) given to the running commands to complete after SIGTERM
+DRAIN_TIMEOUT = 30
+# Interval (in seconds) between two checks of the connections being drained
+DRAIN_INTERVAL = 0.1
+
+# Maximum number of commands of a client sent to the server before waiting for their completion
+# (1 disables the pipelining)
+PIPELINE_DEPTH = 32
+
 CRLF = b'\r\n'
 
 # Tagged request from the client
@@ -28,6 +52,9 @@ Tagged_Response= re.compile(r'\A(?P<tag>[A-Z0-9]+)'
     r'(\s\[(?P<flags>.*)\])?'
     r'\s(?P<command>[A-Z]*)', flags=re.IGNORECASE)
 
+# UIDVALIDITY of the selected mailbox
+UIDValidity_Response = re.compile(rb'\* OK \[UIDVALIDITY (?P<uidvalidity>[0-9]+)\]', flags=re.IGNORECASE)
+
 # Capabilities of the proxy
 CAPABILITIES = ( 
     'IMAP4',
@@ -41,7 +68,7 @@ CAPABILITIES = (
     'NAMESPACE'
 )
 
-# Authorized domain addresses with their corresponding host
+# Authorized domain addresses with their corresponding host ('host' or 'host:port')
 HOSTS = {
     'hotmail': 'imap-mail.outlook.com',
     'outlook': 'imap-mail.outlook.com',
@@ -50,173 +77,555 @@ HOSTS = {
     'dovecot': 'dovecot.travis.dev' # for Travis-CI
 }
 
-# Intercepted commands
+# Commands intercepted by the proxy (and the commands of the modules, see dispatch_table)
 COMMANDS = (
     'authenticate',
     'capability',
     'login',
     'logout',
+    'starttls',
     'select',
-    'move',
-    'fetch'
+    'idle',
+    'compress'
 )
 
+# Dispatch tables of the connection classes, by enabled modules (see dispatch_table)
+DISPATCH_TABLES = {}
+
 class IMAP_Proxy:
     
     r""" Implementation of the proxy.
 
-    Instantiate with: IMAP_Proxy([port[, host[, certfile[, key[, max_client[, verbose[, ipv6]]]]]]])
+    Instantiate with: IMAP_Proxy([port[, host[, certfile[, key[, max_client[, verbose[, ipv6[, engine[, max_sessions[, metrics_port[, workers[, setup[, reuse_port[, starttls[, compress[, max_host_sessions]]]]]]]]]]]]]]]])
 
             port - port number (default: None. Standard IMAP4 / IMAP4 SSL port will be selected);
             host - host's name (default: localhost);
             certfile - PEM formatted certificate chain file (default: None);
                 Note: if certfile is provided, the connection will be secured over
-                SSL/TLS. Otherwise, it won't be secured.
+                SSL/TLS. Otherwise, it won't be secured. The certificate is reloaded
+                when the file changes (see tls.ServerContext).
             key - Key used to verify the integrity of emails append by the proxy (default: 'secret-proxy')
             max_client - Maximum number of client supported by the proxy (default: global variable MAX_CLIENT);
-            verbose - Display the IMAP payload (default: False)
+                the next clients are disconnected (with TOO_MANY_CLIENTS in plain text) until one leaves.
+                With workers > 1, the maximum of each worker process
+            verbose - Trace the IMAP payload with the tracer of the proxy (default: False, see tracer.configure)
             ipv6 - Should be enabled if the ip of the proxy is IPv6 (default: False)
+            engine - 'thread' to serve each client in its own thread or 'asyncio' to serve
+                all clients as coroutines of one event loop (default: 'thread')
+            max_sessions - Maximum number of upstream sessions per account, kept in a pool and reused
+                by the next connections of the account (default: MAX_SESSIONS, 0 disables the pool)
+            metrics_port - Serve the metrics of the proxy on http://host:metrics_port/metrics
+                (default: None, the metrics are disabled and not measured)
+            workers - Number of worker processes sharing the port, each running the proxy with
+                the given engine (default: 1, no worker process, see supervisor.Supervisor)
+            setup - Function called without argument before starting the proxy, in every worker
+                process, to configure the modules (default: None). Must be picklable with workers > 1
+            reuse_port - Bind the port with SO_REUSEPORT, set in the worker processes (default: False)
+            starttls - With a certfile, listen in plain text (default port: IMAP_PORT) and offer
+                STARTTLS to the clients instead of starting with SSL/TLS (default: False)
+            compress - Legs compressed with COMPRESS=DEFLATE when the peer asks for it or supports it:
+                'client' and/or 'server' (default: (), no compression)
+            max_host_sessions - Maximum number of upstream sessions kept in the pool for all the accounts
+                of a provider host (default: MAX_HOST_SESSIONS)
     
     The proxy listens on the given host and port and creates an object IMAP4_Client (or IMAP4_Client_SSL for
     secured connections) for each new client. These socket connections are asynchronous and non-blocking.
+
+    On SIGTERM, the proxy stops accepting clients, closes the connections between two commands
+    (with a BYE response) and stops once they are all closed, or after DRAIN_TIMEOUT seconds.
     """
 
-    def __init__(self, port=None, host='', certfile=None, key=DEFAULT_KEY, max_client=MAX_CLIENT, verbose=False, ipv6=False):
+    def __init__(self, port=None, host='', certfile=None, key=DEFAULT_KEY, max_client=MAX_CLIENT, verbose=False, ipv6=False, engine='thread', max_sessions=MAX_SESSIONS, metrics_port=None, workers=1, setup=None, reuse_port=False, starttls=False, compress=(), max_host_sessions=MAX_HOST_SESSIONS):
+        if workers and workers > 1:
+            from .supervisor import Supervisor
+            Supervisor(workers, setup, dict(port=port, host=host, certfile=certfile, key=key, max_client=max_client,
+                verbose=verbose, ipv6=ipv6, engine=engine, max_sessions=max_sessions, metrics_port=metrics_port,
+                starttls=starttls, compress=compress, max_host_sessions=max_host_sessions)).run()
+            return
+
+        if setup:
+            setup()
+        modules.enabled() # Loaded before the first client
+
         self.verbose = verbose
+        self.tracer = get_tracer() if verbose else None
         self.certfile = certfile
+        self.tls = ServerContext(certfile) if certfile else None # Shared by all the connections
+        self.starttls = starttls and self.tls is not None
         self.key = key
+        for leg in compress:
+            if leg not in LEGS:
+                raise ValueError('Unknown compressed leg ' + leg + ', should be one of: ' + ', '.join(LEGS))
+        self.compress = tuple(compress)
+        self.pool = SessionPool(max_sessions, max_host_sessions=max_host_sessions) if max_sessions else None
+        self.idle = IdleHub() if self.pool else None # Upstream IDLEs shared by the connections of an account
+        self.connections = set() # Connections opened with the clients
+        self.draining = False
+
+        if metrics_port:
+            if self.pool:
+                metrics.Callback('imapproxy_upstream_sessions', 'Upstream sessions opened (busy or idle in the pool)',
+                    'gauge', self.pool.stats, ('state',))
+                metrics.Callback('imapproxy_idle', 'Mailboxes in IDLE upstream and idling client connections',
+                    'gauge', self.idle.stats, ('kind',))
+            if self.tls:
+                metrics.Callback('imapproxy_tls_sessions', 'Session statistics of the SSL/TLS context (accept, hits...)',
+                    'counter', self.tls.stats, ('counter',))
+            metrics.serve(metrics_port)
 
         if not port: # Set default port
-            port = IMAP_SSL_PORT if certfile else IMAP_PORT
+            port = IMAP_SSL_PORT if self.tls and not self.starttls else IMAP_PORT
 
         if not max_client:
             max_client = MAX_CLIENT
+        self.clients = threading.BoundedSemaphore(max_client) # Taken by each connection
+
+        if not engine:
+            engine = ENGINES[0]
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine ' + engine + ', should be one of: ' + ', '.join(ENGINES))
 
         # IPv4 or IPv6
         addr_fam = socket.AF_INET6 if ipv6 else socket.AF_INET
         self.sock = socket.socket(addr_fam, socket.SOCK_STREAM)
+        if reuse_port: # Each worker process listens on the port
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             
         self.sock.bind(('', port))
         self.sock.listen(max_client)
-        self.listen()
+
+        if engine == 'asyncio':
+            self.listen_async()
+        else:
+            self.listen()
 
 
     def listen(self):
         """ Wait and create a new Connection for each new connection with a client. """
 
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
         while True:
             try:
                 ssock, addr = self.sock.accept()
-                if self.certfile: # Add SSL/TLS
-                    ssock = ssl.wrap_socket(ssock, certfile=self.certfile, server_side=True)
 
-                # Connect the proxy with the client
+                # Connect the proxy with the client (SSL/TLS handshake in its thread)
                 threading.Thread(target = self.new_connection, args = (ssock,)).start()
             except KeyboardInterrupt:
                 break
-            except ssl.SSLError as e:
+            except OSError:
+                if self.draining: # Socket closed by stop()
+                    break
                 raise
             
         if self.sock:
             self.sock.close()
 
+        if self.draining:
+            self.drain()
+
+    def stop(self):
+        """ Stop accepting clients and drain the connections (on SIGTERM) """
+        print('Draining', len(self.connections), 'connections')
+        self.draining = True
+        self.sock.close()
+
+    def drain(self):
+        """ Close the connections between two commands, and all of them after DRAIN_TIMEOUT seconds """
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.connections and time.monotonic() < deadline:
+            for connection in list(self.connections):
+                connection.close_idle()
+            time.sleep(DRAIN_INTERVAL)
+
+        for connection in list(self.connections):
+            connection.close()
+
+    def listen_async(self):
+        """ Serve all the clients from one event loop """
+        from .aio import run
+        run(self)
+
     def new_connection(self, ssock):
-        Connection(ssock, self.key, self.verbose)
+        if not self.clients.acquire(blocking=False):
+            self.reject(ssock)
+            return
+        try:
+            # Responses are small writes: don't delay them (Nagle) until the previous ones are acknowledged
+            ssock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.tls and not self.starttls: # Add SSL/TLS
+                try:
+                    ssock = handshake(ssock, self.tls.context())
+                except OSError as e:
+                    print('[ERROR] SSL/TLS handshake failed:', e)
+                    ssock.close()
+                    return
+
+            if metrics.ENABLED:
+                metrics.CONNECTIONS_TOTAL.inc()
+                metrics.CONNECTIONS.inc()
+            try:
+                Connection(ssock, self.key, self.tracer, self.pool, self.connections, self.tls if self.starttls else None,
+                    self.idle, self.compress)
+            finally:
+                if metrics.ENABLED:
+                    metrics.CONNECTIONS.dec()
+        finally:
+            self.clients.release()
+
+    def reject(self, ssock):
+        """ Disconnect a client over the max_client limit """
+        print('[ERROR] Too many clients, connection refused')
+        if metrics.ENABLED:
+            metrics.CONNECTIONS_REJECTED.inc()
+        if not self.tls or self.starttls: # No handshake just to say goodbye
+            try:
+                ssock.sendall((TOO_MANY_CLIENTS + '\r\n').encode())
+            except OSError:
+                pass
+        ssock.close()
+
+def split_hostname(hostname):
+    """ Return (host, port) of a host of HOSTS, given as 'host' or 'host:port' (default port: IMAP_SSL_PORT) """
+    if hostname.count(':') == 1:
+        host, port = hostname.split(':')
+        return host, int(port)
+    return hostname, IMAP_SSL_PORT
+
+def login_server(hostname, username, password, compress=False):
+    """ Return a new imaplib connection authenticated on the server, compressed
+    if compress is True and the server supports COMPRESS=DEFLATE """
+    conn_server = imaplib.IMAP4_SSL(*split_hostname(hostname))
+    # Pipelined commands are sent at once, not when the first one is acknowledged (Nagle)
+    conn_server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        conn_server.login(username, password)
+    except imaplib.IMAP4.error:
+        conn_server.shutdown()
+        raise
+    refresh_capabilities(conn_server)
+    if compress and negotiate(conn_server):
+        compress_imaplib(conn_server)
+    return conn_server
+
+def dispatch_table(cls):
+    """ Return the table command -> method of the connection class cls intercepting it: the commands
+    of the proxy, the commands some module is called for (see modules) and FETCH if the emails
+    fetched are cached. The other commands are transmitted as they are, and pipelined. """
+
+    key = (cls, modules.enabled(), message_cache() is not None)
+    table = DISPATCH_TABLES.get(key)
+    if table is None:
+        table = {command: getattr(cls, command) for command in COMMANDS}
+        for command in modules.commands():
+            table[command] = cls.module_command
+        if 'fetch' in table or message_cache():
+            table['fetch'] = cls.fetch
+        DISPATCH_TABLES[key] = table
+    return table
+
+def run_sync(coroutine):
+    """ Run a coroutine of a Connection to its end in the calling thread and return its result:
+    the I/O primitives of Connection block instead of suspending it """
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError('Error while running the connection: coroutine suspended')
+
+class BlockingReader:
+
+    r""" Coroutine methods of an IMAPReader (the ones of aio.AsyncIMAPReader), which block
+    instead of suspending the coroutine (see run_sync).
+
+    Instantiate with: BlockingReader(reader)
+
+            reader - framing.IMAPReader
+    """
 
-class Connection:
+    def __init__(self, reader):
+        self.reader = reader
 
-    r""" Implementation of a connection with a client.
+    async def read_message(self):
+        return self.reader.read_message()
 
-    Instantiate with: Connection([ssock[, verbose]])
+    async def read_rest(self):
+        return self.reader.read_rest()
 
-            socket - Socket (with or without SSL/TLS) with the client
-            verbose - Display the IMAP payload (default: False)
-    
-    Listens on the socket commands from the client.
+    async def read_line(self):
+        return self.reader.read_line()
+
+    async def read_chunks(self, size):
+        for chunk in self.reader.read_chunks(size):
+            yield chunk
+
+class BaseConnection:
+
+    r""" IMAP protocol of a connection with a client, shared by the engines.
+
+    Instantiate with: BaseConnection(key[, tracer[, pool[, tls[, idle[, compress]]]]]])
+
+            key - Key used to verify the integrity of emails append by the proxy
+            tracer - Tracer of the IMAP payload (default: None, no trace)
+            pool - SessionPool providing the upstream session (default: None, a new session is opened)
+            tls - ServerContext offered to the client with STARTTLS (default: None, no STARTTLS)
+            idle - IdleHub of the upstream IDLEs (default: None, IDLE is not advertised and transmitted to the server)
+            compress - Legs compressed with COMPRESS=DEFLATE: 'client' and/or 'server' (default: ())
+
+    The commands transmitted as they are to the server are pipelined: while the client has
+    more requests waiting, they are sent without waiting for the completion of the previous
+    ones (at most PIPELINE_DEPTH), and the completion responses are routed back with the tags
+    of the client. The commands intercepted by the proxy and its modules (see dispatch_table)
+    and the commands with a synchronizing literal wait for the completion of the previous ones.
+
+    IDLE is answered by the proxy: the connection is refreshed on the updates of one upstream
+    IDLE per mailbox of the account (see idle.IdleHub), instead of keeping its own session in IDLE.
+
+    COMPRESS=DEFLATE is negotiated independently on each leg: the literals are decompressed
+    and compressed again chunk by chunk while they are streamed.
+
+    The protocol is written as coroutines, run by the engine: Connection runs them in the thread
+    of the client (see run_sync), aio.AsyncConnection on the event loop. The engine gives the
+    readers of the client and the server (client_reader and server_reader, with the methods of
+    aio.AsyncIMAPReader), the WATCHER class of the upstream IDLEs and the I/O primitives:
+    client_ready, write_client, drain_client, write_server, drain_server, open_session,
+    start_client_tls, compress_client, run_blocking, stop_idling, release_server and close_client.
     """
 
-    def __init__(self, socket, key, verbose = False):
-        self.verbose = verbose
+    def __init__(self, key, tracer = None, pool = None, tls = None, idle = None, compress = ()):
+        self.trace = tracer.connection() if tracer else None
         self.key = key
-        self.conn_client = socket
+        self.pool = pool
+        self.handlers = dispatch_table(type(self))
+        self.session = None
         self.conn_server = None
+        self.client_reader = None
+        self.server_reader = None
+        self.current_folder = None
+        self.uidvalidity = None
+        self.account = None
+        self.background_session = None
+        self.acquire_session = None # Function returning a session of the account to the WATCHER
+        self.in_command = False
+        self.closing = False
+        self.tls = tls
+        self.pending = {} # server tag -> (client tag, command, start time) of the commands sent to the server
+        self.idle_hub = idle
+        self.idling = False
+        self.compression = compress
+        self.client_compressed = False
+        self.fetch_responses = None # FetchResponses of the FETCH command being run (see fetchcache)
+        self.upstream_time = 0 # Time spent waiting for the server during the command (metrics)
+
+    async def serve(self):
+        """ Greet the client and listen to it until the connection is closed """
 
         try:
-            self.send_to_client('* OK Service Ready.') # Server greeting
-            self.listen_client()
+            await self.send_to_client('* OK Service Ready.') # Server greeting
+            await self.listen_client()
         except ssl.SSLError:
             pass
-        except (BrokenPipeError, ConnectionResetError):
+        except (BrokenPipeError, ConnectionResetError, asyncio.IncompleteReadError):
             print('Connections closed')
         except ValueError as e:
             print('[ERROR]', e)
-
-        if self.conn_client:
-            self.conn_client.close()
+            self.dump_trace(e)
+        except Exception as e:
+            self.dump_trace(e)
+            raise
+        finally:
+            await self.release_server()
+
+        self.close_client()
+
+    def dump_trace(self, error):
+        """ Write the last events of the connection in a dump of the tracer """
+        if not self.trace:
+            return
+        try:
+            path = self.trace.dump(error)
+            if path:
+                print('[TRACE] Last events of connection', self.trace.id, 'dumped in', path)
+        except OSError as e:
+            print('[ERROR] Dump of the trace failed:', e)
 
     #       Listen client/server and connect server
 
-    def listen_client(self):
+    async def listen_client(self):
         """ Listen commands from the client """
 
         while self.listen_client:
-            for request in self.recv_from_client().split('\r\n'): # In case of multiple requests
-
-                match = Tagged_Request.match(request)
-                if not match:
-                    # Not a correct request
-                    self.send_to_client(self.error('Incorrect request'))
-                    raise ValueError('Error while listening the client: '
-                        + request + ' contains no tag and/or no command')
-
-                self.client_tag = match.group('tag')
-                self.client_command = match.group('command').lower()
-                self.client_flags = match.group('flags')
-                self.request = request
-
-                if self.client_command in COMMANDS:
-                    # Command supported by the proxy
-                    getattr(self, self.client_command)()
-                else:
-                    # Command unsupported -> directly transmit to the server
-                    self.transmit()
-
-    def transmit(self):
+            if self.pending and (len(self.pending) >= PIPELINE_DEPTH or not self.client_ready()):
+                # No more pipelined request: wait for the commands sent to the server
+                await self.listen_server()
+
+            # One complete request per message, pipelined requests stay in the reader
+            parts, literal = await self.recv_from_client()
+            request = parts[0][:-2].decode('utf-8', 'replace') # Only the first line is decoded
+
+            match = Tagged_Request.match(request)
+            if not match:
+                # Not a correct request
+                await self.send_to_client(self.error('Incorrect request'))
+                raise ValueError('Error while listening the client: '
+                    + request + ' contains no tag and/or no command')
+
+            command = match.group('command').lower()
+            pipelined = self.pipelined(command, literal)
+            if self.pending and not pipelined:
+                # Barrier: the commands sent before complete first
+                await self.listen_server()
+
+            self.parts, self.literal = parts, literal
+            self.client_tag = match.group('tag')
+            self.client_command = command
+            self.client_flags = match.group('flags')
+            self.request = request
+
+            if pipelined:
+                # Completed by listen_server, with the next pipelined commands
+                await self.send_command(time.perf_counter() if metrics.ENABLED else None)
+                continue
+
+            self.in_command = True
+            measure = metrics.ENABLED
+            if measure:
+                start = time.perf_counter()
+                self.upstream_time = 0
+            handler = self.handlers.get(self.client_command)
+            if handler:
+                # Command supported by the proxy or its modules
+                await handler(self)
+            else:
+                # Command unsupported -> directly transmit to the server
+                await self.transmit()
+            if measure:
+                metrics.observe_command(self.client_command, time.perf_counter() - start, self.upstream_time)
+            self.in_command = False
+
+    def pipelined(self, command, literal):
+        """ Return True if the command can be sent before the completion of the previous ones """
+        return (PIPELINE_DEPTH > 1 and self.conn_server is not None and literal is None
+            and command not in self.handlers)
+
+    async def transmit(self):
         """ Replace client tag by the server tag, transmit it to the server and listen to the server """
-        server_tag = self.conn_server._new_tag().decode()
-        self.send_to_server(self.request.replace(self.client_tag, server_tag, 1))
-        self.listen_server(server_tag)
-                
-    def listen_server(self, server_tag):
-        """ Continuously listen the server until a command completion response 
-        with the corresponding server_tag is received"""
-
-        while True:
-
-            response = self.recv_from_server()
-            response_match = Tagged_Response.match(response)
+        if metrics.ENABLED:
+            start = time.perf_counter()
+        await self.send_command()
+        await self.listen_server()
+        if metrics.ENABLED:
+            self.upstream_time += time.perf_counter() - start
+
+    async def send_command(self, start=None):
+        """ Send the command to the server with a new server tag, pending until its completion.
+        start - Time the command was received, to measure it on completion (default: None, measured by the caller) """
+        if metrics.ENABLED and self.pending:
+            metrics.PIPELINED_COMMANDS.inc()
+        server_tag = self.conn_server._new_tag()
+        first_line = server_tag + self.parts[0][len(self.client_tag):]
+        await self.forward_to_server([first_line] + self.parts[1:])
+        self.pending[server_tag] = (self.client_tag.encode(), self.client_command, start)
+
+    async def listen_server(self):
+        """ Continuously listen the server until the completion responses of the pending
+        commands are received, and send them to the client with its tags """
+
+        while self.pending:
+
+            response = await self.recv_line_from_server()
 
             ##   Command completion response
-            if response_match: 
-                server_response_tag = response_match.group('tag')
-                if server_tag == server_response_tag:
-                    # Verify the command completion corresponds to the client command
-                    self.send_to_client(response.replace(server_response_tag, self.client_tag, 1))
-                    return 
-            
+            server_tag = response[:response.find(b' ')]
+            if server_tag in self.pending:
+                client_tag, command, start = self.pending.pop(server_tag)
+                self.conn_server.tagged_commands.pop(server_tag, None)
+                await self.forward_to_client([client_tag + response[len(server_tag):]])
+                if start is not None and metrics.ENABLED:
+                    elapsed = time.perf_counter() - start
+                    metrics.observe_command(command, elapsed, elapsed)
+                continue
+
             ##   Untagged or continuation response or data messages
-            self.send_to_client(response)
+            await self.forward_untagged(response)
 
-            
-            if response.startswith('+') and self.client_command.upper() != 'FETCH':
+            if response.startswith(b'+') and self.client_command != 'fetch':
                 ##   Continuation response
-                client_sequence = self.recv_from_client()
-                while client_sequence != '' and not client_sequence.endswith('\r\n'): # Client sequence ends with empty request
-                    self.send_to_server(client_sequence)
-                    client_sequence = self.recv_from_client()
-                self.send_to_server(client_sequence)
+                if self.literal is not None:
+                    # The server accepts the synchronizing literal of the client
+                    await self.stream_client_literal(self.literal)
+                    client_parts, self.literal = await self.client_reader.read_rest()
+                    if metrics.ENABLED:
+                        metrics.count_bytes(metrics.CLIENT_IN, client_parts)
+                    if self.trace:
+                        for part in client_parts:
+                            self.trace.event(CLIENT_IN, part)
+                else:
+                    client_parts, self.literal = await self.recv_from_client()
+                await self.forward_to_server(client_parts)
+
+    async def stream_client_literal(self, size):
+        """ Stream to the server the synchronizing literal of the client (e.g. the email
+        of an APPEND), chunk by chunk """
+
+        if metrics.ENABLED:
+            metrics.BYTES.inc(metrics.CLIENT_IN, size)
+        async for chunk in self.client_reader.read_chunks(size):
+            if self.trace:
+                self.trace.event(CLIENT_IN, chunk)
+            await self.forward_to_server([chunk])
+
+    async def forward_untagged(self, response):
+        """ Forward to the client an untagged or continuation response of the server and its literals """
+
+        responses = self.fetch_responses
+        await self.forward_to_client(responses.parts(response) if responses else [response])
+        if self.client_command == 'select':
+            self.read_status(response)
+        if response.endswith(b' EXISTS\r\n'):
+            modules.notify(self)
+        await self.stream_literals(response)
+
+    async def stream_literals(self, response):
+        """ Stream to the client the literals announced by the response line and the
+        lines following them, chunk by chunk and without parsing their content
+        (recorded by the FetchResponses of a FETCH command) """
+
+        literal = literal_size(response)
+        responses = self.fetch_responses
+        while literal:
+            if metrics.ENABLED:
+                metrics.BYTES.inc(metrics.SERVER_IN, literal[0])
+            recorded = responses and responses.literal(literal[0])
+            async for chunk in self.server_reader.read_chunks(literal[0]):
+                if self.trace:
+                    self.trace.event(SERVER_IN, chunk)
+                if recorded:
+                    responses.chunk(chunk)
+                await self.forward_to_client([chunk])
+            response = await self.recv_line_from_server()
+            await self.forward_to_client([response])
+            if responses:
+                responses.line(response)
+            literal = literal_size(response)
+
+    async def proxy_command(self, request):
+        """ Send a request of the proxy (bytes without tag) to the server, forward its untagged
+        responses to the client and return its completion response """
+
+        tag = self.conn_server._new_tag()
+        await self.forward_to_server([tag + b' ' + request])
+        while True:
+            response = await self.recv_line_from_server()
+            if response.startswith(tag + b' '):
+                self.conn_server.tagged_commands.pop(tag, None)
+                return response
+            await self.forward_untagged(response)
 
-    def connect_server(self, username, password):
+    async def connect_server(self, username, password):
         """ Connect to the real server of the client for its credentials """
 
         username = self.remove_quotation_marks(username)
@@ -228,70 +637,196 @@ class Connection:
         try:
             hostname = HOSTS[domain]
         except KeyError:
-            self.send_to_client(self.error('Unknown hostname'))
+            await self.send_to_client(self.error('Unknown hostname'))
             raise ValueError('Error while connecting to the server: '
                     + 'Invalid domain name '+ domain)
 
         print("Trying to connect ", username)
-        self.conn_server = imaplib.IMAP4_SSL(hostname)
+        if self.trace:
+            self.trace.identify(username)
 
+        start = time.perf_counter()
         try:
-            self.conn_server.login(username, password)
+            await self.open_session(hostname, username, password)
         except imaplib.IMAP4.error:
-            self.send_to_client(self.failure())
+            await self.send_to_client(self.failure())
             raise ValueError('Error while connecting to the server: '
-                    + 'Invalid credentials: ' + username + " / " + password)
+                    + 'Invalid credentials for ' + username)
+        except ValueError:
+            # Too many sessions opened for the account
+            await self.send_to_client(self.failure())
+            raise
 
-        self.send_to_client(self.success())
+        if metrics.ENABLED:
+            metrics.UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - start)
+
+        self.account = username
+        await self.send_to_client(self.success())
 
     #       Mandatory supported IMAP commands
 
-    def capability(self):
+    async def capability(self):
         """ Send capabilites of the proxy """
-        self.send_to_client('* CAPABILITY ' + ' '.join(cap for cap in CAPABILITIES) + ' +')
-        self.send_to_client(self.success())
-
-    def authenticate(self):
+        capabilities = CAPABILITIES + ('STARTTLS',) if self.tls else CAPABILITIES
+        if self.idle_hub: # Answered by the proxy, only with the pool of sessions
+            capabilities += ('IDLE',)
+        if 'client' in self.compression and not self.client_compressed:
+            capabilities += ('COMPRESS=DEFLATE',)
+        await self.send_to_client('* CAPABILITY ' + ' '.join(cap for cap in capabilities) + ' +')
+        await self.send_to_client(self.success())
+
+    async def starttls(self):
+        """ Start SSL/TLS on the connection with the client, before its authentication """
+        if not self.tls or self.conn_server:
+            await self.send_to_client(self.error('STARTTLS not available'))
+            return
+
+        await self.send_to_client(self.success())
+        try:
+            await self.start_client_tls()
+        except OSError as e:
+            raise ValueError('Error while starting SSL/TLS with the client: ' + str(e))
+        self.tls = None
+
+    async def compress(self):
+        """ Compress the connection with the client (the responses after this one and its next requests) """
+        if 'client' not in self.compression:
+            await self.send_to_client(self.error('COMPRESS not available'))
+            return
+        if self.client_compressed:
+            await self.send_to_client(self.client_tag + ' NO [COMPRESSIONACTIVE] DEFLATE already active')
+            return
+        if (self.client_flags or '').upper() != 'DEFLATE':
+            await self.send_to_client(self.error('Unknown compression mechanism'))
+            return
+
+        await self.send_to_client(self.client_tag + ' OK DEFLATE active')
+        # The client compresses right after its command: what the reader received is compressed
+        await self.compress_client()
+        self.client_compressed = True
+        self.tls = None # No STARTTLS in a compressed stream
+
+    async def authenticate(self):
         """ Authenticate the client and call the given auth mechanism """
         auth_type = self.client_flags.split(' ')[0].lower()
-        getattr(self, self.client_command+"_"+auth_type)() 
+        await getattr(self, self.client_command+"_"+auth_type)()
 
-    def authenticate_plain(self):
+    async def authenticate_plain(self):
         """ Get the username and password using plain mechanism and 
         connect to the server """
-        self.send_to_client('+')
-        request = self.recv_from_client()
-        (empty, busername, bpassword) = base64.b64decode(request).split(b'\x00')
+        await self.send_to_client('+')
+        parts, literal = await self.recv_from_client()
+        (empty, busername, bpassword) = base64.b64decode(parts[0]).split(b'\x00')
         username = busername.decode()
         password = bpassword.decode()
-        self.connect_server(username, password)
+        await self.connect_server(username, password)
 
-    def login(self):
+    async def login(self):
         """ Login and connect to the server """
         (username, password) = self.client_flags.split(' ')
-        self.connect_server(username, password)
+        await self.connect_server(username, password)
 
-    def logout(self):
+    async def logout(self):
         """ Logout and stop listening the client """
         self.listen_client = False
-        self.transmit()
-
-    def select(self):
+        if self.session:
+            # The upstream session stays opened in the pool
+            await self.send_to_client('* BYE Logging out')
+            await self.send_to_client(self.success())
+        else:
+            await self.transmit()
+
+    async def select(self):
         """ Select a mailbox """
         self.set_current_folder(self.client_flags)
-        self.transmit()
-
-    #       CIRCL modules
-
-    def fetch(self):
-        """ Fetch an email """
-        pycircleanmail_module(self)
-        self.transmit()
-
-    def move(self):
-        """ Move an email to another mailbox """
-        misp_module(self)
-        self.transmit()
+        self.uidvalidity = None
+        await self.transmit()
+
+    async def idle(self):
+        """ Send the updates of the selected mailbox until the client sends DONE """
+        if not (self.idle_hub and self.session and self.current_folder):
+            await self.transmit()
+            return
+
+        await self.send_to_client('+ idling')
+        self.idling = True
+        self.in_command = False # Refreshed by the watcher, closed by a drain
+        watcher = self.idle_hub.subscribe(self.WATCHER, self.session.key, self.current_folder,
+            self.pool, self.acquire_session, self)
+        try:
+            parts, literal = await self.recv_from_client()
+        finally:
+            self.idle_hub.unsubscribe(watcher, self)
+            await self.stop_idling()
+        self.in_command = True
+
+        if parts[0].upper() != b'DONE\r\n':
+            await self.send_to_client(self.error('Expected DONE'))
+            return
+        await self.send_to_client(self.success())
+
+    async def send_updates(self):
+        """ Send the updates of the selected mailbox to the idling client, with a NOOP on its
+        session (see refresh, with the idle_lock held) """
+
+        if not self.idling or self.closing:
+            return
+        try:
+            tag = self.conn_server._new_tag()
+            await self.forward_to_server([tag + b' NOOP' + CRLF])
+            while True:
+                response = await self.recv_line_from_server()
+                if response.startswith(tag + b' '):
+                    self.conn_server.tagged_commands.pop(tag, None)
+                    break
+                await self.forward_untagged(response)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            print('[ERROR] Refresh of the idling client failed:', e)
+            self.idling = False
+            self.in_command = True # The session is not given back to the pool
+            self.close() # The client is listened until the end of the stream
+
+    #       Modules
+
+    async def module_command(self):
+        """ Call the modules of the command, then transmit it """
+        if await self.call_modules():
+            await self.transmit()
+
+    async def call_modules(self):
+        """ Call the modules of the command whose request and mailbox match (see modules.Module),
+        with run_blocking: the modules use the blocking conn_server.
+        Return False if a module waited too long for its turn (see scheduler): the command is
+        answered NO [UNAVAILABLE], not transmitted without the module. """
+        for module in modules.hooks(self.client_command):
+            match = module.match(self)
+            if match:
+                try:
+                    await self.run_blocking(module.process, self, match)
+                except Unavailable as e:
+                    print('[ERROR]', e)
+                    await self.send_to_client(self.unavailable())
+                    return False
+        return True
+
+    async def fetch(self):
+        """ Fetch an email, with the immutable data of the emails cached (see fetchcache) """
+        if not await self.call_modules():
+            return
+        commands = await self.run_blocking(fetchcache_module, self)
+        try:
+            for request, self.fetch_responses in commands[:-1]:
+                response = await self.proxy_command(request)
+                if response.split(b' ', 2)[1].upper() != b'OK':
+                    await self.forward_to_client([self.client_tag.encode() + response[response.find(b' '):]])
+                    return
+            if commands:
+                request, self.fetch_responses = commands[-1]
+                if request is not None:
+                    self.parts = [self.client_tag.encode() + b' ' + request]
+            await self.transmit()
+        finally:
+            self.fetch_responses = None
 
     #       Command completion
 
@@ -307,47 +842,83 @@ class Connection:
         """ Error command completing response """
         return self.client_tag + ' BAD ' + msg
 
+    def unavailable(self):
+        """ Failure command completing response when the proxy is too busy """
+        return self.client_tag + ' NO [UNAVAILABLE] ' + self.client_command + ' failed, try again later.'
+
     #       Sending and receiving methods
 
-    def send_to_client(self, str_data):
+    async def send_to_client(self, str_data):
         """ Send String data (without CRLF) to the client """
+        await self.forward_to_client([str_data.encode('utf-8', 'replace') + CRLF])
+
+    async def forward_to_client(self, parts):
+        """ Send the parts (bytes or memoryviews) of a response to the client as they are """
+
+        size = 0
+        for part in parts:
+            self.write_client(part)
+            size += len(part)
 
-        b_data = str_data.encode('utf-8', 'replace') + CRLF
-        self.conn_client.send(b_data)
+            if self.trace:
+                self.trace.event(CLIENT_OUT, part)
 
-        if self.verbose: 
-            print("[<--]: ", b_data)
+        await self.drain_client()
+        if metrics.ENABLED:
+            metrics.BYTES.inc(metrics.CLIENT_OUT, size)
 
-    def recv_from_client(self):
-        """ Return the last String request from the client without CRLF """
+    async def recv_from_client(self):
+        """ Return (parts, literal) of the next request from the client (see IMAPReader.read_message) """
 
-        b_request = self.conn_client.recv(1024)
-        str_request = b_request.decode('utf-8', 'replace')[:-2] # decode and remove CRLF
+        parts, literal = await self.client_reader.read_message()
+        if metrics.ENABLED:
+            metrics.count_bytes(metrics.CLIENT_IN, parts)
 
-        if self.verbose: 
-            print("[-->]: ", b_request)
+        if self.trace:
+            for part in parts:
+                self.trace.event(CLIENT_IN, part)
 
-        return str_request
+        return parts, literal
 
-    def send_to_server(self, str_data):
+    async def send_to_server(self, str_data):
         """ Send String data (without CRLF) to the server """
+        await self.forward_to_server([str_data.encode('utf-8', 'replace') + CRLF])
+
+    async def forward_to_server(self, parts):
+        """ Send the parts (bytes or memoryviews) of a request to the server as they are """
+
+        for part in parts:
+            self.write_server(part)
 
-        b_data = str_data.encode('utf-8', 'replace') + CRLF
-        self.conn_server.send(b_data)
+            if self.trace:
+                self.trace.event(SERVER_OUT, part)
 
-        if self.verbose: 
-            print("  [-->]: ", b_data)
+        await self.drain_server()
+        if metrics.ENABLED:
+            metrics.count_bytes(metrics.SERVER_OUT, parts)
 
-    def recv_from_server(self):
-        """ Return the last String response from the server without CRLF """
+    async def recv_from_server(self):
+        """ Return the parts of the next response from the server (see IMAPReader.read_message) """
 
-        b_response = self.conn_server._get_line()
-        str_response = b_response.decode('utf-8', 'replace')    
+        parts, literal = await self.server_reader.read_message()
 
-        if self.verbose: 
-            print("  [<--]: ", b_response)
+        if self.trace:
+            for part in parts:
+                self.trace.event(SERVER_IN, part)
 
-        return str_response
+        return parts
+
+    async def recv_line_from_server(self):
+        """ Return the next line (with CRLF) from the server """
+
+        line = await self.server_reader.read_line()
+        if metrics.ENABLED:
+            metrics.BYTES.inc(metrics.SERVER_IN, len(line))
+
+        if self.trace:
+            self.trace.event(SERVER_IN, line)
+
+        return line
 
     #       Helpers
 
@@ -355,8 +926,143 @@ class Connection:
         """ Set the current folder of the client """
         self.current_folder = self.remove_quotation_marks(folder)
 
+    def read_status(self, response):
+        """ Keep the UIDVALIDITY of the selected mailbox from a response of the server """
+        match = UIDValidity_Response.match(response)
+        if match:
+            self.uidvalidity = int(match.group('uidvalidity'))
+
     def remove_quotation_marks(self, text):
         """ Remove quotation marks from a String """
         if text.startswith('"') and text.endswith('"'):
             text = text[1:-1]
-        return text
\ No newline at end of file
+        return text
+
+class Connection(BaseConnection):
+
+    r""" Connection with a client served by its own thread.
+
+    Instantiate with: Connection(socket, key[, tracer[, pool[, connections[, tls[, idle[, compress]]]]]]])
+
+            socket - Socket (with or without SSL/TLS) with the client
+            key - Key used to verify the integrity of emails append by the proxy
+            tracer - Tracer of the IMAP payload (default: None, no trace)
+            pool - SessionPool providing the upstream session (default: None, a new session is opened)
+            connections - Set the connection is kept in while it is opened (default: None)
+            tls - ServerContext offered to the client with STARTTLS (default: None, no STARTTLS)
+            idle - IdleHub of the upstream IDLEs (default: None, IDLE is not advertised and transmitted to the server)
+            compress - Legs compressed with COMPRESS=DEFLATE: 'client' and/or 'server' (default: ())
+    
+    Listens on the socket commands from the client (see BaseConnection), until it is closed.
+    The I/O primitives block on the sockets: the protocol runs as in a plain function (see run_sync).
+    """
+
+    WATCHER = Watcher
+
+    def __init__(self, socket, key, tracer = None, pool = None, connections = None, tls = None, idle = None, compress = ()):
+        BaseConnection.__init__(self, key, tracer, pool, tls, idle, compress)
+        self.conn_client = socket
+        self.client_reader = BlockingReader(IMAPReader(socket.makefile('rb'), client=True))
+        self.idle_lock = threading.Lock() # Held while the idling client is refreshed
+        self.client_deflater = None # Deflater of the responses once the client sent COMPRESS
+
+        if connections is not None:
+            connections.add(self)
+        try:
+            run_sync(self.serve())
+        finally:
+            if connections is not None:
+                connections.discard(self)
+
+    def close_idle(self):
+        """ Close the connection with a BYE response, unless a command is running """
+        if self.in_command or self.pending or self.closing:
+            return
+        self.closing = True
+        with self.idle_lock: # Not during a refresh
+            try:
+                run_sync(self.send_to_client('* BYE Server shutting down'))
+            except OSError:
+                pass
+            self.close()
+
+    def close(self):
+        """ Shut the socket of the client down, the listening thread stops on the end of the stream """
+        self.closing = True
+        try:
+            socket.socket.shutdown(self.conn_client, socket.SHUT_RDWR) # Also for SSL sockets, without SSL shutdown
+        except OSError:
+            pass
+
+    def close_client(self):
+        """ Close the socket of the client once it is not listened anymore """
+        self.conn_client.close()
+
+    def refresh(self):
+        """ Send the updates of the selected mailbox to the idling client (called by the Watcher of the mailbox) """
+        with self.idle_lock:
+            run_sync(self.send_updates())
+
+    async def stop_idling(self):
+        """ Stop the refreshes of the client, once the one running is over """
+        with self.idle_lock:
+            self.idling = False
+
+    async def release_server(self):
+        """ Give the upstream session back to the pool, unless a command was interrupted """
+        if not self.session:
+            return
+        if self.in_command or self.pending:
+            self.pool.discard(self.session)
+        else:
+            self.pool.release(self.session, self.current_folder is not None)
+        self.session = None
+
+    async def open_session(self, hostname, username, password):
+        """ Open the upstream session of the account, or take it from the pool """
+
+        connect = functools.partial(login_server, compress='server' in self.compression)
+        if self.pool:
+            self.session = self.pool.acquire(hostname, username, password, connect)
+            self.conn_server = self.session.conn
+            self.background_session = functools.partial(self.pool.acquire, hostname, username, password, connect)
+            self.acquire_session = self.background_session
+        else:
+            self.conn_server = connect(hostname, username, password)
+        self.server_reader = BlockingReader(IMAPReader(self.conn_server.file))
+
+    async def start_client_tls(self):
+        """ Start SSL/TLS on the socket of the client (see starttls) """
+        self.conn_client = handshake(self.conn_client, self.tls.context())
+        # Data sent by the client before the handshake is dropped with the previous reader
+        self.client_reader = BlockingReader(IMAPReader(self.conn_client.makefile('rb'), client=True))
+
+    async def compress_client(self):
+        """ Decompress the next requests of the client and compress the next responses (see compress) """
+        self.client_reader = BlockingReader(IMAPReader(inflating_file(self.conn_client,
+            self.client_reader.reader.file, metrics.CLIENT_IN), client=True))
+        self.client_deflater = Deflater(metrics.CLIENT_OUT)
+
+    async def run_blocking(self, function, *args):
+        """ Return function(*args), called in the thread of the client """
+        return function(*args)
+
+    def client_ready(self):
+        """ Return True if the client already sent (a part of) its next request """
+        return received(self.conn_client, self.client_reader.reader.file)
+
+    def write_client(self, data):
+        """ Send data to the client, compressed once it sent COMPRESS """
+        self.conn_client.sendall(self.client_deflater.compress(data) if self.client_deflater else data)
+
+    async def drain_client(self):
+        """ Send the end of the compressed data of the response (see Deflater) """
+        if self.client_deflater:
+            self.conn_client.sendall(self.client_deflater.flush())
+
+    def write_server(self, data):
+        """ Send data to the server """
+        self.conn_server.send(data)
+
+    async def drain_server(self):
+        """ Nothing to wait for: write_server sends at once """
@@ -3,15 +3,22 @@
     Sanitize emails before being fetched by the user.
 """
 
-import email, re, imaplib, time, hashlib, hmac
-from .helpers import parse_ids
-from io import BytesIO
-from kittengroomer_email import KittenGroomerMail
+import re, imaplib, time
+from .helpers import parse_fetch, SequenceSet, crlf, get_header, add_headers
+from .sanitizer import SanitizerPool
+from .cache import SanitizedCache, MEMORY_SIZE, DISK_SIZE
+from .index import SanitizedIndex
+from .presanitizer import Presanitizer, WORKERS, RATE, BURST
+from .fetchcache import remember
+from .signer import PROXY_SIGN, DIGEST, sign, verify
+from .scheduler import scheduler
+from .modules import Module
+from . import metrics
 
 Fetch = re.compile(r'(?P<tag>[A-Z0-9]+)'
     r'(\s(UID))?'
     r'\s(FETCH)'
-    r'\s(?P<ids>[0-9:,]+)'
+    r'\s(?P<ids>[0-9:,*]+)'
     r'\s(?P<flags>.*)', flags=re.IGNORECASE)
 
 # Default Quarantine folder
@@ -22,18 +29,71 @@ CIRCL_SIGN = 'X-CIRCL-Sanitizer'
 VALUE_ORIGINAL = 'Original'
 VALUE_SANITIZED= 'Sanitized'
 VALUE_ERROR= 'Error'
-# Proxy header to verify email integrity
-PROXY_SIGN = 'X-Proxy-Sign'
 
-# Message data used to get the flags and sanitizer header
-MSG_DATA_FS = '(FLAGS BODY.PEEK[HEADER.FIELDS (' + CIRCL_SIGN + ')])'
-# Message data used to get the entire mail
-MSG_DATA = 'BODY.PEEK[]'
+# Uid of an appended email (UIDPLUS)
+Append_UID = re.compile(rb'\[APPENDUID (?P<uidvalidity>[0-9]+) (?P<uid>[0-9]+)\]', flags=re.IGNORECASE)
+# Uids of the copied emails (UIDPLUS), response code of COPY and MOVE without brackets
+Copy_UID = re.compile(rb'(?P<uidvalidity>[0-9]+) (?P<source>[0-9:,]+) (?P<destination>[0-9:,]+)')
 
-def process(client):
-    """ Apply the PyCIRCLeanMail module if the request match with a Fetch request
+# Message data used to get the uid, flags and sanitizer header
+MSG_DATA_FS = '(UID FLAGS BODY.PEEK[HEADER.FIELDS (' + CIRCL_SIGN + ')])'
+# Message data used to get the entire mail
+MSG_DATA = '(UID BODY.PEEK[])'
+
+# Maximum number of entire emails fetched at once
+FETCH_BATCH = 50
+
+# Number of most recent emails checked by a background sanitization
+PRESANITIZE_WINDOW = 100
+
+# Pool of worker processes sanitizing the emails (created on first use or by configure)
+SANITIZER = None
+# Index of the uids known to be sanitized (created on first use or by configure)
+INDEX = None
+# Background sanitization of the new emails (disabled by default, see configure)
+PRESANITIZER = None
+# Digest of the signatures of the emails appended (see signer)
+SIGN_DIGEST = DIGEST
+# Verify the signature of the emails with the sanitizer header before trusting it
+VERIFY_SIGNATURES = False
+
+def configure(cache_size=MEMORY_SIZE, cache_path=None, cache_disk_size=DISK_SIZE, index_path=None,
+        presanitize=False, presanitize_workers=WORKERS, presanitize_rate=RATE, presanitize_burst=BURST,
+        sign_digest=DIGEST, verify_signatures=False, **options):
+    """ Create the pool of worker processes with the given options (see SanitizerPool),
+    its cache of sanitized emails (see SanitizedCache, disabled if cache_size is 0),
+    the index of sanitized uids (see SanitizedIndex) and, if presanitize is True,
+    the background sanitization of new emails (see Presanitizer), the digest of the signatures
+    and if they are verified (see signer) """
+    global SANITIZER, INDEX, PRESANITIZER, SIGN_DIGEST, VERIFY_SIGNATURES
+    cache = SanitizedCache(cache_size, cache_path, cache_disk_size) if cache_size else None
+    SANITIZER = SanitizerPool(cache=cache, **options)
+    if cache:
+        metrics.Callback('imapproxy_sanitized_cache', 'Counters of the cache of sanitized emails',
+            'gauge', lambda: {(name,): value for name, value in cache.stats().items()}, ('counter',))
+    INDEX = SanitizedIndex(index_path)
+    PRESANITIZER = Presanitizer(presanitize_emails, presanitize_workers,
+        presanitize_rate, presanitize_burst) if presanitize else None
+    SIGN_DIGEST = sign_digest
+    VERIFY_SIGNATURES = verify_signatures
+
+def sanitizer():
+    """ Return the pool of worker processes """
+    if SANITIZER is None:
+        configure()
+    return SANITIZER
+
+def index():
+    """ Return the index of sanitized uids """
+    if INDEX is None:
+        configure()
+    return INDEX
+
+def process(client, match):
+    """ Apply the PyCIRCLeanMail module to a Fetch request, in a folder whose emails are sanitized
 
         client - Connection object
+        match - Match of the request with Fetch
 
     """
     request = client.request
@@ -41,126 +101,304 @@ def process(client):
     folder = client.current_folder
     key = client.key
 
-    # Only sanitize emails in the Inbox
-    if ("QUARANTINE" in folder.upper()) or ("SENT" in folder.upper()): 
-            print("Don't need to sanitize in the folder:", folder)
+    uidc = True if (('UID' in request) or ('uid' in request)) else False
+
+    ids = SequenceSet.parse(match.group('ids'))
+
+    if uidc and client.uidvalidity:
+        # Only check the emails which are not known to be sanitized
+        ids = index().missing(client.account, folder, client.uidvalidity, ids)
+        if not ids:
             return
 
-    uidc = True if (('UID' in request) or ('uid' in request)) else False
+    process_emails(ids, conn_server, folder, uidc, key, client.account)
 
-    match = Fetch.match(request) 
-    if not match: return # Client discovers new emails (presence of '*' key)
-    ids = match.group('ids')
+def notify(client):
+    """ Sanitize in background the new emails of the current folder of the client
 
-    if ids.isdigit(): 
-        # Only one email fetched
-        process_email(ids, conn_server, folder, uidc, key)
-    else:
-        # Multiple emails are fetched (ids format: [0-9,:])
-        for id in parse_ids(ids):
-            process_email(str(id), conn_server, folder, uidc, key) 
+        client - Connection object which received an EXISTS response
 
-def process_email(id, conn_server, folder, uidc, key):
-    """ Sanitize, if necessary, an email.
+    Only if the background sanitization is enabled and the client uses a pool of sessions.
+    """
 
-        id - String containing the id of the email to fetch;
+    if PRESANITIZER and client.background_session:
+        PRESANITIZER.notify(client.account, client.current_folder, client.pool,
+            client.background_session, client.current_folder, client.key, client.account)
+
+def need_sanitization(folder):
+    """ Return False for the folders whose emails are not sanitized """
+    return not (("QUARANTINE" in folder.upper()) or ("SENT" in folder.upper()))
+
+def presanitize_emails(pool, background_session, folder, key, account):
+    """ Sanitize the PRESANITIZE_WINDOW most recent emails of the folder which are not known
+    to be sanitized, with a session of the account taken from the pool by background_session() """
+
+    session = background_session()
+    conn_server = session.conn
+    try:
+        result, response = conn_server.status(folder, '(UIDVALIDITY UIDNEXT)')
+        status = dict(re.findall(r'(UIDVALIDITY|UIDNEXT) ([0-9]+)', response[-1].decode().upper()))
+        uidvalidity, uidnext = int(status['UIDVALIDITY']), int(status['UIDNEXT'])
+
+        recent = SequenceSet([(max(1, uidnext - PRESANITIZE_WINDOW), uidnext - 1)] if uidnext > 1 else [])
+        missing = index().missing(account, folder, uidvalidity, recent)
+        if missing:
+            process_emails(missing, conn_server, folder, True, key, account)
+    except Exception:
+        pool.discard(session)
+        raise
+    pool.release(session)
+
+def process_emails(ids, conn_server, folder, uidc, key, account):
+    """ Sanitize, if necessary, the emails.
+
+        ids - SequenceSet of the ids of the emails to fetch, '*' included;
         conn_server - imaplib connection to the server;
         folder - Current folder of the client;
-        uidc - True if command contains UID flag
+        uidc - True if ids are uids
         key - key used to verify integrity of email
-
-    If the email is not sanitized yet, make a sanitized copy in the same folder
-    and an unsanitized copy if the Quarantine folder. The original email is deleted.
+        account - Account of the client (username), used by the index of sanitized uids
+
+    The folder is selected once, the signatures of all the emails are fetched at once and
+    only the unsanitized emails are downloaded (by batches of FETCH_BATCH emails).
+    The signatures and every batch wait for a slot of the account (see scheduler), so the
+    accounts take turns on the server.
+    If the server supports it, the originals of every batch are moved to the Quarantine
+    folder on the server (see quarantine_emails). Otherwise, or if it fails, their copies
+    are appended and the originals deleted with one STORE and one EXPUNGE at the end.
     """
 
-    conn_server.select(folder)
-
-    if has_CIRCL_signature(id, conn_server, uidc): 
+    slot = lambda: scheduler().slot(account, conn_server.host)
+    with slot():
+        result, exists = conn_server.select(folder)
+        uidvalidity, uidnext = mailbox_status(conn_server)
+        # '*' is the largest uid (UIDNEXT - 1) or message number (EXISTS), resolved by the server if unknown
+        largest = None
+        if uidc and uidnext:
+            largest = uidnext - 1
+        elif not uidc and result == 'OK':
+            largest = int(exists[-1] or 0)
+        if largest is not None:
+            ids = ids.resolve(largest) if largest else SequenceSet()
+        signatures = fetch_signatures(ids, conn_server, uidc, key) if ids else {}
+
+    if signatures is None:
+        # Nothing is known about the emails: they are checked again by the next FETCH
         return
-    print('Email not sanitized')
 
-    #   -- No CIRCL signature or incorrect value --
-    bmail = fetch_entire_email(id, conn_server, uidc)
-    if not bmail: 
+    uids = SequenceSet.from_ids(uid for uid, sanitized in signatures.items() if not sanitized)
+    processed, appended = [], []
+    quarantined = SequenceSet() # Originals moved to the Quarantine folder
+    server_side = can_quarantine(conn_server)
+
+    if uids:
+        print('Emails not sanitized:', len(uids))
+    for batch in uids.chunks(FETCH_BATCH):
+        with slot():
+            bmails = fetch_entire_emails(batch, conn_server)
+
+            # The emails of the batch are sanitized concurrently by the workers
+            jobs = {uid: sanitizer().submit(bmail) for uid, bmail in bmails.items()}
+            sanitized = []
+            for uid, bmail in bmails.items():
+                content = jobs[uid].result()
+                if not content:
+                    # Kept on the server: fetched next by the client
+                    remember(account, folder, uidvalidity, uid, bmail)
+                    continue
+                sanitized.append(uid)
+                append_uid = process_email(bmail, content, conn_server, folder, key, account,
+                    quarantine=not server_side)
+                if append_uid and append_uid[0] == uidvalidity:
+                    appended.append(append_uid[1])
+            processed += sanitized
+
+            if server_side and sanitized:
+                moved = quarantine_emails(SequenceSet.from_ids(sanitized), conn_server, bmails, account)
+                if moved:
+                    quarantined |= moved
+                else:
+                    # Fallback: copies appended, originals deleted with the others
+                    server_side = False
+                    for uid in sanitized:
+                        quarantine_email(bmails[uid], conn_server, key, account)
+
+    processed = SequenceSet.from_ids(processed)
+    if processed - quarantined:
+        with slot():
+            delete_emails(processed - quarantined, conn_server)
+
+    if not uidvalidity:
         return
-    mail = email.message_from_bytes(bmail)
 
-    # Get the DATE of the email
-    date_str = mail.get('Date')
-    date = imaplib.Internaldate2tuple(date_str.encode()) if date_str else imaplib.Time2Internaldate(time.time())
+    # Record only the uids seen sanitized by the server, and the sanitized copies
+    known = SequenceSet.from_ids(signatures) - (uids - processed)
+    index().add(account, folder, uidvalidity, known | SequenceSet.from_ids(appended))
 
-    # Get the payload and hash
-    digest_original = hash_payload(get_payload(mail), key)
+def process_email(bmail, content, conn_server, folder, key, account=None, quarantine=True):
+    """ Add the sanitized copy of an email, the original is deleted by the caller.
+    Return (UIDVALIDITY, uid) of the sanitized copy if the server gives it (UIDPLUS).
 
-    # Sanitize the email
-    content = sanitize_email(bmail)
-    if not content: 
-        return
+        bmail - Raw email (in bytes);
+        content - Sanitized raw email (in bytes);
+        conn_server - imaplib connection to the server;
+        folder - Current folder of the client;
+        key - key used to verify integrity of email
+        account - Account of the client (username), used by the cache of the emails fetched
+        quarantine - Append an unsanitized copy in the Quarantine folder, False if the caller
+            moves the original there (default: True)
+
+    Make a sanitized copy in the same folder and an unsanitized copy in the Quarantine folder.
+    The emails are neither parsed nor serialized again: the headers of the proxy are added
+    to their raw header block (see append_email).
+    """
+
+    if metrics.ENABLED:
+        start = time.perf_counter()
+
+    date = email_date(bmail)
 
     # Copy of the sanitized email
-    smail = email.message_from_bytes(content.getvalue())
-    digest_sanitized = hash_payload(get_payload(smail), key)
-    append_email(conn_server, smail, digest_sanitized, VALUE_SANITIZED, date, folder)
+    append_uid = append_email(conn_server, content, VALUE_SANITIZED, date, folder, key, account)
 
     # Copy of the original email in the Quarantine folder
-    append_email(conn_server, mail, digest_original, VALUE_ORIGINAL, date, QUARANTINE_FOLDER)
+    if quarantine:
+        append_email(conn_server, bmail, VALUE_ORIGINAL, date, QUARANTINE_FOLDER, key, account)
 
-    # Delete original
-    conn_server.uid('STORE', id, '+FLAGS', '(\Deleted)') if uidc else conn_server.store(id, '+FLAGS', '(\Deleted)')
-    conn_server.expunge()
+    if metrics.ENABLED:
+        metrics.PROCESS_EMAIL_SECONDS.observe(time.perf_counter() - start)
 
-def has_CIRCL_signature(id, conn_server, uidc):
-    """ Return False if the email with the given id has not been sanitized yet """
+    return append_uid
 
-    result, response = conn_server.uid('fetch', id, MSG_DATA_FS) if uidc else conn_server.fetch(id, MSG_DATA_FS)
+def quarantine_email(bmail, conn_server, key, account=None):
+    """ Append an unsanitized copy of the email in the Quarantine folder """
+    append_email(conn_server, bmail, VALUE_ORIGINAL, email_date(bmail), QUARANTINE_FOLDER, key, account)
 
-    if result == 'OK' and response[0]:
-        try:
-            [(flags, signature), ids] = response
-        except ValueError:
-            # Not correct response
-            return True
+def email_date(bmail):
+    """ Return the date of the raw email given to APPEND """
+    date_str = get_header(bmail, 'Date')
+    return imaplib.Internaldate2tuple(date_str.encode()) if date_str else imaplib.Time2Internaldate(time.time())
 
-        if (CIRCL_SIGN.encode() in signature) and (VALUE_SANITIZED.encode() in signature):
-            print('Already sanitized')
-            return True
+def can_quarantine(conn_server):
+    """ Return True if the server can move the originals to the Quarantine folder itself:
+    with MOVE, or with COPY and UID EXPUNGE (UIDPLUS) so that only these emails are expunged """
+    return 'MOVE' in conn_server.capabilities or 'UIDPLUS' in conn_server.capabilities
+
+def quarantine_emails(uids, conn_server, bmails=None, account=None):
+    """ Move the emails of the SequenceSet of uids to the Quarantine folder on the server,
+    as they are, with UID MOVE or UID COPY and UID EXPUNGE (see can_quarantine).
+    Return the SequenceSet of the uids moved, empty if the server refused.
+
+        bmails - {uid: raw email} of the emails, kept in the cache of the emails fetched
+            under their uids in the Quarantine folder (default: None)
+    """
+
+    uid_set = str(uids)
+    command = 'MOVE' if 'MOVE' in conn_server.capabilities else 'COPY'
+    result, response = conn_server.uid(command, uid_set, QUARANTINE_FOLDER)
+    if result != 'OK' and b'[TRYCREATE]' in (response[-1] or b'').upper():
+        conn_server.create(QUARANTINE_FOLDER)
+        result, response = conn_server.uid(command, uid_set, QUARANTINE_FOLDER)
+    # Response code of the completion or of an untagged OK (MOVE)
+    typ, copyuid = conn_server.response('COPYUID')
+
+    if result != 'OK':
+        print('[ERROR] Quarantine of the emails on the server failed:', response[-1])
+        return SequenceSet()
+
+    if command == 'COPY':
+        delete_emails(uids, conn_server)
+
+    match = Copy_UID.match(copyuid[-1] or b'')
+    if match and bmails:
+        destinations = SequenceSet.parse(match.group('destination').decode())
+        for uid, copy_uid in zip(SequenceSet.parse(match.group('source').decode()), destinations):
+            if uid in bmails:
+                remember(account, QUARANTINE_FOLDER, int(match.group('uidvalidity')), copy_uid, bmails[uid])
+
+    return uids
+
+def mailbox_status(conn_server):
+    """ Return (UIDVALIDITY, UIDNEXT) of the mailbox just selected (None if unknown) """
+
+    status = []
+    for name in ('UIDVALIDITY', 'UIDNEXT'):
+        typ, dat = conn_server.response(name)
+        status.append(int(dat[-1]) if dat[-1] else None)
+
+    return tuple(status)
+
+def fetch_signatures(ids, conn_server, uidc, key):
+    """ Return {uid: True if the email has the CIRCL signature} (with one FETCH), None if the
+    server refused the FETCH. If VERIFY_SIGNATURES, the signature of the proxy of the emails with
+    the CIRCL signature is verified too: unlike the header, it can't be forged without the key.
+    An email which can't be downloaded to be verified is not trusted. """
+
+    result, response = conn_server.uid('fetch', str(ids), MSG_DATA_FS) if uidc else conn_server.fetch(str(ids), MSG_DATA_FS)
+    if result != 'OK':
+        return None
+
+    signatures = {uid: has_CIRCL_signature(signature) for uid, signature in parse_fetch(response).items()}
+    if VERIFY_SIGNATURES:
+        signed = SequenceSet.from_ids(uid for uid, sanitized in signatures.items() if sanitized)
+        for batch in signed.chunks(FETCH_BATCH):
+            bmails = fetch_entire_emails(batch, conn_server)
+            for uid in batch:
+                signatures[uid] = uid in bmails and bool(verify(bmails[uid], key))
+    return signatures
+
+def has_CIRCL_signature(signature):
+    """ Return False if the sanitizer header of the email has not the sanitized value """
+
+    if signature and (CIRCL_SIGN.encode() in signature) and (VALUE_SANITIZED.encode() in signature):
+        return True
 
     return False
 
-def fetch_entire_email(id, conn_server, uidc):
-    """ Return the raw_email in bytes """
-    result, response = conn_server.uid('fetch', id, MSG_DATA) if uidc else conn_server.fetch(id, MSG_DATA)
+def fetch_entire_emails(uids, conn_server):
+    """ Return {uid: raw_email in bytes} for the SequenceSet of uids (with one UID FETCH) """
 
-    if result == 'OK' and response != [b'The specified message set is invalid.'] and response != [None]:
-        bmail = response[0][1]
-    else:
-        return
+    result, response = conn_server.uid('fetch', str(uids), MSG_DATA)
+    if result != 'OK':
+        return {}
 
-    return bmail
-
-def sanitize_email(bmail):
-    """ Sanitize the raw email (in bytes) using the PyCIRCLeanMail module """
-    t = KittenGroomerMail(bmail)
-    m = t.process_mail()
-    return BytesIO(m.as_bytes())
-
-def append_email(conn_server, mail, proxy_value, circl_value, date, folder):
-    """ Append the email on the server """
-    mail.add_header(CIRCL_SIGN, circl_value)
-    mail.add_header(PROXY_SIGN, proxy_value)
-    conn_server.append(folder, '', date, str(mail).encode())
-
-def get_payload(mail):
-    """ Return the payload of the given email """
-    res = ''
-    if mail.is_multipart():
-        for payload in mail.get_payload():
-            res += payload.get_payload()
-    else:
-        res = mail.get_payload()
+    return {uid: bmail for uid, bmail in parse_fetch(response).items() if bmail}
+
+def delete_emails(uids, conn_server):
+    """ Delete the emails of the SequenceSet of uids. With UIDPLUS, only these emails are expunged. """
 
-    return res
+    uid_set = str(uids)
+    conn_server.uid('STORE', uid_set, '+FLAGS', '(\Deleted)')
 
-def hash_payload(payload, key):
-    """ Hash the payload """
-    return hmac.new(str(key).encode('utf-8'), str(payload).encode('utf-8'), hashlib.sha1).hexdigest()
\ No newline at end of file
+    if 'UIDPLUS' in conn_server.capabilities:
+        conn_server._simple_command('UID', 'EXPUNGE', uid_set)
+    else:
+        conn_server.expunge()
+
+def append_email(conn_server, bmail, circl_value, date, folder, key, account=None):
+    """ Append the raw email (in bytes), signed with the key, on the server and return its
+    (UIDVALIDITY, uid) if the server gives it. The email is then kept in the cache of the emails
+    fetched (see fetchcache).
+
+    The sanitizer and proxy headers are spliced at the end of the header block in one copy,
+    the rest of the email is appended byte for byte (with CRLF line endings, as imaplib does). """
+    bmail = crlf(bmail)
+    bmail = add_headers(bmail, [(CIRCL_SIGN, circl_value), (PROXY_SIGN, sign(bmail, key, SIGN_DIGEST))])
+    result, response = append_raw(conn_server, folder, date, bmail)
+
+    match = Append_UID.search(response[-1] or b'') if result == 'OK' else None
+    if match:
+        uidvalidity, uid = int(match.group('uidvalidity')), int(match.group('uid'))
+        remember(account, folder, uidvalidity, uid, bmail)
+        return uidvalidity, uid
+
+def append_raw(conn_server, folder, date, bmail):
+    """ imaplib append() of a raw email which has CRLF line endings already (see crlf),
+    without the copy imaplib makes to convert them """
+    if conn_server.utf8_enabled:
+        return conn_server.append(folder, '', date, bmail)
+    conn_server.literal = bmail
+    return conn_server._simple_command('APPEND', folder, None, imaplib.Time2Internaldate(date) if date else None)
+
+# Only the emails in the Inbox are sanitized
+MODULE = Module('pycircleanmail', ('fetch',), process, Fetch, need_sanitization, notify)
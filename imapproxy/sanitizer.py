@@ -0,0 +1,174 @@
+"""
+    Pool of worker processes running KittenGroomerMail, out of the GIL of the proxy
+"""
+
+import threading, queue, multiprocessing, time
+from concurrent.futures import ThreadPoolExecutor
+from kittengroomer_email import KittenGroomerMail
+from .cache import digest
+from . import metrics
+
+# Default number of worker processes
+WORKERS = multiprocessing.cpu_count()
+
+# Default maximum time (in seconds) to sanitize one email
+TIMEOUT = 60
+
+# Default maximum size (in bytes) of a sanitized email
+MAX_SIZE = 50 * 1024 * 1024
+
+# Default number of jobs run by a worker before being replaced
+MAX_JOBS = 100
+
+# Default number of jobs waiting for a worker
+MAX_QUEUE = 100
+
+# Maximum time (in seconds) to wait for a place in the queue
+QUEUE_TIMEOUT = 30
+
+def groom(bmail):
+    """ Return the sanitized raw email (in bytes) """
+    return KittenGroomerMail(bmail).process_mail().as_bytes()
+
+def work(conn):
+    """ Main loop of a worker: receive raw emails and send back the sanitized ones
+    (empty bytes if the sanitization failed) """
+
+    while True:
+        try:
+            bmail = conn.recv_bytes()
+        except EOFError:
+            return
+
+        try:
+            result = groom(bmail)
+        except Exception as e:
+            print('[ERROR] Sanitization failed:', e)
+            result = b''
+
+        conn.send_bytes(result)
+
+class Worker:
+
+    r""" Worker process sanitizing one email at a time.
+
+    Instantiate with: Worker(context)
+
+            context - multiprocessing context used to start the process
+    """
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=work, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def run(self, bmail, timeout):
+        """ Return the sanitized email or None if the sanitization failed.
+        Raise TimeoutError if the worker doesn't answer in time """
+
+        self.conn.send_bytes(bmail)
+        if not self.conn.poll(timeout):
+            raise TimeoutError('Sanitization took more than ' + str(timeout) + 's')
+
+        self.jobs += 1
+        return self.conn.recv_bytes() or None
+
+    def stop(self):
+        """ Stop the worker, killing it if it is busy """
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+class SanitizerPool:
+
+    r""" Pool of worker processes sanitizing raw emails.
+
+    Instantiate with: SanitizerPool([workers[, timeout[, max_size[, max_jobs[, max_queue[, cache]]]]]])
+
+            workers - Number of worker processes (default: number of CPUs)
+            timeout - Maximum time (in seconds) to sanitize one email, the worker is killed after it (default: TIMEOUT)
+            max_size - Emails bigger than max_size bytes are not sanitized (default: MAX_SIZE)
+            max_jobs - A worker is replaced after max_jobs emails (default: MAX_JOBS)
+            max_queue - Maximum number of emails waiting for a worker (default: MAX_QUEUE)
+            cache - SanitizedCache of the emails already sanitized (default: None)
+
+    The calling thread only waits on a pipe while an email is sanitized, so the other
+    connections keep being served. When the queue is full, callers wait up to QUEUE_TIMEOUT
+    seconds for a place and then give up.
+    """
+
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, max_size=MAX_SIZE, max_jobs=MAX_JOBS, max_queue=MAX_QUEUE, cache=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.max_size = max_size
+        self.max_jobs = max_jobs
+        self.context = multiprocessing.get_context('spawn') # No fork of the threads of the proxy
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.executor = ThreadPoolExecutor(workers)
+
+        self.idle = queue.LifoQueue()
+        for i in range(workers):
+            self.idle.put(Worker(self.context))
+
+    def sanitize(self, bmail):
+        """ Return the sanitized raw email (in bytes) or None if it couldn't be sanitized """
+
+        if len(bmail) > self.max_size:
+            print('Email too big to be sanitized:', len(bmail), 'bytes')
+            return None
+
+        if self.cache:
+            key = digest(bmail)
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        content = self.run(bmail)
+        if content and self.cache:
+            self.cache.put(key, content)
+
+        return content
+
+    def run(self, bmail):
+        """ Return the email sanitized by a worker or None """
+
+        if not self.slots.acquire(timeout=QUEUE_TIMEOUT):
+            print('Sanitization queue full')
+            return None
+
+        measure = metrics.ENABLED
+        if measure:
+            metrics.SANITIZE_QUEUE.inc()
+        try:
+            worker = self.idle.get()
+            start = time.perf_counter()
+            try:
+                content = worker.run(bmail, self.timeout)
+            except (TimeoutError, EOFError, OSError) as e:
+                print('[ERROR]', e)
+                worker.stop()
+                worker = Worker(self.context)
+                return None
+            finally:
+                if measure:
+                    metrics.SANITIZE_SECONDS.observe(time.perf_counter() - start)
+
+            if worker.jobs >= self.max_jobs:
+                # Recycle the worker
+                worker.stop()
+                worker = Worker(self.context)
+
+            return content
+        finally:
+            self.idle.put(worker)
+            self.slots.release()
+            if measure:
+                metrics.SANITIZE_QUEUE.dec()
+
+    def submit(self, bmail):
+        """ Return a Future of sanitize(bmail), to sanitize several emails concurrently """
+        return self.executor.submit(self.sanitize, bmail)
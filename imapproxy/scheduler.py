@@ -0,0 +1,195 @@
+"""
+    Fair scheduling of the upstream work of the modules: concurrency limits per account,
+    per host and for the proxy, rate limit per account and round robin between the accounts
+"""
+
+import time, threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from . import metrics
+
+# Default maximum number of units of work running at the same time (all accounts)
+MAX_RUNNING = 8
+
+# Default maximum number of units of work running at the same time for an account
+MAX_ACCOUNT = 1
+
+# Default maximum number of units of work running at the same time on a host (all its accounts)
+MAX_HOST = 4
+
+# Default number of units of work per second for an account, and in a row
+RATE = 5
+BURST = 10
+
+# Maximum time (in seconds) a unit of work waits for its turn
+WAIT_TIMEOUT = 120
+
+# Scheduler of the proxy (created on first use or by configure)
+SCHEDULER = None
+
+def configure(max_running=MAX_RUNNING, max_account=MAX_ACCOUNT, max_host=MAX_HOST, rate=RATE, burst=BURST):
+    """ Create the scheduler of the proxy (see Scheduler) """
+    global SCHEDULER
+    SCHEDULER = Scheduler(max_running, max_account, max_host, rate, burst)
+    metrics.Callback('imapproxy_scheduler', 'Units of upstream work of the modules running and waiting',
+        'gauge', SCHEDULER.stats, ('state',))
+
+def scheduler():
+    """ Return the scheduler of the proxy """
+    if SCHEDULER is None:
+        configure()
+    return SCHEDULER
+
+class Unavailable(ValueError):
+
+    r""" Raised when a unit of work waited WAIT_TIMEOUT seconds for its turn: the command of the
+    client is answered NO [UNAVAILABLE] instead of dropping the connection """
+
+class TokenBucket:
+
+    r""" Token bucket rate limiter.
+
+    Instantiate with: TokenBucket(rate, burst)
+
+            rate - Number of tokens added per second
+            burst - Maximum number of tokens
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """ Take a token and return 0, or return the time (in seconds) before a token is available """
+
+        delay = self.delay()
+        if not delay:
+            self.tokens -= 1
+        return delay
+
+    def delay(self):
+        """ Return the time (in seconds) before a token is available, 0 if one is """
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Scheduler:
+
+    r""" Scheduler of the units of upstream work of the modules (e.g. a batch of emails
+    downloaded, sanitized and appended).
+
+    Instantiate with: Scheduler([max_running[, max_account[, max_host[, rate[, burst]]]]])
+
+            max_running - Maximum number of units running at the same time (default: MAX_RUNNING)
+            max_account - Maximum number of units running at the same time for an account (default: MAX_ACCOUNT)
+            max_host - Maximum number of units running at the same time on a host (default: MAX_HOST)
+            rate - Number of units started per second for an account (default: RATE)
+            burst - Number of units an account can start in a row (default: BURST)
+
+    A unit runs in a slot (see slot). The accounts waiting for a slot take turns: when a slot
+    is free, it goes to the next account in the round whose limits allow it to run, and the
+    account goes to the end of the round. An account syncing a whole mailbox gets one slot
+    of every round, whatever the number of its units waiting, and can't starve the others.
+    """
+
+    def __init__(self, max_running=MAX_RUNNING, max_account=MAX_ACCOUNT, max_host=MAX_HOST, rate=RATE, burst=BURST):
+        self.max_running = max_running
+        self.max_account = max_account
+        self.max_host = max_host
+        self.rate = rate
+        self.burst = burst
+        self.running = 0
+        self.accounts = {} # account -> units running
+        self.hosts = {} # host -> units running
+        self.buckets = {} # account -> TokenBucket
+        self.waiting = OrderedDict() # account -> deque of the waiting units (ticket, host), in the order of the round
+        self.lock = threading.Condition()
+
+    @contextmanager
+    def slot(self, account, host):
+        """ Run the block in a slot of the account on the host """
+        self.acquire(account, host)
+        try:
+            yield
+        finally:
+            self.release(account, host)
+
+    def acquire(self, account, host):
+        """ Wait for the turn of the account, and its slot on the host (Unavailable after WAIT_TIMEOUT seconds) """
+
+        ticket = (object(), host)
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        with self.lock:
+            self.waiting.setdefault(account, deque()).append(ticket)
+            try:
+                while True:
+                    turn, delay = self.next_turn()
+                    if turn == account and self.waiting[account][0] is ticket:
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Unavailable('Error while waiting for the server: '
+                            + 'Too much work running for ' + str(account))
+                    self.lock.wait(min(remaining, delay) if delay else remaining)
+            except BaseException:
+                self.waiting[account].remove(ticket)
+                if not self.waiting[account]:
+                    del self.waiting[account]
+                self.lock.notify_all()
+                raise
+
+            # Run, and go to the end of the round
+            self.waiting[account].popleft()
+            if self.waiting[account]:
+                self.waiting.move_to_end(account)
+            else:
+                del self.waiting[account]
+            self.buckets[account].take()
+            self.running += 1
+            self.accounts[account] = self.accounts.get(account, 0) + 1
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+            self.lock.notify_all()
+
+    def next_turn(self):
+        """ Return (account whose first unit runs next or None, time in seconds before an
+        account waiting for tokens can run or None) (lock held) """
+
+        if self.running >= self.max_running:
+            return None, None
+
+        delay = None
+        for account, units in self.waiting.items():
+            if self.accounts.get(account, 0) >= self.max_account or self.hosts.get(units[0][1], 0) >= self.max_host:
+                continue
+            bucket = self.buckets.setdefault(account, TokenBucket(self.rate, self.burst))
+            wait = bucket.delay()
+            if wait:
+                delay = min(delay, wait) if delay else wait
+                continue
+            return account, None
+        return None, delay
+
+    def release(self, account, host):
+        """ Free the slot of the account on the host, and give it to the next account in the round """
+        with self.lock:
+            self.running -= 1
+            self.accounts[account] -= 1
+            if not self.accounts[account]:
+                del self.accounts[account]
+            self.hosts[host] -= 1
+            if not self.hosts[host]:
+                del self.hosts[host]
+            self.lock.notify_all()
+
+    def stats(self):
+        """ Return the number of units running and waiting (see metrics) """
+        with self.lock:
+            return {('running',): self.running, ('waiting',): sum(len(units) for units in self.waiting.values())}
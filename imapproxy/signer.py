@@ -0,0 +1,107 @@
+"""
+    Integrity signature of the emails appended by the proxy (X-Proxy-Sign header):
+    HMAC of the headers of the MIME structure and of the raw bytes of the body, computed incrementally
+"""
+
+import re, hmac, hashlib, email
+from .helpers import body_offset, add_headers, get_header
+
+# Digests of the signatures
+DIGESTS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256, 'blake2b': hashlib.blake2b}
+
+# Default digest of the new signatures
+DIGEST = 'sha256'
+
+# Headers signed with the body: they give its meaning (MIME boundary, charset, encoding)
+SIGNED_HEADERS = ('Content-Type', 'Content-Transfer-Encoding')
+
+# Proxy header to verify email integrity
+PROXY_SIGN = 'X-Proxy-Sign'
+
+# Tag ending the signatures of the SIGNED_HEADERS and the body. Without it, the signature is the one
+# of the body only, as appended by the previous versions of the proxy.
+HEADERS_TAG = '; h=' + ':'.join(name.lower() for name in SIGNED_HEADERS)
+
+# Signature: digest=hexadecimal HMAC[; h=headers] (or hexadecimal HMAC-SHA1 of the payload, see legacy_signature)
+Signature = re.compile(r'(?P<digest>[a-z0-9]+)=(?P<hmac>[0-9a-f]+)(?P<headers>' + re.escape(HEADERS_TAG) + r')?\Z')
+# X-Proxy-Sign header in a raw header block
+Proxy_Sign = re.compile(rb'^' + PROXY_SIGN.encode() + rb':[ \t]*(?P<value>[^\r\n]*)', flags=re.IGNORECASE | re.MULTILINE)
+
+class Signer:
+
+    r""" Incremental HMAC of an email.
+
+    Instantiate with: Signer(key[, digest])
+
+            key - Key of the proxy
+            digest - Name of the digest (see DIGESTS, default: DIGEST)
+
+    update() is given the canonical headers (see canonical_headers), then the raw bytes of the body
+    as they are stored on the server (CRLF line endings), in as many chunks as needed: the MIME
+    parts are never decoded nor copied.
+    """
+
+    def __init__(self, key, digest=DIGEST):
+        if digest not in DIGESTS:
+            raise ValueError('Error while signing: unknown digest ' + digest)
+        self.digest = digest
+        self.hmac = hmac.new(str(key).encode('utf-8'), digestmod=DIGESTS[digest])
+
+    def update(self, data):
+        self.hmac.update(data)
+
+    def signature(self):
+        """ Return digest=hexadecimal HMAC """
+        return '%s=%s' % (self.digest, self.hmac.hexdigest())
+
+def sign(bmail, key, digest=DIGEST, headers=True):
+    """ Return the signature of the raw email (bytes with CRLF line endings): HMAC of its
+    canonical SIGNED_HEADERS (see canonical_headers) and of its body, of the body only if not headers """
+    offset = body_offset(bmail)
+    signer = Signer(key, digest)
+    if headers:
+        signer.update(canonical_headers(bmail))
+    signer.update(memoryview(bmail)[offset:])
+    return signer.signature() + (HEADERS_TAG if headers else '')
+
+def canonical_headers(bmail):
+    """ Return the SIGNED_HEADERS of the raw email as they are signed: one line 'name:value' per
+    header, with the name in lowercase and the value unfolded, its whitespace runs reduced to one
+    space (empty value if the email has no such header) """
+    lines = []
+    for name in SIGNED_HEADERS:
+        value = get_header(bmail, name) or ''
+        lines.append(name.lower() + ':' + ' '.join(value.split()) + '\r\n')
+    return ''.join(lines).encode('utf-8')
+
+def add_signature(bmail, key, digest=DIGEST):
+    """ Return the raw email (bytes with CRLF line endings) with its X-Proxy-Sign header """
+    return add_headers(bmail, [(PROXY_SIGN, sign(bmail, key, digest))])
+
+def verify(bmail, key):
+    """ Return True if the X-Proxy-Sign header of the raw email (bytes) is valid, False if not,
+    None if it has no signature. The signatures of the body only, and the legacy ones
+    (see legacy_signature), of the previous versions of the proxy are verified too. """
+
+    match = Proxy_Sign.search(bmail, 0, body_offset(bmail))
+    if not match:
+        return None
+    value = match.group('value').decode('ascii', 'replace').strip()
+
+    signature = Signature.match(value)
+    if signature and signature.group('digest') in DIGESTS:
+        return hmac.compare_digest(sign(bmail, key, signature.group('digest'), bool(signature.group('headers'))), value)
+    if re.fullmatch(r'[0-9a-f]{40}', value):
+        mail = email.message_from_bytes(bytes(bmail))
+        return hmac.compare_digest(legacy_signature(mail, key), value)
+    return None
+
+def legacy_signature(mail, key):
+    """ Return the signature of the emails appended by the previous versions of the proxy:
+    HMAC-SHA1 of the concatenated payloads of the first level of the email.Message """
+
+    if mail.is_multipart():
+        payload = ''.join(str(part.get_payload()) for part in mail.get_payload())
+    else:
+        payload = mail.get_payload()
+    return hmac.new(str(key).encode('utf-8'), str(payload).encode('utf-8'), hashlib.sha1).hexdigest()
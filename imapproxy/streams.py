@@ -0,0 +1,76 @@
+"""
+    asyncio streams of the connections of the asyncio engine, with the clients and the servers
+"""
+
+import asyncio
+from .framing import MAX_LINE
+from .compress import Inflater
+
+class StreamReader(asyncio.StreamReader):
+
+    r""" asyncio.StreamReader knowing how many bytes it holds, which can decompress the data it receives.
+
+    Instantiate with: StreamReader([limit])
+
+            limit - Maximum length of a line (default: framing.MAX_LINE)
+
+    size is the number of bytes received and not read yet, e.g. the pipelined requests of a
+    client. Once inflate() is called, the data received is decompressed before being read.
+    """
+
+    def __init__(self, limit=MAX_LINE):
+        super().__init__(limit=limit)
+        self.size = 0 # Bytes received and not read yet
+        self.inflater = None
+
+    def feed_data(self, data):
+        """ Called by the protocol of the stream with the data received """
+        if self.inflater:
+            data = self.inflater.decompress(data)
+        self.size += len(data)
+        super().feed_data(data)
+
+    async def readline(self):
+        line = await super().readline()
+        self.size -= len(line)
+        return line
+
+    async def readexactly(self, n):
+        try:
+            data = await super().readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            self.size -= len(e.partial)
+            raise
+        self.size -= len(data)
+        return data
+
+    async def read(self, n=-1):
+        data = await super().read(n)
+        self.size -= len(data)
+        return data
+
+    async def inflate(self, labels):
+        """ Decompress the data received from now on, including the data held already.
+        Return the Inflater counting the compressed bytes (labels of metrics.COMPRESSED_BYTES). """
+
+        data = await self.read(self.size) if self.size else b''
+        self.inflater = Inflater(labels)
+        if data:
+            self.feed_data(data)
+        return self.inflater
+
+async def open_connection(host, port, **kwds):
+    """ Return the (StreamReader, asyncio.StreamWriter) of a new connection, as asyncio.open_connection """
+
+    loop = asyncio.get_event_loop()
+    reader = StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, protocol = await loop.create_connection(lambda: protocol, host, port, **kwds)
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+async def start_server(client_connected, sock):
+    """ Return the server calling client_connected(StreamReader, asyncio.StreamWriter) for each
+    new connection on the listening socket, as asyncio.start_server """
+
+    loop = asyncio.get_event_loop()
+    return await loop.create_server(lambda: asyncio.StreamReaderProtocol(StreamReader(), client_connected), sock=sock)
@@ -0,0 +1,115 @@
+"""
+    Multi-process mode: worker processes running the proxy on the same port (SO_REUSEPORT)
+"""
+
+import os, socket, signal, time, multiprocessing
+from multiprocessing.connection import wait
+
+# A worker exiting sooner than RESTART_DELAY seconds after its start is restarted after this delay
+RESTART_DELAY = 1
+
+# Time (in seconds) given to the workers after their drain before killing them
+KILL_DELAY = 5
+
+def run_worker(index, setup, options):
+    """ Main function of a worker process: configure the modules and run the proxy """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The supervisor drains the workers with SIGTERM
+
+    from .proxy import IMAP_Proxy
+    if options.get('metrics_port'):
+        options = dict(options, metrics_port=options['metrics_port'] + index)
+    IMAP_Proxy(setup=setup, reuse_port=True, **options)
+
+class Supervisor:
+
+    r""" Supervisor of the worker processes of the proxy.
+
+    Instantiate with: Supervisor(workers, setup, options)
+
+            workers - Number of worker processes
+            setup - Picklable function called without argument in each worker before the proxy starts,
+                to configure the modules (see config.configure_modules), or None
+            options - Arguments of IMAP_Proxy in the workers
+
+    Each worker binds the port with SO_REUSEPORT, so the kernel spreads the new connections
+    over the workers, and keeps its own connections, sessions and caches in memory. The caches
+    with a path (sqlite) and the MISP queue are shared by the workers. Worker i serves its
+    metrics on metrics_port + i.
+
+    A worker which exits is restarted. SIGTERM (or SIGINT) is forwarded to the workers as SIGTERM:
+    they drain their connections (see IMAP_Proxy) and the supervisor exits once they are stopped.
+    """
+
+    def __init__(self, workers, setup, options):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('Error while starting the workers: SO_REUSEPORT is not supported by this system')
+
+        from .proxy import DRAIN_TIMEOUT
+        self.workers = workers
+        self.setup = setup
+        self.options = options
+        self.timeout = DRAIN_TIMEOUT + KILL_DELAY
+        # Workers don't inherit the threads and sockets of the supervisor
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {} # index -> (process, start time)
+        self.stopping = False
+
+    def run(self):
+        """ Start the workers, restart them when they exit and stop them on SIGTERM """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.start(index)
+
+        while not self.stopping:
+            sentinels = {process.sentinel: index for index, (process, start) in self.processes.items()}
+            for sentinel in wait(list(sentinels)):
+                if self.stopping:
+                    break
+                self.restart(sentinels[sentinel])
+
+        self.join()
+
+    def start(self, index):
+        process = self.context.Process(target=run_worker, args=(index, self.setup, self.options),
+            name='imapproxy-worker-%d' % index)
+        process.start()
+        self.processes[index] = (process, time.monotonic())
+        print('Worker', index, 'started (pid', str(process.pid) + ')')
+
+    def restart(self, index):
+        """ Restart a worker which exited """
+
+        process, start = self.processes[index]
+        process.join()
+        print('[ERROR] Worker', index, '(pid', process.pid, ') exited with code', process.exitcode)
+
+        if time.monotonic() - start < RESTART_DELAY: # Don't restart a failing worker in a loop
+            time.sleep(RESTART_DELAY)
+        if not self.stopping:
+            self.start(index)
+
+    def stop(self, signum=None, frame=None):
+        """ Ask the workers to drain their connections """
+
+        if self.stopping:
+            return
+        self.stopping = True
+        print('Stopping', len(self.processes), 'workers')
+        for process, start in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def join(self):
+        """ Wait for the workers to stop and kill the ones still running after the drain """
+
+        deadline = time.monotonic() + self.timeout
+        for process, start in self.processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print('[ERROR] Worker (pid', process.pid, ') killed after the drain')
+                process.kill()
+                process.join()
@@ -0,0 +1,133 @@
+"""
+    SSL/TLS of the connections with the clients: shared context, handshakes and certificate reload
+"""
+
+import os, ssl, time, asyncio, threading
+from . import metrics
+from .streams import StreamReader
+
+# Maximum time (in seconds) given to a client to complete the SSL/TLS handshake
+HANDSHAKE_TIMEOUT = 10
+
+# Minimum interval (in seconds) between two checks of the certificate file for changes
+RELOAD_INTERVAL = 5
+
+# Number of TLS 1.3 session tickets sent to a client after a full handshake
+NUM_TICKETS = 2
+
+def build_context(certfile):
+    """ Return a server SSLContext with the certificate chain (and private key) of the PEM file """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile)
+    # Resumption with session tickets (TLS 1.2 and 1.3) and the session cache of the context
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, 'num_tickets'): # Python 3.8+
+        context.num_tickets = NUM_TICKETS
+    return context
+
+class ServerContext:
+
+    r""" SSLContext of the proxy, built once and rebuilt when the certificate file changes.
+
+    Instantiate with: ServerContext(certfile)
+
+            certfile - PEM formatted certificate chain file, with the private key
+
+    All the connections share the context: the certificate is read once and the clients can
+    resume their sessions. context() checks the modification of the file at most every
+    RELOAD_INTERVAL seconds and builds a new context if it changed, so a renewed certificate
+    is used by the next connections without restarting the proxy. If the new file can't be
+    loaded, the previous context is kept.
+    """
+
+    def __init__(self, certfile):
+        self.certfile = certfile
+        self.version = self.file_version()
+        self.current = build_context(certfile)
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def file_version(self):
+        stat = os.stat(self.certfile)
+        return stat.st_mtime_ns, stat.st_size
+
+    def context(self):
+        """ Return the current SSLContext """
+
+        now = time.monotonic()
+        if now - self.checked >= RELOAD_INTERVAL and self.lock.acquire(blocking=False):
+            try:
+                self.checked = now
+                self.reload()
+            finally:
+                self.lock.release()
+        return self.current
+
+    def reload(self):
+        """ Build a new context if the certificate file changed """
+        try:
+            version = self.file_version()
+            if version != self.version:
+                self.current = build_context(self.certfile)
+                self.version = version
+                print('Certificate reloaded from', self.certfile)
+        except (OSError, ssl.SSLError) as e:
+            print('[ERROR] Certificate not reloaded, the previous one is kept:', e)
+
+    def stats(self):
+        """ Return the session statistics of the current context (see SSLContext.session_stats) """
+        return {(name,): value for name, value in self.current.session_stats().items()}
+
+def handshake(sock, context):
+    """ Return the SSL socket of the connected socket once the handshake is completed.
+    Raise OSError (ssl.SSLError, socket.timeout) if the client fails to complete it in HANDSHAKE_TIMEOUT seconds """
+
+    ssock = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    start = time.perf_counter()
+    try:
+        ssock.settimeout(HANDSHAKE_TIMEOUT)
+        ssock.do_handshake()
+        ssock.settimeout(None)
+    except OSError:
+        if metrics.ENABLED:
+            metrics.TLS_HANDSHAKE_FAILURES.inc()
+        ssock.close()
+        raise
+    if metrics.ENABLED:
+        metrics.TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - start, (resumed(ssock),))
+    return ssock
+
+def resumed(ssl_object):
+    """ Return the label of a completed handshake: 'resumed' or 'full' """
+    return 'resumed' if ssl_object.session_reused else 'full'
+
+async def start_tls(reader, writer, context):
+    """ Start SSL/TLS on the connection of the asyncio streams (server side) and wait for the handshake.
+    Return the (reader, writer) of the protected connection, which replace the given ones.
+    Raise OSError if the client fails to complete it in HANDSHAKE_TIMEOUT seconds """
+
+    start = time.perf_counter()
+    try:
+        if hasattr(writer, 'start_tls'): # Python 3.11+
+            await writer.start_tls(context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        else:
+            reader, writer = await wrap_streams(writer, context)
+    except OSError:
+        if metrics.ENABLED:
+            metrics.TLS_HANDSHAKE_FAILURES.inc()
+        raise
+    if metrics.ENABLED:
+        metrics.TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - start,
+            (resumed(writer.get_extra_info('ssl_object')),))
+    return reader, writer
+
+async def wrap_streams(writer, context):
+    """ Return new (reader, writer) streams on the SSL/TLS transport started on the connection of the writer """
+
+    loop = asyncio.get_event_loop()
+    reader = StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport = await loop.start_tls(writer.transport, protocol, context, server_side=True,
+        ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+    protocol.connection_made(transport) # Not called by start_tls
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
@@ -0,0 +1,224 @@
+"""
+    Protocol tracer: sampled and redacted traces of the connections, written in background
+"""
+
+import os, sys, time, queue, random, struct, threading, itertools, re
+from collections import deque
+from .framing import literal_size
+
+# Default fraction of the connections traced (1: all of them)
+SAMPLE = 1.0
+
+# Bytes of a literal shown in the trace, and maximum length of a line shown in the trace
+MAX_LITERAL = 64
+MAX_LINE = 1024
+
+# Maximum number of events waiting for the writer, the next events are dropped
+QUEUE_SIZE = 10000
+
+# Number of last events of every connection kept for the dumps on error (0 disables the dumps)
+RING_SIZE = 64
+
+# Default directory of the dumps
+DUMP_PATH = 'trace_dumps'
+
+# Directions of the events, and their prefix in the trace
+CLIENT_IN, CLIENT_OUT, SERVER_OUT, SERVER_IN = range(4)
+ARROWS = ('[-->]: ', '[<--]: ', '  [-->]: ', '  [<--]: ')
+
+# Commands whose arguments are credentials
+Credentials = re.compile(rb'\A(?P<command>(?P<tag>[^ ]+) (LOGIN|AUTHENTICATE) )', flags=re.IGNORECASE)
+REDACTED = b'<redacted>\r\n'
+
+# Dump: header, then one record (time, direction, size) followed by the data per event
+DUMP_MAGIC = b'IMAPTRACE1\n'
+Record = struct.Struct('>dBI')
+
+# Tracer of the proxy (created on first use or by configure)
+TRACER = None
+
+def configure(path=None, sample=SAMPLE, users=(), max_literal=MAX_LITERAL, dump_path=DUMP_PATH, ring_size=RING_SIZE):
+    """ Create the tracer of the proxy with the given options (see Tracer) """
+    global TRACER
+    TRACER = Tracer(path, sample, users, max_literal, dump_path, ring_size)
+
+def tracer():
+    """ Return the tracer of the proxy """
+    if TRACER is None:
+        configure()
+    return TRACER
+
+class Tracer:
+
+    r""" Trace of the IMAP payload of the connections, written by a background thread.
+
+    Instantiate with: Tracer([path[, sample[, users[, max_literal[, dump_path[, ring_size]]]]]])
+
+            path - File the trace is appended to (default: None, standard output)
+            sample - Fraction of the connections traced (default: SAMPLE, 0 only keeps the dumps)
+            users - Usernames whose connections are always traced (default: ())
+            max_literal - Bytes of a literal shown in the trace (default: MAX_LITERAL)
+            dump_path - Directory of the dumps written on error (default: DUMP_PATH)
+            ring_size - Number of last events of every connection dumped on error (default: RING_SIZE)
+
+    Every connection gets an id. Literals are truncated and the arguments of LOGIN and
+    AUTHENTICATE are redacted before the events are queued. When the queue is full, events
+    are dropped instead of slowing down the connections. The last events of every connection
+    (traced or not) are kept in a ring buffer, written in binary by dump() (see read_dump).
+    """
+
+    def __init__(self, path=None, sample=SAMPLE, users=(), max_literal=MAX_LITERAL, dump_path=DUMP_PATH, ring_size=RING_SIZE):
+        self.sample = sample
+        self.users = frozenset(users)
+        self.max_literal = max_literal
+        self.dump_path = dump_path
+        self.ring_size = ring_size
+        self.ids = itertools.count(1)
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.dropped = 0
+
+        self.file = open(path, 'a') if path else sys.stdout
+        threading.Thread(target=self.write_forever, daemon=True).start()
+
+    def connection(self):
+        """ Return the ConnectionTrace of a new connection """
+        return ConnectionTrace(self, next(self.ids), random.random() < self.sample)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_forever(self):
+        """ Format and write the queued events """
+
+        reported = 0
+        while True:
+            events = [self.queue.get()]
+            while not self.queue.empty() and len(events) < 1000:
+                events.append(self.queue.get_nowait())
+
+            lines = []
+            if self.dropped != reported:
+                lines.append('[TRACE] %d events dropped\n' % (self.dropped - reported))
+                reported = self.dropped
+            for (timestamp, id, direction, data) in events:
+                lines.append('%s.%03d #%d %s%r\n' % (time.strftime('%H:%M:%S', time.localtime(timestamp)),
+                    timestamp % 1 * 1000, id, ARROWS[direction], data))
+
+            self.file.write(''.join(lines))
+            self.file.flush()
+
+class ConnectionTrace:
+
+    r""" Trace of one connection.
+
+    Instantiate with: ConnectionTrace(tracer, id, sampled)
+
+            sampled - True if the events are written in the trace
+    """
+
+    def __init__(self, tracer, id, sampled):
+        self.tracer = tracer
+        self.id = id
+        self.sampled = sampled
+        self.ring = deque(maxlen=tracer.ring_size) if tracer.ring_size else None
+        self.left = [0, 0, 0, 0] # bytes of literal left, per direction
+        self.sizes = [0, 0, 0, 0] # size of the current literal, per direction
+        self.redact = None # tag (and space) of the command whose credentials are being sent
+
+    def identify(self, username):
+        """ Trace the connection if the user is one of the traced users """
+        if username in self.tracer.users:
+            self.sampled = True
+
+    def event(self, direction, data):
+        """ Record data (bytes or memoryview) sent or received in the given direction """
+
+        if not (self.sampled or self.ring is not None):
+            return
+
+        data = self.shorten(direction, data)
+        if data is None:
+            return
+
+        event = (time.time(), self.id, direction, data)
+        if self.ring is not None:
+            self.ring.append(event)
+        if self.sampled:
+            self.tracer.put(event)
+
+    def events(self, direction, parts):
+        """ Record the parts of an iterable while yielding them """
+        for part in parts:
+            self.event(direction, part)
+            yield part
+
+    def shorten(self, direction, data):
+        """ Return the bytes shown for the data: None for the rest of a literal already shown """
+
+        left = self.left[direction]
+        if left:
+            # Part of a literal: only its start is shown
+            self.left[direction] = max(0, left - len(data))
+            size = self.sizes[direction]
+            if left != size:
+                return None
+            if direction == CLIENT_IN and self.redact:
+                return REDACTED
+            shown = bytes(data[:self.tracer.max_literal])
+            return shown + (b'... (%d bytes)' % size if size > len(shown) else b'')
+
+        line = bytes(data[:MAX_LINE])
+        literal = literal_size(line)
+        if literal:
+            self.left[direction] = self.sizes[direction] = literal[0]
+
+        if direction == CLIENT_IN:
+            if self.redact:
+                return REDACTED
+            match = Credentials.match(line)
+            if match:
+                # Credentials until the completion of the command (literals, AUTHENTICATE exchanges)
+                self.redact = match.group('tag') + b' '
+                return match.group('command') + REDACTED
+        elif self.redact and line.startswith(self.redact):
+            self.redact = None
+
+        return line if len(data) <= MAX_LINE else line + b'... (%d bytes)' % len(data)
+
+    def dump(self, reason):
+        """ Write the last events of the connection in a file of the dump directory and return its path """
+
+        if not self.ring:
+            return None
+
+        os.makedirs(self.tracer.dump_path, exist_ok=True)
+        path = os.path.join(self.tracer.dump_path, 'connection-%d-%d-%d.trace' % (os.getpid(), self.id, time.time()))
+        with open(path, 'wb') as f:
+            f.write(DUMP_MAGIC)
+            f.write(str(reason).encode('utf-8', 'replace').replace(b'\n', b' ') + b'\n')
+            for (timestamp, id, direction, data) in list(self.ring):
+                f.write(Record.pack(timestamp, direction, len(data)))
+                f.write(data)
+
+        return path
+
+def read_dump(path):
+    """ Return (reason, [(time, direction, data)]) of a dump written by ConnectionTrace.dump """
+
+    with open(path, 'rb') as f:
+        if f.readline() != DUMP_MAGIC:
+            raise ValueError('Error while reading the dump: ' + path + ' is not a trace dump')
+        reason = f.readline()[:-1].decode('utf-8', 'replace')
+
+        events = []
+        while True:
+            record = f.read(Record.size)
+            if len(record) < Record.size:
+                break
+            timestamp, direction, size = Record.unpack(record)
+            events.append((timestamp, direction, f.read(size)))
+
+    return reason, events
@@ -10,12 +10,21 @@ setup(
     maintainer='Xavier Schul',
     url='https://github.com/CIRCL/IMAP-Proxy',
     description='IMAP Proxy to sanitize attachments and share threats to MISP',
-    packages=['imapproxy'],
-    scripts=['bin/start_cl.py', 'bin/start_conf.py', 'bin/test_proxy.py', 'bin/test_pycircleanmail.py'],
+    packages=['imapproxy', 'imapproxy.bench'],
+    python_requires='>=3.7',
+    scripts=['bin/start_cl.py', 'bin/start_conf.py', 'bin/test_proxy.py', 'bin/test_pycircleanmail.py',
+        'bin/test_index.py', 'bin/test_fetchcache.py', 'bin/bench_fetch_literal.py',
+        'bin/bench_sequence_set.py', 'bin/bench_proxy.py', 'bin/bench_process_email.py', 'bin/read_trace.py'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Console',
         'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Security'
     ]
 )
\ No newline at end of file